@@ -1,6 +1,10 @@
 from kilroy_module_server_py_sdk import *
 from kilroy_module_pytorch_py_sdk.generator import Generator
-from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
+from kilroy_module_pytorch_py_sdk.models.abc import (
+    SequentialModel,
+    StepwiseSequentialModel,
+)
+from kilroy_module_pytorch_py_sdk.models.batcher import ForwardBatcher
 from kilroy_module_pytorch_py_sdk.models.loader import ModelLoader
 from kilroy_module_pytorch_py_sdk.models.registry import ModelsRegistry
 from kilroy_module_pytorch_py_sdk.module.module import PytorchModule
@@ -15,6 +19,7 @@ from kilroy_module_pytorch_py_sdk.optimizers import (
     RMSPropOptimizer,
     SGDOptimizer,
 )
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
 from kilroy_module_pytorch_py_sdk.resources import (
     resource,
     resource_bytes,
@@ -46,4 +51,5 @@ from kilroy_module_pytorch_py_sdk.utils import (
     unpack_to_padded,
     unpad,
     freeze,
+    gather_packed,
 )
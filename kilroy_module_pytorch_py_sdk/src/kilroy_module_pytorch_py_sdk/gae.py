@@ -2,9 +2,10 @@ from typing import Dict, Any, Callable, Awaitable
 
 import torch
 from pydantic import Field
+from torch import Tensor
 from torch.nn.utils.rnn import PackedSequence
 
-from kilroy_module_pytorch_py_sdk.utils import unpack_to_list, pack_list
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
 from kilroy_module_server_py_sdk import SerializableState
 from kilroy_server_py_utils import Configurable, Parameter, classproperty
 
@@ -55,6 +56,41 @@ class GeneralizedAdvantageEstimator(Configurable[State]):
             state.lambda_ = value
             return undo
 
+    @staticmethod
+    def _align(rewards: PackedSequence, values: PackedSequence) -> Tensor:
+        if torch.equal(rewards.batch_sizes, values.batch_sizes) and (
+            rewards.unsorted_indices is values.unsorted_indices
+            or (
+                rewards.unsorted_indices is not None
+                and values.unsorted_indices is not None
+                and torch.equal(
+                    rewards.unsorted_indices, values.unsorted_indices
+                )
+            )
+        ):
+            return rewards.data
+        return RaggedBatch.from_packed(rewards).to_packed_like(values).data
+
+    @staticmethod
+    def _get_next(x: Tensor, batch_sizes: Tensor, steps: Tensor) -> Tensor:
+        rows = torch.arange(len(x))[steps > 0]
+        previous = rows - batch_sizes[steps[steps > 0] - 1]
+        return x.new_zeros(x.shape).index_copy(
+            0, previous.to(x.device), x[rows.to(x.device)]
+        )
+
+    @staticmethod
+    def _discount(x: Tensor, batch_sizes: Tensor, factor: float) -> Tensor:
+        if factor == 0:
+            return x
+
+        discounted, running = [], x.new_zeros((0, *x.shape[1:]))
+        for step in reversed(x.split(batch_sizes.tolist())):
+            padding = step.new_zeros((len(step) - len(running), *x.shape[1:]))
+            running = step + factor * torch.cat((running, padding))
+            discounted.append(running)
+        return torch.cat(discounted[::-1])
+
     async def calculate(
         self, rewards: PackedSequence, values: PackedSequence
     ) -> PackedSequence:
@@ -62,27 +98,19 @@ class GeneralizedAdvantageEstimator(Configurable[State]):
             gamma = state.gamma
             lambda_ = state.lambda_
 
-        batch_rewards = unpack_to_list(rewards)
-        batch_values = unpack_to_list(values)
-
-        batch_advantages = []
-
-        for rewards, values in zip(batch_rewards, batch_values):
-            advantages = []
-            advantage = 0
-
-            for i in reversed(range(len(rewards))):
-                reward = rewards[i]
-                value = values[i]
-                next_value = (
-                    torch.zeros(1) if i == len(rewards) - 1 else values[i + 1]
-                )
+        batch_sizes = values.batch_sizes
+        steps = torch.arange(len(batch_sizes)).repeat_interleave(batch_sizes)
 
-                delta = reward + gamma * next_value - value
-                advantage = delta + gamma * lambda_ * advantage
-                advantages.append(advantage)
+        rewards = self._align(rewards, values)
+        data = values.data
 
-            advantages = torch.stack(advantages[::-1])
-            batch_advantages.append(advantages)
+        next_values = self._get_next(data, batch_sizes, steps)
+        deltas = rewards + gamma * next_values - data
+        advantages = self._discount(deltas, batch_sizes, gamma * lambda_)
 
-        return pack_list(batch_advantages)
+        return PackedSequence(
+            advantages,
+            batch_sizes,
+            values.sorted_indices,
+            values.unsorted_indices,
+        )
@@ -0,0 +1,464 @@
+import re
+from typing import Any, Callable, Dict, List, Pattern, Tuple
+
+import torch
+from torch import Tensor
+
+from kilroy_module_pytorch_py_sdk.tokenizer import Tokenizer
+
+try:
+    from re import _constants as constants, _parser as parser
+except ImportError:  # Python < 3.11
+    import sre_constants as constants
+    import sre_parse as parser
+
+MAX_STATES = 10000
+INFINITY = torch.iinfo(torch.int32).max
+
+
+class _Node:
+    __slots__ = ("kind", "args")
+
+    def __init__(self, kind: str, args: Tuple) -> None:
+        self.kind = kind
+        self.args = args
+
+
+class _RegexCompiler:
+    def __init__(self, regex: Pattern[str], alphabet: List[str]) -> None:
+        if regex.flags & (re.IGNORECASE | re.MULTILINE | re.LOCALE):
+            raise ValueError("Unsupported regex flags")
+
+        self._flags = regex.flags
+        self._nodes: Dict[Tuple, _Node] = {}
+        self._predicates: List[Callable[[str], bool]] = []
+        self._nullable: Dict[Tuple[_Node, bool], bool] = {}
+        self._derivatives: Dict[Tuple[_Node, int, bool], _Node] = {}
+
+        self.empty = self._node("empty", ())
+        self.epsilon = self._node("epsilon", ())
+        self.everything = self._node("not", (self.empty,))
+
+        parsed = parser.parse(regex.pattern, regex.flags)
+        tree = self._compile(list(parsed), ("epsilon",))
+        self.classes, self.alphabet = self._build_classes(alphabet)
+        self.root = self._resolve(tree, {})
+
+    def _node(self, kind: str, args: Tuple) -> _Node:
+        key = (kind, args)
+        if key not in self._nodes:
+            self._nodes[key] = _Node(kind, args)
+        return self._nodes[key]
+
+    def _predicate(self, predicate: Callable[[str], bool]) -> Tuple:
+        self._predicates.append(predicate)
+        return ("chars", len(self._predicates) - 1)
+
+    def _category(self, category: Any) -> Callable[[str], bool]:
+        patterns = {
+            constants.CATEGORY_DIGIT: r"\d",
+            constants.CATEGORY_NOT_DIGIT: r"\D",
+            constants.CATEGORY_SPACE: r"\s",
+            constants.CATEGORY_NOT_SPACE: r"\S",
+            constants.CATEGORY_WORD: r"\w",
+            constants.CATEGORY_NOT_WORD: r"\W",
+        }
+        if category not in patterns:
+            raise ValueError(f"Unsupported regex category: {category}")
+        pattern = re.compile(patterns[category], self._flags)
+        return lambda char: pattern.fullmatch(char) is not None
+
+    def _set_predicate(self, items: List) -> Callable[[str], bool]:
+        tests, negate = [], False
+
+        for op, av in items:
+            if op is constants.NEGATE:
+                negate = True
+            elif op is constants.LITERAL:
+                tests.append(lambda char, value=av: ord(char) == value)
+            elif op is constants.RANGE:
+                tests.append(
+                    lambda char, low=av[0], high=av[1]: low
+                    <= ord(char)
+                    <= high
+                )
+            elif op is constants.CATEGORY:
+                tests.append(self._category(av))
+            else:
+                raise ValueError(f"Unsupported regex set item: {op}")
+
+        return lambda char: any(test(char) for test in tests) != negate
+
+    @staticmethod
+    def _has_assertions(items: List) -> bool:
+        for op, av in items:
+            if op in (constants.AT, constants.ASSERT, constants.ASSERT_NOT):
+                return True
+            if op is constants.BRANCH:
+                if any(_RegexCompiler._has_assertions(b) for b in av[1]):
+                    return True
+            if op is constants.SUBPATTERN:
+                if _RegexCompiler._has_assertions(list(av[-1])):
+                    return True
+            if op in (constants.MAX_REPEAT, constants.MIN_REPEAT):
+                if _RegexCompiler._has_assertions(list(av[2])):
+                    return True
+        return False
+
+    def _compile(self, items: List, continuation: Tuple) -> Tuple:
+        for op, av in reversed(items):
+            continuation = self._compile_item(op, av, continuation)
+        return continuation
+
+    def _compile_item(self, op: Any, av: Any, continuation: Tuple) -> Tuple:
+        if op is constants.LITERAL:
+            chars = self._predicate(lambda char: ord(char) == av)
+            return ("concat", chars, continuation)
+        if op is constants.NOT_LITERAL:
+            chars = self._predicate(lambda char: ord(char) != av)
+            return ("concat", chars, continuation)
+        if op is constants.ANY:
+            if self._flags & re.DOTALL:
+                chars = self._predicate(lambda char: True)
+            else:
+                chars = self._predicate(lambda char: char != "\n")
+            return ("concat", chars, continuation)
+        if op is constants.IN:
+            chars = self._predicate(self._set_predicate(av))
+            return ("concat", chars, continuation)
+        if op is constants.BRANCH:
+            return (
+                "union",
+                *(self._compile(list(b), continuation) for b in av[1]),
+            )
+        if op is constants.SUBPATTERN:
+            if av[1] or av[2]:
+                raise ValueError("Unsupported inline regex flags")
+            return self._compile(list(av[3]), continuation)
+        if op in (constants.MAX_REPEAT, constants.MIN_REPEAT):
+            low, high, items = av
+            if self._has_assertions(list(items)):
+                raise ValueError("Unsupported assertion inside repetition")
+            body = self._compile(list(items), ("epsilon",))
+            if high is constants.MAXREPEAT:
+                tail = ("star", body)
+            else:
+                tail = ("epsilon",)
+                for _ in range(high - low):
+                    tail = ("union", ("epsilon",), ("concat", body, tail))
+            tail = ("concat", tail, continuation)
+            for _ in range(low):
+                tail = ("concat", body, tail)
+            return tail
+        if op is constants.AT:
+            if av in (constants.AT_BEGINNING, constants.AT_BEGINNING_STRING):
+                return ("start", continuation)
+            if av is constants.AT_END:
+                newline = self._predicate(lambda char: char == "\n")
+                end = ("union", ("epsilon",), newline)
+                return ("and", end, continuation)
+            if av is constants.AT_END_STRING:
+                return ("and", ("epsilon",), continuation)
+            raise ValueError(f"Unsupported regex anchor: {av}")
+        if op in (constants.ASSERT, constants.ASSERT_NOT):
+            direction, items = av
+            if direction != 1:
+                raise ValueError("Unsupported lookbehind assertion")
+            lookahead = self._compile(list(items), ("everything",))
+            if op is constants.ASSERT_NOT:
+                lookahead = ("not", lookahead)
+            return ("and", lookahead, continuation)
+        raise ValueError(f"Unsupported regex operation: {op}")
+
+    def _build_classes(
+        self, alphabet: List[str]
+    ) -> Tuple[List[frozenset], Dict[str, int]]:
+        signatures, mapping = {}, {}
+        for char in alphabet:
+            signature = tuple(p(char) for p in self._predicates)
+            mapping[char] = signatures.setdefault(signature, len(signatures))
+
+        classes = [set() for _ in self._predicates]
+        for signature, index in signatures.items():
+            for predicate, matches in enumerate(signature):
+                if matches:
+                    classes[predicate].add(index)
+        return [frozenset(c) for c in classes], mapping
+
+    def _resolve(self, tree: Tuple, resolved: Dict[int, _Node]) -> _Node:
+        if id(tree) not in resolved:
+            resolved[id(tree)] = self._resolve_new(tree, resolved)
+        return resolved[id(tree)]
+
+    def _resolve_new(self, tree: Tuple, resolved: Dict[int, _Node]) -> _Node:
+        kind, *args = tree
+        if kind == "empty":
+            return self.empty
+        if kind == "epsilon":
+            return self.epsilon
+        if kind == "everything":
+            return self.everything
+        if kind == "chars":
+            return self.chars(self.classes[args[0]])
+        builders = {
+            "concat": self.concat,
+            "union": self.union,
+            "and": self.intersection,
+            "not": self.complement,
+            "star": self.star,
+            "start": self.start,
+        }
+        args = (self._resolve(arg, resolved) for arg in args)
+        return builders[kind](*args)
+
+    def chars(self, classes: frozenset) -> _Node:
+        if not classes:
+            return self.empty
+        return self._node("chars", (classes,))
+
+    def concat(self, left: _Node, right: _Node) -> _Node:
+        if left is self.empty or right is self.empty:
+            return self.empty
+        if left is self.epsilon:
+            return right
+        if right is self.epsilon:
+            return left
+        if left.kind == "concat":
+            return self.concat(left.args[0], self.concat(left.args[1], right))
+        return self._node("concat", (left, right))
+
+    def _flatten(self, kind: str, nodes: Tuple[_Node, ...]) -> frozenset:
+        flat = set()
+        for node in nodes:
+            flat.update(node.args[0] if node.kind == kind else (node,))
+        return frozenset(flat)
+
+    def union(self, *nodes: _Node) -> _Node:
+        nodes = self._flatten("union", nodes) - {self.empty}
+        if self.everything in nodes:
+            return self.everything
+        if len(nodes) == 0:
+            return self.empty
+        if len(nodes) == 1:
+            return next(iter(nodes))
+        return self._node("union", (nodes,))
+
+    def intersection(self, *nodes: _Node) -> _Node:
+        nodes = self._flatten("and", nodes) - {self.everything}
+        if self.empty in nodes:
+            return self.empty
+        if len(nodes) == 0:
+            return self.everything
+        if len(nodes) == 1:
+            return next(iter(nodes))
+        return self._node("and", (nodes,))
+
+    def complement(self, node: _Node) -> _Node:
+        if node.kind == "not":
+            return node.args[0]
+        return self._node("not", (node,))
+
+    def star(self, node: _Node) -> _Node:
+        if node is self.empty or node is self.epsilon:
+            return self.epsilon
+        if node.kind == "star":
+            return node
+        return self._node("star", (node,))
+
+    def start(self, node: _Node) -> _Node:
+        if node is self.empty:
+            return self.empty
+        return self._node("start", (node,))
+
+    def nullable(self, node: _Node, at_start: bool) -> bool:
+        key = (node, at_start)
+        if key in self._nullable:
+            return self._nullable[key]
+
+        kind, args = node.kind, node.args
+        if kind in ("epsilon", "star"):
+            value = True
+        elif kind in ("empty", "chars"):
+            value = False
+        elif kind == "concat":
+            value = all(self.nullable(arg, at_start) for arg in args)
+        elif kind == "union":
+            value = any(self.nullable(arg, at_start) for arg in args[0])
+        elif kind == "and":
+            value = all(self.nullable(arg, at_start) for arg in args[0])
+        elif kind == "not":
+            value = not self.nullable(args[0], at_start)
+        else:
+            value = at_start and self.nullable(args[0], at_start)
+
+        self._nullable[key] = value
+        return value
+
+    def derivative(self, node: _Node, char: int, at_start: bool) -> _Node:
+        key = (node, char, at_start)
+        if key in self._derivatives:
+            return self._derivatives[key]
+
+        kind, args = node.kind, node.args
+        if kind in ("empty", "epsilon"):
+            value = self.empty
+        elif kind == "chars":
+            value = self.epsilon if char in args[0] else self.empty
+        elif kind == "concat":
+            left, right = args
+            value = self.concat(self.derivative(left, char, at_start), right)
+            if self.nullable(left, at_start):
+                value = self.union(
+                    value, self.derivative(right, char, at_start)
+                )
+        elif kind == "union":
+            value = self.union(
+                *(self.derivative(arg, char, at_start) for arg in args[0])
+            )
+        elif kind == "and":
+            value = self.intersection(
+                *(self.derivative(arg, char, at_start) for arg in args[0])
+            )
+        elif kind == "not":
+            value = self.complement(self.derivative(args[0], char, at_start))
+        elif kind == "star":
+            value = self.concat(self.derivative(args[0], char, at_start), node)
+        elif at_start:
+            value = self.derivative(args[0], char, at_start)
+        else:
+            value = self.empty
+
+        self._derivatives[key] = value
+        return value
+
+
+class TokenAutomaton:
+    def __init__(
+        self, regex: Pattern[str], pieces: List[str], end_token: int
+    ) -> None:
+        alphabet = sorted(set("".join(pieces)))
+        compiler = _RegexCompiler(regex, alphabet)
+        groups, token_groups = {}, []
+        for piece in pieces:
+            key = tuple(compiler.alphabet[char] for char in piece)
+            token_groups.append(groups.setdefault(key, len(groups)))
+
+        trie = self._build_trie(list(groups.keys()))
+        states, accepting, transitions = self._explore(
+            compiler, trie, len(groups)
+        )
+
+        group_transitions = torch.tensor(transitions, dtype=torch.long)
+        distances = self._get_distances(
+            group_transitions, torch.tensor(accepting)
+        )
+        token_groups = torch.tensor(token_groups, dtype=torch.long)
+
+        self.transitions = group_transitions[:, token_groups]
+        self.transitions[:, end_token] = torch.where(
+            torch.tensor(accepting), torch.arange(len(states)), -1
+        )
+        self.distances = distances[self.transitions.clamp(min=0)]
+        self.distances[self.transitions < 0] = INFINITY
+        self.distances = self.distances.to(torch.int32)
+        finite = distances[distances < INFINITY]
+        self.horizon = int(finite.max()) + 1 if len(finite) > 0 else 1
+
+    @classmethod
+    def build(
+        cls, regex: Pattern[str], tokenizer: Tokenizer, size: int
+    ) -> "TokenAutomaton":
+        pieces = tokenizer.decode_pieces(list(range(size)))
+        return cls(regex, pieces, tokenizer.end_token)
+
+    @staticmethod
+    def _build_trie(sequences: List[Tuple[int, ...]]) -> Dict:
+        trie = {}
+        for group, sequence in enumerate(sequences):
+            node = trie
+            for char in sequence:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(group)
+        return trie
+
+    @staticmethod
+    def _explore(
+        compiler: _RegexCompiler, trie: Dict, n_groups: int
+    ) -> Tuple[List[_Node], List[bool], List[List[int]]]:
+        states = [compiler.root]
+        indices = {(compiler.root, True): 0}
+        transitions = []
+
+        for index in range(MAX_STATES):
+            if index >= len(states):
+                break
+            row = [-1] * n_groups
+            stack = [(trie, states[index], index == 0)]
+            while stack:
+                node, state, at_start = stack.pop()
+                if state is compiler.empty:
+                    continue
+                for char, child in node.items():
+                    if char is not None:
+                        next_state = compiler.derivative(state, char, at_start)
+                        stack.append((child, next_state, False))
+                        continue
+                    key = (state, at_start)
+                    if key not in indices:
+                        indices[key] = len(states)
+                        states.append(state)
+                    for group in child:
+                        row[group] = indices[key]
+            transitions.append(row)
+        else:
+            raise ValueError("Regex is too complex for constrained decoding")
+
+        accepting = [
+            compiler.nullable(state, i == 0) for i, state in enumerate(states)
+        ]
+        return states, accepting, transitions
+
+    @staticmethod
+    def _get_distances(transitions: Tensor, accepting: Tensor) -> Tensor:
+        distances = torch.where(accepting, 0, INFINITY)
+
+        for _ in range(len(transitions)):
+            next_distances = torch.where(
+                transitions >= 0,
+                distances[transitions.clamp(min=0)],
+                INFINITY,
+            )
+            candidates = next_distances.min(-1).values + 1
+            updated = torch.minimum(distances, candidates.clamp(max=INFINITY))
+            if torch.equal(updated, distances):
+                break
+            distances = updated
+
+        return distances
+
+    def run(self, sequences: Tensor, lengths: Tensor) -> Tensor:
+        states = torch.zeros(len(sequences), dtype=torch.long)
+        for i in range(sequences.shape[1]):
+            selected = lengths > i
+            if not selected.any():
+                break
+            states[selected] = self.advance(
+                states[selected], sequences[selected, i]
+            )
+        return states
+
+    def advance(self, states: Tensor, tokens: Tensor) -> Tensor:
+        alive = states >= 0
+        next_states = torch.full_like(states, -1)
+        next_states[alive] = self.transitions[states[alive], tokens[alive]]
+        return next_states
+
+    def mask(self, states: Tensor, budgets: Tensor) -> Tensor:
+        budgets = budgets.clamp(max=self.horizon)
+        keys = torch.stack([states, budgets], dim=-1)
+        keys, inverse = keys.unique(dim=0, return_inverse=True)
+        states, budgets = keys[:, 0], keys[:, 1:]
+        allowed = self.distances[states.clamp(min=0)] < budgets
+        allowed |= (states < 0).unsqueeze(-1)
+        allowed |= ~allowed.any(-1, keepdim=True)
+        return allowed[inverse]
@@ -1,45 +1,76 @@
-import random
+import asyncio
 import re
 from abc import ABC
-from dataclasses import dataclass
+from contextlib import aclosing
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterable, List, Set, Type, Pattern, Tuple, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+    Type,
+)
 
 import torch
 from kilroy_module_server_py_sdk import Configurable, Parameter, classproperty
+from kilroy_server_py_utils.utils import background
 from torch import Tensor
 from torch.distributions import Categorical
+from torch.nn.utils.rnn import PackedSequence
 
+from kilroy_module_pytorch_py_sdk.generator.automaton import TokenAutomaton
 from kilroy_module_pytorch_py_sdk.generator.parameters import (
     ContextsParameter,
     RegexParameter,
     MaxLengthParameter,
+    ConstrainedParameter,
+    WindowParameter,
 )
 from kilroy_module_pytorch_py_sdk.generator.params import Params
-from kilroy_module_pytorch_py_sdk.generator.state import State
-from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
+from kilroy_module_pytorch_py_sdk.generator.state import ContextIndex, State
+from kilroy_module_pytorch_py_sdk.models.abc import (
+    SequentialModel,
+    StepwiseSequentialModel,
+)
 from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
 from kilroy_module_pytorch_py_sdk.tokenizer import Tokenizer
 from kilroy_module_pytorch_py_sdk.utils import freeze
 from kilroy_module_pytorch_py_sdk.utils import (
     unpack_to_padded,
+    pack_padded,
     pack_list,
-    batched_forward,
+    pad,
+    model_forward,
+    get_batch_ranges,
 )
 
 
 @dataclass
-class SequenceState:
-    context: List[int]
-    response: List[int]
+class GenerationState:
+    sequences: Tensor
+    context_lengths: Tensor
+    lengths: Tensor
+    active: Tensor
+    index: ContextIndex
+    needed: int
+    regex: Optional[Pattern[str]] = None
+    automata: Optional[Dict] = None
+    automaton: Optional[TokenAutomaton] = None
+    automaton_states: Optional[Tensor] = None
+    logprobs: Optional[Tensor] = None
+    finished: asyncio.Queue = field(default_factory=asyncio.Queue)
 
 
 @dataclass
-class GenerationState:
-    waiting_sequences: List[SequenceState]
-    current_sequences: List[SequenceState]
-    finished_sequences: List[SequenceState]
-    current_max_length: int
+class PrefixNode:
+    tokens: List[int]
+    children: Dict[int, "PrefixNode"] = field(default_factory=dict)
+    contexts: List[int] = field(default_factory=list)
 
 
 class GeneratorBase(Configurable[State], ABC):
@@ -50,6 +81,8 @@ class GeneratorBase(Configurable[State], ABC):
             ContextsParameter,
             RegexParameter,
             MaxLengthParameter,
+            ConstrainedParameter,
+            WindowParameter,
         }
 
     async def _build_default_state(self) -> State:
@@ -58,6 +91,8 @@ class GeneratorBase(Configurable[State], ABC):
             contexts=params.contexts,
             regex=re.compile(params.regex),
             max_length=params.max_length,
+            constrained=params.constrained,
+            window=params.window,
         )
 
     async def _save_state(self, state: State, directory: Path) -> None:
@@ -65,6 +100,8 @@ class GeneratorBase(Configurable[State], ABC):
             "contexts": state.contexts,
             "regex": state.regex.pattern,
             "max_length": state.max_length,
+            "constrained": state.constrained,
+            "window": state.window,
         }
         await self._save_state_dict(state_dict, directory)
 
@@ -75,211 +112,622 @@ class GeneratorBase(Configurable[State], ABC):
             contexts=state_dict.get("contexts", params.contexts),
             regex=re.compile(state_dict.get("regex", params.regex)),
             max_length=state_dict.get("max_length", params.max_length),
+            constrained=state_dict.get("constrained", params.constrained),
+            window=state_dict.get("window", params.window),
         )
 
 
 class Generator(GeneratorBase):
     @staticmethod
-    def _sample_contexts(
-        contexts: List[str], tokenizer: Tokenizer, n: int
-    ) -> Iterable[List[int]]:
-        contexts = random.choices(contexts or [""], k=n)
+    def _build_context_index(
+        contexts: List[str], tokenizer: Tokenizer
+    ) -> ContextIndex:
+        contexts = [
+            torch.tensor(tokenizer.encode(context)[:-1], dtype=torch.long)
+            for context in contexts or [""]
+        ]
+        if any(len(context) == 0 for context in contexts):
+            raise ValueError("Every context must encode to at least one token")
+        sequences, lengths = pad(contexts)
+        return ContextIndex(
+            sequences=sequences,
+            lengths=torch.tensor(lengths, dtype=torch.long),
+        )
 
-        for context in contexts:
-            encoded = tokenizer.encode(context)
-            yield encoded[:-1]
+    async def _get_context_index(
+        self, state: State, tokenizer: Tokenizer
+    ) -> ContextIndex:
+        if tokenizer not in state.context_indices:
+            state.context_indices[tokenizer] = await background(
+                self._build_context_index, state.contexts, tokenizer
+            )
+        return state.context_indices[tokenizer]
+
+    @staticmethod
+    def _sample_contexts(index: ContextIndex, n: int) -> Tuple[Tensor, Tensor]:
+        indices = torch.randint(len(index.lengths), (n,))
+        lengths = index.lengths[indices]
+        return index.sequences[indices, : lengths.max()], lengths
 
     @staticmethod
     def _build_initial_generation_state(
-        contexts: Iterable[Iterable[int]],
+        index: ContextIndex,
+        slots: int,
+        max_length: int,
+        needed: int,
+        regex: Optional[Pattern[str]] = None,
+        automata: Optional[Dict] = None,
+        logprobs: bool = False,
     ) -> GenerationState:
-        contexts = [list(context) for context in contexts]
-        min_length = len(min(contexts, key=len))
-        current, waiting = [], []
-
-        for context in contexts:
-            sequence = SequenceState(context=context, response=[])
-            if len(context) == min_length:
-                current.append(sequence)
-            else:
-                waiting.append(sequence)
+        width = max(max_length + 1, index.sequences.shape[1])
 
         return GenerationState(
-            waiting_sequences=waiting,
-            current_sequences=current,
-            finished_sequences=[],
-            current_max_length=min_length,
+            sequences=torch.zeros(slots, width, dtype=torch.long),
+            context_lengths=torch.zeros(slots, dtype=torch.long),
+            lengths=torch.zeros(slots, dtype=torch.long),
+            active=torch.zeros(slots, dtype=torch.bool),
+            index=index,
+            needed=needed,
+            regex=regex,
+            automata=automata,
+            logprobs=torch.zeros(slots, width) if logprobs else None,
+            finished=asyncio.Queue(maxsize=slots),
         )
 
-    @staticmethod
-    def _should_stop(state: GenerationState, max_length: int) -> bool:
-        return (
-            len(state.current_sequences) <= 0
-            or state.current_max_length >= max_length + 1
+    def _admit(self, state: GenerationState, max_length: int) -> Tensor:
+        free = (~state.active).nonzero().flatten()
+        n = min(len(free), state.needed - int(state.active.sum()))
+        if n <= 0:
+            return free[:0]
+
+        rows = free[:n]
+        contexts, lengths = self._sample_contexts(state.index, n)
+        state.sequences[rows] = 0
+        state.sequences[rows, : contexts.shape[1]] = contexts
+        state.context_lengths[rows] = lengths
+        state.lengths[rows] = lengths
+        state.active[rows] = lengths < max_length + 1
+        if state.automaton_states is not None:
+            state.automaton_states[rows] = state.automaton.run(
+                contexts, lengths
+            )
+        return rows
+
+    async def _finish(
+        self,
+        model: ModelInfo[SequentialModel],
+        state: GenerationState,
+        rows: Tensor,
+    ) -> None:
+        if len(rows) == 0:
+            return
+
+        sequences = await background(
+            self._complete,
+            state.sequences[rows].tolist(),
+            state.context_lengths[rows].tolist(),
+            state.lengths[rows].tolist(),
+            model.tokenizer,
+            state.regex,
         )
+        for row, sequence in zip(rows.tolist(), sequences):
+            if sequence is not None and state.needed > 0:
+                state.needed -= 1
+                if state.logprobs is not None:
+                    context, response = sequence
+                    start, end = len(context), len(context) + len(response)
+                    logprobs = state.logprobs[row, start:end].clone()
+                    sequence = (context, response, logprobs)
+                await state.finished.put(sequence)
+
+    async def _refill(
+        self,
+        model: ModelInfo[SequentialModel],
+        state: GenerationState,
+        max_length: int,
+    ) -> Tensor:
+        rows = self._admit(state, max_length)
+        await self._finish(model, state, rows[~state.active[rows]])
+        return rows[state.active[rows]]
 
     @staticmethod
+    def _pack_rows(state: GenerationState, rows: Tensor) -> PackedSequence:
+        lengths = state.lengths[rows]
+        sequences = state.sequences[rows, : lengths.max()]
+        return pack_padded(sequences.unsqueeze(-1), lengths)
+
     async def _predict(
+        self,
         model: ModelInfo[SequentialModel],
-        current_sequences: List[SequenceState],
+        state: GenerationState,
+        rows: Tensor,
     ) -> Tensor:
-        sequences = [
-            torch.tensor(sequence.context + sequence.response).view(-1, 1)
-            for sequence in current_sequences
-        ]
-        async with model.lock:
-            with freeze(model.model) as frozen_model:
-                predictions = await batched_forward(
-                    frozen_model, pack_list(sequences), model.batch_size
-                )
+        x = self._pack_rows(state, rows)
+        if model.batcher is not None:
+            predictions = await model.batcher.forward(model, x)
+        else:
+            async with model.lock:
+                with freeze(model.model) as frozen_model:
+                    predictions = await model_forward(model, x, frozen_model)
         predictions, _ = unpack_to_padded(predictions)
-        return predictions[:, -1]
-
-    @staticmethod
-    async def _pick(batched_logprobs: Tensor) -> List[int]:
-        dist = Categorical(logits=batched_logprobs, validate_args=False)
-        samples = dist.sample((1,))
-        return samples.permute(1, 0).flatten().tolist()
+        return predictions[torch.arange(len(rows)), state.lengths[rows] - 1]
 
     @staticmethod
-    def _get_finished_mask(
-        next_values: List[int], end_value: int
-    ) -> List[bool]:
-        return [value == end_value for value in next_values]
+    async def _get_automaton(
+        tokenizer: Tokenizer,
+        regex: Pattern[str],
+        automata: Dict,
+        size: int,
+    ) -> Optional[TokenAutomaton]:
+        key = (tokenizer, size)
+        if key not in automata:
+            try:
+                automata[key] = await background(
+                    TokenAutomaton.build, regex, tokenizer, size
+                )
+            except ValueError:
+                automata[key] = None
+        return automata[key]
 
-    def _update_generation_state(
+    async def _constrain(
         self,
+        model: ModelInfo[SequentialModel],
         state: GenerationState,
-        next_values: List[int],
-        tokenizer: Tokenizer,
-    ) -> GenerationState:
-        sequences = [
-            SequenceState(
-                context=current.context,
-                response=current.response + [next],
-            )
-            for current, next in zip(state.current_sequences, next_values)
-        ]
+        rows: Tensor,
+        logprobs: Tensor,
+        max_length: int,
+    ) -> Tensor:
+        if state.automata is None:
+            return logprobs
 
-        finished_mask = self._get_finished_mask(
-            next_values, tokenizer.end_token
-        )
+        if state.automaton is None:
+            state.automaton = await self._get_automaton(
+                model.tokenizer,
+                state.regex,
+                state.automata,
+                logprobs.shape[-1],
+            )
+            if state.automaton is None:
+                state.automata = None
+                return logprobs
+            state.automaton_states = state.automaton.run(
+                state.sequences, state.lengths
+            )
 
-        state.finished_sequences.extend(
-            [
-                sequence
-                for sequence, finished in zip(sequences, finished_mask)
-                if finished
-            ]
+        mask = state.automaton.mask(
+            state.automaton_states[rows], max_length + 1 - state.lengths[rows]
         )
+        return logprobs.masked_fill(~mask, -torch.inf)
 
-        new_current_sequences = [
-            sequence
-            for sequence, finished in zip(sequences, finished_mask)
-            if not finished
-        ]
-        new_current_max_length = state.current_max_length + 1
-        new_waiting_sequences = []
-
-        for sequence in state.waiting_sequences:
-            if (
-                len(sequence.context + sequence.response)
-                == new_current_max_length
-            ):
-                new_current_sequences.append(sequence)
-            else:
-                new_waiting_sequences.append(sequence)
+    @staticmethod
+    async def _pick(batched_logprobs: Tensor) -> Tensor:
+        dist = Categorical(logits=batched_logprobs, validate_args=False)
+        return dist.sample()
 
-        state.current_sequences = new_current_sequences
-        state.waiting_sequences = new_waiting_sequences
-        state.current_max_length = new_current_max_length
+    @staticmethod
+    def _record_logprobs(
+        state: GenerationState,
+        rows: Tensor,
+        logprobs: Tensor,
+        next_values: Tensor,
+    ) -> None:
+        if state.logprobs is None:
+            return
+        state.logprobs[rows, state.lengths[rows]] = logprobs.gather(
+            -1, next_values.unsqueeze(-1)
+        ).squeeze(-1)
 
+    @staticmethod
+    def _update_generation_state(
+        state: GenerationState,
+        rows: Tensor,
+        next_values: Tensor,
+        end_token: int,
+        max_length: int,
+    ) -> GenerationState:
+        lengths = state.lengths[rows]
+        if state.automaton_states is not None:
+            state.automaton_states[rows] = state.automaton.advance(
+                state.automaton_states[rows], next_values
+            )
+        state.sequences[rows, lengths] = next_values
+        state.lengths[rows] = lengths + 1
+        state.active[rows] = (next_values != end_token) & (
+            lengths + 1 < max_length + 1
+        )
         return state
 
     @staticmethod
+    def _get_offsets(
+        indices: List[int], tokenizer: Tokenizer, text: str
+    ) -> Optional[List[int]]:
+        pieces = tokenizer.decode_pieces(indices)
+        if "".join(pieces) != text:
+            return None
+        offsets = [0]
+        for piece in pieces:
+            offsets.append(offsets[-1] + len(piece))
+        return offsets
+
     def _trim_until_valid(
-        sequence: SequenceState,
+        self,
+        context: List[int],
+        response: List[int],
         tokenizer: Tokenizer,
         regex: Pattern[str],
-    ) -> SequenceState:
-        for i in range(len(sequence.response) - 1, -1, -1):
-            index = slice(0, i + 1)
-            sentence = tokenizer.decode(
-                sequence.context + sequence.response[index]
-            )
-            if regex.fullmatch(sentence):
-                return SequenceState(
-                    context=sequence.context,
-                    response=sequence.response[index],
-                )
+    ) -> List[int]:
+        text = tokenizer.decode(context + response)
+        offsets = self._get_offsets(context + response, tokenizer, text)
+        checked = set()
+
+        for i in range(len(response), 0, -1):
+            if offsets is None:
+                sentence = tokenizer.decode(context + response[:i])
+                match = regex.fullmatch(sentence)
+            else:
+                end = offsets[len(context) + i]
+                if end in checked:
+                    continue
+                checked.add(end)
+                match = regex.fullmatch(text, 0, end)
+            if match:
+                return response[:i]
 
         raise ValueError("No valid sentence found")
 
     def _complete(
         self,
-        state: GenerationState,
+        sequences: List[List[int]],
+        context_lengths: List[int],
+        lengths: List[int],
         tokenizer: Tokenizer,
         regex: Pattern[str],
-    ) -> List[Optional[SequenceState]]:
-        in_sequences = state.finished_sequences + state.current_sequences
-        out_sequences = []
+    ) -> List[Optional[Tuple[List[int], List[int]]]]:
+        out = []
 
-        for sequence in in_sequences:
+        for sequence, context_length, length in zip(
+            sequences, context_lengths, lengths
+        ):
+            context = sequence[:context_length]
+            response = sequence[context_length:length]
             try:
-                sequence = self._trim_until_valid(sequence, tokenizer, regex)
+                response = self._trim_until_valid(
+                    context, response, tokenizer, regex
+                )
             except ValueError:
-                sequence = None
-            out_sequences.append(sequence)
-        return out_sequences
+                out.append(None)
+                continue
+            out.append((context, response))
 
-    @staticmethod
-    def _prepare_output(
-        sequences: List[Optional[SequenceState]],
-    ) -> List[Optional[Tuple[List[int], List[int]]]]:
-        return [
-            (sequence.context, sequence.response)
-            if sequence is not None
-            else None
-            for sequence in sequences
-        ]
+        return out
 
-    async def _generate(
+    async def _generate_full(
         self,
         model: ModelInfo[SequentialModel],
-        contexts: Iterable[Iterable[int]],
+        state: GenerationState,
         max_length: int,
-        regex: Pattern[str],
-    ) -> List[Optional[Tuple[List[int], List[int]]]]:
-        state = self._build_initial_generation_state(contexts)
-        while not self._should_stop(state, max_length):
-            logprobs = await self._predict(model, state.current_sequences)
-            next_values = await self._pick(logprobs)
-            state = self._update_generation_state(
-                state, next_values, model.tokenizer
+    ) -> None:
+        while state.needed > 0:
+            await self._refill(model, state, max_length)
+            rows = state.active.nonzero().flatten()
+            if len(rows) == 0:
+                continue
+
+            logprobs = await self._predict(model, state, rows)
+            constrained = await self._constrain(
+                model, state, rows, logprobs, max_length
             )
-        sequences = self._complete(state, model.tokenizer, regex)
-        return self._prepare_output(sequences)
+            next_values = await self._pick(constrained)
+            self._record_logprobs(state, rows, logprobs, next_values)
+            self._update_generation_state(
+                state,
+                rows,
+                next_values,
+                model.tokenizer.end_token,
+                max_length,
+            )
+            await self._finish(model, state, rows[~state.active[rows]])
 
-    async def generate(
+    @staticmethod
+    async def _predict_stepwise(
+        model: ModelInfo[StepwiseSequentialModel],
+        x: PackedSequence,
+        model_state: Optional[Any] = None,
+    ) -> Tuple[Tensor, Any]:
+        if model.batcher is not None:
+            return await model.batcher.forward_last(model, x, model_state)
+        async with model.lock:
+            with freeze(model.model) as frozen_model:
+                return await background(
+                    frozen_model.forward_last, x, model_state
+                )
+
+    @staticmethod
+    def _insert_prefix(
+        root: PrefixNode, context: List[int], index: int
+    ) -> None:
+        node, i = root, 0
+
+        while i < len(context):
+            child = node.children.get(context[i])
+            if child is None:
+                node.children[context[i]] = PrefixNode(
+                    tokens=context[i:], contexts=[index]
+                )
+                return
+
+            common = 0
+            for a, b in zip(child.tokens, context[i:]):
+                if a != b:
+                    break
+                common += 1
+
+            if common < len(child.tokens):
+                split = PrefixNode(
+                    tokens=child.tokens[:common],
+                    children={child.tokens[common]: child},
+                )
+                child.tokens = child.tokens[common:]
+                node.children[context[i]] = split
+                child = split
+
+            node, i = child, i + common
+
+        node.contexts.append(index)
+
+    def _build_prefix_tree(self, contexts: List[List[int]]) -> PrefixNode:
+        root = PrefixNode(tokens=[])
+        for index, context in enumerate(contexts):
+            self._insert_prefix(root, context, index)
+        return root
+
+    async def _predict_prefixes(
         self,
-        model: ModelInfo[SequentialModel],
-        n: int,
-    ) -> List[Tuple[List[int], List[int]]]:
-        out = []
+        model: ModelInfo[StepwiseSequentialModel],
+        nodes: List[PrefixNode],
+        parents: Optional[Tensor],
+        parent_state: Optional[Any],
+    ) -> Tuple[Tensor, Any]:
+        logprobs, states = [], []
+
+        ranges = get_batch_ranges(
+            (len(node.tokens) for node in nodes),
+            model.batch_size,
+            model.max_tokens,
+        )
 
-        while len(out) < n:
-            async with self.state.read_lock() as state:
-                contexts = self._sample_contexts(
-                    state.contexts, model.tokenizer, n - len(out)
+        for start, end in ranges:
+            chunk = torch.arange(start, end)
+            x = pack_list(
+                torch.tensor(nodes[i].tokens).view(-1, 1) for i in chunk
+            )
+            chunk_state = None
+            if parent_state is not None:
+                chunk_state = model.model.select_state(
+                    parent_state, parents[chunk]
                 )
-            sequences = await self._generate(
+            chunk_logprobs, chunk_state = await self._predict_stepwise(
+                model, x, chunk_state
+            )
+            logprobs.append(chunk_logprobs)
+            states.append(chunk_state)
+
+        return torch.cat(logprobs), model.model.concatenate_states(states)
+
+    async def _prefill_stepwise(
+        self,
+        model: ModelInfo[StepwiseSequentialModel],
+        state: GenerationState,
+        rows: Tensor,
+    ) -> Tuple[Tensor, Any]:
+        lengths = state.context_lengths[rows]
+        keys = torch.cat(
+            [lengths.unsqueeze(-1), state.sequences[rows, : lengths.max()]],
+            dim=-1,
+        )
+        keys, inverse = keys.unique(dim=0, return_inverse=True)
+        contexts = [key[1 : key[0] + 1] for key in keys.tolist()]
+
+        level = list(self._build_prefix_tree(contexts).children.values())
+        parents, parent_state = None, None
+        outputs, output_logprobs, output_states = [], [], []
+
+        while level:
+            logprobs, level_state = await self._predict_prefixes(
+                model, level, parents, parent_state
+            )
+            ends = [
+                (position, index)
+                for position, node in enumerate(level)
+                for index in node.contexts
+            ]
+            if ends:
+                positions = torch.tensor([position for position, _ in ends])
+                outputs.extend(index for _, index in ends)
+                output_logprobs.append(logprobs[positions])
+                output_states.append(
+                    model.model.select_state(level_state, positions)
+                )
+
+            children = [
+                (position, child)
+                for position, node in enumerate(level)
+                for child in node.children.values()
+            ]
+            parents = torch.tensor([position for position, _ in children])
+            level = [child for _, child in children]
+            parent_state = level_state
+
+        order = torch.empty(len(outputs), dtype=torch.long)
+        order[torch.tensor(outputs)] = torch.arange(len(outputs))
+        positions = order[inverse]
+
+        logprobs = torch.cat(output_logprobs)[positions]
+        model_state = model.model.select_state(
+            model.model.concatenate_states(output_states), positions
+        )
+        return logprobs, model_state
+
+    async def _step_stepwise(
+        self,
+        model: ModelInfo[StepwiseSequentialModel],
+        tokens: Tensor,
+        model_state: Any,
+    ) -> Tuple[Tensor, Any]:
+        if len(tokens) <= model.batch_size:
+            x = pack_padded(tokens.view(-1, 1, 1))
+            return await self._predict_stepwise(model, x, model_state)
+
+        logprobs, states = [], []
+
+        for chunk in torch.arange(len(tokens)).split(model.batch_size):
+            chunk_logprobs, chunk_state = await self._predict_stepwise(
                 model,
-                contexts,
+                pack_padded(tokens[chunk].view(-1, 1, 1)),
+                model.model.select_state(model_state, chunk),
+            )
+            logprobs.append(chunk_logprobs)
+            states.append(chunk_state)
+
+        return torch.cat(logprobs), model.model.concatenate_states(states)
+
+    async def _generate_stepwise(
+        self,
+        model: ModelInfo[StepwiseSequentialModel],
+        state: GenerationState,
+        max_length: int,
+    ) -> None:
+        rows = torch.empty(0, dtype=torch.long)
+        logprobs, model_state = None, None
+
+        while state.needed > 0:
+            new_rows = await self._refill(model, state, max_length)
+            if len(new_rows) > 0:
+                new_logprobs, new_state = await self._prefill_stepwise(
+                    model, state, new_rows
+                )
+                if len(rows) > 0:
+                    rows = torch.cat([rows, new_rows])
+                    logprobs = torch.cat([logprobs, new_logprobs])
+                    order = rows.argsort()
+                    rows, logprobs = rows[order], logprobs[order]
+                    model_state = model.model.select_state(
+                        model.model.concatenate_states(
+                            [model_state, new_state]
+                        ),
+                        order,
+                    )
+                else:
+                    rows, logprobs = new_rows, new_logprobs
+                    model_state = new_state
+
+            if len(rows) == 0:
+                continue
+
+            constrained = await self._constrain(
+                model, state, rows, logprobs, max_length
+            )
+            next_values = await self._pick(constrained)
+            self._record_logprobs(state, rows, logprobs, next_values)
+            self._update_generation_state(
+                state,
+                rows,
+                next_values,
+                model.tokenizer.end_token,
+                max_length,
+            )
+            await self._finish(model, state, rows[~state.active[rows]])
+
+            indices = state.active[rows].nonzero().flatten()
+            rows = rows[indices]
+            if len(rows) == 0:
+                continue
+
+            model_state = model.model.select_state(model_state, indices)
+            logprobs, model_state = await self._step_stepwise(
+                model, next_values[indices], model_state
+            )
+
+    async def _decode(
+        self,
+        model: ModelInfo[SequentialModel],
+        state: GenerationState,
+        max_length: int,
+    ) -> None:
+        try:
+            if isinstance(model.model, StepwiseSequentialModel):
+                await self._generate_stepwise(model, state, max_length)
+            else:
+                await self._generate_full(model, state, max_length)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await state.finished.put(None)
+            raise
+        await state.finished.put(None)
+
+    async def _generate(
+        self,
+        model: ModelInfo[SequentialModel],
+        state: GenerationState,
+        max_length: int,
+    ) -> AsyncIterator[Tuple]:
+        task = asyncio.create_task(self._decode(model, state, max_length))
+
+        try:
+            while (sequence := await state.finished.get()) is not None:
+                yield sequence
+            await task
+        finally:
+            task.cancel()
+
+    async def _generate_stream(
+        self,
+        model: ModelInfo[SequentialModel],
+        n: int,
+        logprobs: bool = False,
+    ) -> AsyncIterator[Tuple]:
+        async with self.state.read_lock() as state:
+            index = await self._get_context_index(state, model.tokenizer)
+            generation_state = self._build_initial_generation_state(
+                index,
+                min(state.window, n),
                 state.max_length,
+                n,
                 state.regex,
+                state.automata if state.constrained else None,
+                logprobs,
             )
-            out.extend(
-                sequence for sequence in sequences if sequence is not None
-            )
+            max_length = state.max_length
 
-        return out
+        async with aclosing(
+            self._generate(model, generation_state, max_length)
+        ) as sequences:
+            async for sequence in sequences:
+                yield sequence
+
+    async def generate_stream(
+        self,
+        model: ModelInfo[SequentialModel],
+        n: int,
+    ) -> AsyncIterator[Tuple[List[int], List[int]]]:
+        async with aclosing(self._generate_stream(model, n)) as sequences:
+            async for sequence in sequences:
+                yield sequence
+
+    async def generate(
+        self,
+        model: ModelInfo[SequentialModel],
+        n: int,
+    ) -> List[Tuple[List[int], List[int]]]:
+        return [sequence async for sequence in self.generate_stream(model, n)]
+
+    async def generate_with_logprobs(
+        self,
+        model: ModelInfo[SequentialModel],
+        n: int,
+    ) -> List[Tuple[List[int], List[int], Tensor]]:
+        async with aclosing(
+            self._generate_stream(model, n, logprobs=True)
+        ) as sequences:
+            return [sequence async for sequence in sequences]
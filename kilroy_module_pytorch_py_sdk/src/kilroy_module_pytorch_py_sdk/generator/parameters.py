@@ -6,6 +6,21 @@ from kilroy_server_py_utils import Parameter, classproperty
 
 
 class ContextsParameter(Parameter[State, List[str]]):
+    @classmethod
+    async def _set(
+        cls, state: State, value: List[str]
+    ) -> Callable[[], Awaitable]:
+        original_value = state.contexts
+        original_indices = state.context_indices
+
+        async def undo():
+            state.contexts = original_value
+            state.context_indices = original_indices
+
+        state.contexts = value
+        state.context_indices = {}
+        return undo
+
     # noinspection PyMethodParameters
     @classproperty
     def schema(cls) -> Dict[str, Any]:
@@ -25,11 +40,14 @@ class RegexParameter(Parameter[State, str]):
     @classmethod
     async def _set(cls, state: State, value: str) -> Callable[[], Awaitable]:
         original_value = state.regex
+        original_automata = state.automata
 
         async def undo():
             state.regex = original_value
+            state.automata = original_automata
 
         state.regex = re.compile(value)
+        state.automata = {}
         return undo
 
     # noinspection PyMethodParameters
@@ -62,3 +80,36 @@ class MaxLengthParameter(Parameter[State, int]):
     @classproperty
     def pretty_name(cls) -> str:
         return "Maximum Length"
+
+
+class ConstrainedParameter(Parameter[State, bool]):
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": "boolean",
+            "title": cls.pretty_name,
+            "default": False,
+        }
+
+    # noinspection PyMethodParameters
+    @classproperty
+    def pretty_name(cls) -> str:
+        return "Constrained Decoding"
+
+
+class WindowParameter(Parameter[State, int]):
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": "integer",
+            "minimum": 1,
+            "title": cls.pretty_name,
+            "default": 256,
+        }
+
+    # noinspection PyMethodParameters
+    @classproperty
+    def pretty_name(cls) -> str:
+        return "Generation Window"
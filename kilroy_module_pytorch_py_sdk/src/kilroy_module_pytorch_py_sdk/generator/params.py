@@ -7,3 +7,5 @@ class Params(SerializableModel):
     contexts: List[str] = []
     regex: str = r"^(^(?!.*\s+[a-zA-Z0-9_']*$).+$)|(^(?!.*[\.\?!]+).+$)$"
     max_length: int = 16
+    constrained: bool = False
+    window: int = 256
@@ -1,5 +1,16 @@
-from dataclasses import dataclass
-from typing import List, Pattern
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from torch import Tensor
+
+from kilroy_module_pytorch_py_sdk.generator.automaton import TokenAutomaton
+from kilroy_module_pytorch_py_sdk.tokenizer import Tokenizer
+
+
+@dataclass
+class ContextIndex:
+    sequences: Tensor
+    lengths: Tensor
 
 
 @dataclass
@@ -7,3 +18,11 @@ class State:
     contexts: List[str]
     regex: Pattern[str]
     max_length: int
+    constrained: bool
+    window: int
+    context_indices: Dict[Tokenizer, ContextIndex] = field(
+        default_factory=dict
+    )
+    automata: Dict[Tuple[Tokenizer, int], Optional[TokenAutomaton]] = field(
+        default_factory=dict
+    )
@@ -75,3 +75,75 @@ class ScoreMetric(LineMetric):
             y_axis_label,
             tags,
         )
+
+
+class StalenessMetric(LineMetric):
+    def __init__(
+        self,
+        observable: Observable[Tuple[int, Dict[str, Any]]],
+        name: str,
+        label: str,
+        x_axis_key: str,
+        x_axis_label: str,
+        y_axis_key: str = "staleness",
+        y_axis_label: str = "Staleness",
+        tags: Optional[List[str]] = None,
+    ) -> None:
+        super().__init__(
+            observable,
+            name,
+            label,
+            x_axis_key,
+            x_axis_label,
+            y_axis_key,
+            y_axis_label,
+            tags,
+        )
+
+
+class LatencyMetric(LineMetric):
+    def __init__(
+        self,
+        observable: Observable[Tuple[int, Dict[str, Any]]],
+        name: str,
+        label: str,
+        x_axis_key: str,
+        x_axis_label: str,
+        y_axis_key: str = "latency",
+        y_axis_label: str = "Latency (s)",
+        tags: Optional[List[str]] = None,
+    ) -> None:
+        super().__init__(
+            observable,
+            name,
+            label,
+            x_axis_key,
+            x_axis_label,
+            y_axis_key,
+            y_axis_label,
+            tags,
+        )
+
+
+class EfficiencyMetric(LineMetric):
+    def __init__(
+        self,
+        observable: Observable[Tuple[int, Dict[str, Any]]],
+        name: str,
+        label: str,
+        x_axis_key: str,
+        x_axis_label: str,
+        y_axis_key: str = "efficiency",
+        y_axis_label: str = "Efficiency",
+        tags: Optional[List[str]] = None,
+    ) -> None:
+        super().__init__(
+            observable,
+            name,
+            label,
+            x_axis_key,
+            x_axis_label,
+            y_axis_key,
+            y_axis_label,
+            tags,
+        )
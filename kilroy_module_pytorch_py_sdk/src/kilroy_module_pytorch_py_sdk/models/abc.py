@@ -1,10 +1,29 @@
 from abc import ABC, abstractmethod
+from typing import Generic, Iterable, Optional, Tuple, TypeVar
 
-from torch import nn
+from torch import Tensor, nn
 from torch.nn.utils.rnn import PackedSequence
 
+StateType = TypeVar("StateType")
+
 
 class SequentialModel(nn.Module, ABC):
     @abstractmethod
     def forward(self, x: PackedSequence) -> PackedSequence:
         pass
+
+
+class StepwiseSequentialModel(SequentialModel, Generic[StateType], ABC):
+    @abstractmethod
+    def forward_last(
+        self, x: PackedSequence, state: Optional[StateType] = None
+    ) -> Tuple[Tensor, StateType]:
+        pass
+
+    @abstractmethod
+    def select_state(self, state: StateType, indices: Tensor) -> StateType:
+        pass
+
+    @abstractmethod
+    def concatenate_states(self, states: Iterable[StateType]) -> StateType:
+        pass
@@ -0,0 +1,210 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+
+import torch
+from kilroy_module_server_py_sdk import StandardMetric
+from kilroy_server_py_utils.utils import background
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence
+
+from kilroy_module_pytorch_py_sdk.models.abc import (
+    SequentialModel,
+    StepwiseSequentialModel,
+)
+from kilroy_module_pytorch_py_sdk.utils import (
+    get_batch_ranges,
+    model_forward,
+    freeze,
+    pack_list,
+    select_packed,
+    unpack_to_list,
+)
+
+if TYPE_CHECKING:
+    from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+
+
+@dataclass
+class ForwardRequest:
+    sequences: List[Tensor]
+    state: Optional[Any]
+    future: asyncio.Future
+    start: float
+
+
+class ForwardBatcher:
+    def __init__(
+        self,
+        max_wait: float = 0.005,
+        max_batch_size: int = 256,
+        latency_metric: Optional[StandardMetric] = None,
+    ) -> None:
+        self._max_wait = max_wait
+        self._max_batch_size = max_batch_size
+        self._latency_metric = latency_metric
+        self._queues: Dict[Tuple[str, bool], List[ForwardRequest]] = {}
+        self._timers: Dict[Tuple[str, bool], asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._flushes = 0
+
+    @property
+    def latency_metric(self) -> Optional[StandardMetric]:
+        return self._latency_metric
+
+    @latency_metric.setter
+    def latency_metric(self, metric: Optional[StandardMetric]) -> None:
+        self._latency_metric = metric
+
+    async def forward(
+        self, model: "ModelInfo[SequentialModel]", x: PackedSequence
+    ) -> PackedSequence:
+        return await self._submit(model, ("forward", False), x, None)
+
+    async def forward_last(
+        self,
+        model: "ModelInfo[StepwiseSequentialModel]",
+        x: PackedSequence,
+        state: Optional[Any] = None,
+    ) -> Tuple[Tensor, Any]:
+        key = ("forward_last", state is not None)
+        return await self._submit(model, key, x, state)
+
+    async def _submit(
+        self,
+        model: "ModelInfo",
+        key: Tuple[str, bool],
+        x: PackedSequence,
+        state: Optional[Any],
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        request = ForwardRequest(
+            sequences=unpack_to_list(x),
+            state=state,
+            future=loop.create_future(),
+            start=time.perf_counter(),
+        )
+        queue = self._queues.setdefault(key, [])
+        queue.append(request)
+
+        if sum(len(r.sequences) for r in queue) >= self._max_batch_size:
+            self._flush(model, key)
+        elif len(queue) == 1:
+            self._timers[key] = loop.call_later(
+                self._max_wait, self._flush, model, key
+            )
+
+        return await request.future
+
+    async def _report(self, requests: List[ForwardRequest]) -> None:
+        self._flushes += 1
+        if self._latency_metric is not None:
+            end = time.perf_counter()
+            latency = sum(end - r.start for r in requests) / len(requests)
+            await self._latency_metric.report(self._flushes - 1, latency)
+
+    def _flush(self, model: "ModelInfo", key: Tuple[str, bool]) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        requests = self._queues.pop(key, [])
+        if not requests:
+            return
+
+        task = asyncio.create_task(self._run(model, key, requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(
+        self,
+        model: "ModelInfo",
+        key: Tuple[str, bool],
+        requests: List[ForwardRequest],
+    ) -> None:
+        try:
+            if key[0] == "forward":
+                results = await self._run_forward(model, requests)
+            else:
+                results = await self._run_forward_last(model, requests)
+        except Exception as e:
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        for request, result in zip(requests, results):
+            if not request.future.done():
+                request.future.set_result(result)
+
+        await self._report(requests)
+
+    @staticmethod
+    def _get_offsets(requests: List[ForwardRequest]) -> List[int]:
+        offsets = [0]
+        for request in requests:
+            offsets.append(offsets[-1] + len(request.sequences))
+        return offsets
+
+    async def _run_forward(
+        self,
+        model: "ModelInfo[SequentialModel]",
+        requests: List[ForwardRequest],
+    ) -> List[PackedSequence]:
+        x = pack_list(s for r in requests for s in r.sequences)
+
+        async with model.lock:
+            with freeze(model.model) as frozen_model:
+                y = await model_forward(model, x, frozen_model)
+
+        offsets = self._get_offsets(requests)
+        return [
+            select_packed(y, torch.arange(start, end))[1]
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    async def _run_forward_last(
+        self,
+        model: "ModelInfo[StepwiseSequentialModel]",
+        requests: List[ForwardRequest],
+    ) -> List[Tuple[Tensor, Any]]:
+        sequences = [s for r in requests for s in r.sequences]
+        state = None
+        if requests[0].state is not None:
+            state = model.model.concatenate_states([r.state for r in requests])
+
+        ranges = get_batch_ranges(
+            (len(s) for s in sequences), model.batch_size, model.max_tokens
+        )
+        logprobs, states = [], []
+
+        async with model.lock:
+            with freeze(model.model) as frozen_model:
+                for start, end in ranges:
+                    chunk_state = state
+                    if state is not None and len(ranges) > 1:
+                        chunk_state = model.model.select_state(
+                            state, torch.arange(start, end)
+                        )
+                    chunk_logprobs, chunk_state = await background(
+                        frozen_model.forward_last,
+                        pack_list(sequences[start:end]),
+                        chunk_state,
+                    )
+                    logprobs.append(chunk_logprobs)
+                    states.append(chunk_state)
+
+        logprobs = torch.cat(logprobs)
+        state = states[0]
+        if len(states) > 1:
+            state = model.model.concatenate_states(states)
+
+        offsets = self._get_offsets(requests)
+        return [
+            (
+                logprobs[start:end],
+                model.model.select_state(state, torch.arange(start, end)),
+            )
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
@@ -0,0 +1,67 @@
+from typing import TYPE_CHECKING, Dict, Tuple
+
+import torch
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence
+
+from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
+from kilroy_module_pytorch_py_sdk.utils import frozen_forward
+
+if TYPE_CHECKING:
+    from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+
+
+class ForwardCache:
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._size = 0
+        self._outputs: Dict[Tuple[int, ...], Tensor] = {}
+
+    def __len__(self) -> int:
+        return len(self._outputs)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    def _store(self, key: Tuple[int, ...], output: Tensor) -> None:
+        # Entries are never evicted: epochs replay the data in order,
+        # so keeping the first ones hits every epoch, while LRU would not.
+        if self._size + output.numel() > self._max_size:
+            return
+        self._outputs[key] = output.clone()
+        self._size += output.numel()
+
+    async def forward(
+        self, model: "ModelInfo[SequentialModel]", x: PackedSequence
+    ) -> PackedSequence:
+        sequences = RaggedBatch.from_packed(x)
+        keys = [tuple(s.flatten().tolist()) for s in sequences.to_list()]
+        outputs = {
+            key: self._outputs[key] for key in keys if key in self._outputs
+        }
+        missing = list(
+            {
+                key: index
+                for index, key in enumerate(keys)
+                if key not in outputs
+            }.values()
+        )
+
+        if missing:
+            computed = await frozen_forward(
+                model, sequences[torch.tensor(missing)].to_packed()
+            )
+            computed = RaggedBatch.from_packed(computed).to_list()
+            for index, output in zip(missing, computed):
+                outputs[keys[index]] = output
+                self._store(keys[index], output)
+
+        return RaggedBatch.from_list(
+            outputs[key] for key in keys
+        ).to_packed_like(x)
@@ -1,9 +1,18 @@
 from abc import ABC, abstractmethod
 from asyncio import Lock
-from dataclasses import dataclass
-from typing import TypeVar, Generic, Optional, Type
-
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TypeVar, Generic, Optional, Type, Collection
+
+from kilroy_module_pytorch_py_sdk.metrics import (
+    EfficiencyMetric,
+    LatencyMetric,
+)
+from kilroy_module_pytorch_py_sdk.models.batcher import ForwardBatcher
 from kilroy_module_pytorch_py_sdk.tokenizer import Tokenizer
+from kilroy_module_pytorch_py_sdk.utils import PaddingStats
+from kilroy_module_server_py_sdk import Metric, StandardMetric
+from kilroy_server_py_utils.utils import background
 
 ModelType = TypeVar("ModelType")
 LoaderType = TypeVar("LoaderType", bound="Loader")
@@ -15,18 +24,33 @@ class ModelInfo(Generic[ModelType]):
     tokenizer: Tokenizer
     batch_size: int
     lock: Lock
+    batcher: Optional[ForwardBatcher] = None
+    max_tokens: Optional[int] = None
+    bucket: bool = False
+    workers: int = 1
+    executor: Optional[Executor] = None
+    padding: PaddingStats = field(default_factory=PaddingStats)
+    padding_metric: Optional[StandardMetric] = None
 
 
 class ModelLoader(Generic[ModelType], ABC):
     _info: Optional[ModelInfo[ModelType]]
     _references: int
     _lock: Lock
+    _latency_metric: Optional[LatencyMetric]
+    _padding_metric: Optional[EfficiencyMetric]
+    _executor: Optional[ThreadPoolExecutor]
+    _executor_workers: int
 
     def __init__(self, lock: Lock) -> None:
         super().__init__()
         self._info = None
         self._references = 0
         self._lock = lock
+        self._latency_metric = None
+        self._padding_metric = None
+        self._executor = None
+        self._executor_workers = 0
 
     @classmethod
     async def create(cls: Type[LoaderType], **kwargs) -> LoaderType:
@@ -44,10 +68,48 @@ class ModelLoader(Generic[ModelType], ABC):
     async def _reset(self) -> ModelInfo[ModelType]:
         pass
 
+    async def _get_latency_metric(self) -> LatencyMetric:
+        if self._latency_metric is None:
+            self._latency_metric = await LatencyMetric.create(
+                name="forwardBatcherLatency",
+                label="Forward Batcher Latency",
+                x_axis_key="flush",
+                x_axis_label="Flush",
+            )
+        return self._latency_metric
+
+    async def _get_padding_metric(self) -> EfficiencyMetric:
+        if self._padding_metric is None:
+            self._padding_metric = await EfficiencyMetric.create(
+                name="forwardPaddingEfficiency",
+                label="Forward Padding Efficiency",
+                x_axis_key="forward",
+                x_axis_label="Forward",
+            )
+        return self._padding_metric
+
+    def _register_metrics(self, info: ModelInfo[ModelType]) -> None:
+        if info.batcher is not None and info.batcher.latency_metric is None:
+            info.batcher.latency_metric = self._latency_metric
+        if info.padding_metric is None:
+            info.padding_metric = self._padding_metric
+
+    def _register_executor(self, info: ModelInfo[ModelType]) -> None:
+        if info.workers <= 1 or info.executor is not None:
+            return
+        if self._executor is None or self._executor_workers != info.workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=info.workers)
+            self._executor_workers = info.workers
+        info.executor = self._executor
+
     async def acquire(self) -> ModelInfo[ModelType]:
         async with self._lock:
             if self._info is None:
                 self._info = await self._load()
+                self._register_metrics(self._info)
+                self._register_executor(self._info)
             self._references += 1
             return self._info
 
@@ -76,6 +138,33 @@ class ModelLoader(Generic[ModelType], ABC):
             if self._info is not None:
                 await self._save(self._info)
             self._info = await self._reset()
+            self._register_metrics(self._info)
+            self._register_executor(self._info)
+
+    async def get_metrics(self) -> Collection[Metric]:
+        async with self._lock:
+            metrics = [
+                await self._get_latency_metric(),
+                await self._get_padding_metric(),
+            ]
+            if self._info is not None:
+                self._register_metrics(self._info)
+            return metrics
+
+    async def cleanup(self) -> None:
+        async with self._lock:
+            if self._latency_metric is not None:
+                await self._latency_metric.cleanup()
+                self._latency_metric = None
+            if self._padding_metric is not None:
+                await self._padding_metric.cleanup()
+                self._padding_metric = None
+            if self._executor is not None:
+                if self._info is not None:
+                    self._info.executor = None
+                await background(self._executor.shutdown)
+                self._executor = None
+                self._executor_workers = 0
 
     async def __aenter__(self) -> ModelInfo[ModelType]:
         return await self.acquire()
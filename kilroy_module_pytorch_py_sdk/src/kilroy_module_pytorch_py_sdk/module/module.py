@@ -1,6 +1,7 @@
 import json
 import logging
 from abc import ABC, abstractmethod
+from contextlib import aclosing
 from functools import partial
 from pathlib import Path
 from typing import AsyncIterable, Tuple, Collection, Set, Type, Dict, Any, List
@@ -22,6 +23,7 @@ from kilroy_module_pytorch_py_sdk.module.params import (
 )
 from kilroy_module_pytorch_py_sdk.module.state import State, TrainerState
 from kilroy_module_pytorch_py_sdk.trainers import Trainer
+from kilroy_module_pytorch_py_sdk.utils import report_padding
 from kilroy_module_server_py_sdk import Metric, Module
 from kilroy_server_py_utils import (
     classproperty,
@@ -172,6 +174,9 @@ class PytorchModuleBase(Module[State], ABC):
             if isinstance(state.trainer.trainer, Configurable):
                 await state.trainer.trainer.cleanup()
             await state.generator.cleanup()
+            await state.models.policy.cleanup()
+            await state.models.value.cleanup()
+            await state.models.baseline.cleanup()
 
 
 class PytorchModule(PytorchModuleBase, ABC):
@@ -212,7 +217,9 @@ class PytorchModule(PytorchModuleBase, ABC):
 
     async def get_metrics(self) -> Collection[Metric]:
         async with self.state.read_lock() as state:
-            return await state.trainer.trainer.get_metrics()
+            trainer_metrics = await state.trainer.trainer.get_metrics()
+            model_metrics = await state.models.policy.get_metrics()
+            return list(trainer_metrics) + list(model_metrics)
 
     async def _encode(
         self, context: List[int], response: List[int]
@@ -261,18 +268,22 @@ class PytorchModule(PytorchModuleBase, ABC):
             policy = await state.models.policy.get()
             generator = state.generator
 
-        results = await generator.generate(policy, n)
-
-        for context, response in results:
-            yield await self._encode(context, response)
+        async with report_padding(policy):
+            async with aclosing(
+                generator.generate_stream(policy, n)
+            ) as results:
+                async for context, response in results:
+                    yield await self._encode(context, response)
 
     async def _fit_supervised(
         self, data: AsyncIterable[Tuple[Tensor, Tensor, Tensor]]
     ) -> None:
         async with self.state.read_lock() as state:
             trainer = state.trainer.trainer
+            policy = await state.models.policy.get()
 
-        await trainer.fit_supervised(data)
+        async with report_padding(policy):
+            await trainer.fit_supervised(data)
 
     async def fit_supervised(
         self, data: AsyncIterable[Tuple[Dict[str, Any], float]]
@@ -300,8 +311,10 @@ class PytorchModule(PytorchModuleBase, ABC):
     ) -> None:
         async with self.state.read_lock() as state:
             trainer = state.trainer.trainer
+            policy = await state.models.policy.get()
 
-        await trainer.fit_reinforced(data)
+        async with report_padding(policy):
+            await trainer.fit_reinforced(data)
 
     async def fit_reinforced(
         self, data: AsyncIterable[Tuple[Dict[str, Any], Dict[str, Any], float]]
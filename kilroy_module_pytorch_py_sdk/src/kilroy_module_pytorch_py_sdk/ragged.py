@@ -0,0 +1,148 @@
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Sequence, Tuple, Union
+
+import torch
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence
+
+from kilroy_module_pytorch_py_sdk.utils import get_packed_lengths
+
+
+def _ranges(starts: Tensor, lengths: Tensor) -> Tensor:
+    offsets = lengths.cumsum(0) - lengths
+    return (
+        torch.arange(int(lengths.sum()))
+        - offsets.repeat_interleave(lengths)
+        + starts.repeat_interleave(lengths)
+    )
+
+
+def _get_packed_rows(x: PackedSequence) -> Tensor:
+    lengths = get_packed_lengths(x)
+    ranks = torch.arange(len(lengths))
+    if x.unsorted_indices is not None:
+        ranks = x.unsorted_indices.cpu()
+    offsets = x.batch_sizes.cumsum(0) - x.batch_sizes
+    rows = offsets[_ranges(torch.zeros_like(lengths), lengths)]
+    return rows + ranks.repeat_interleave(lengths)
+
+
+@dataclass
+class RaggedBatch:
+    data: Tensor
+    lengths: Tensor
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __getitem__(self, indices: Union[slice, Tensor]) -> "RaggedBatch":
+        indices = torch.arange(len(self))[indices]
+        lengths = self.lengths[indices]
+        rows = _ranges(self.offsets[indices], lengths)
+        return RaggedBatch(self.data[rows.to(self.data.device)], lengths)
+
+    @property
+    def offsets(self) -> Tensor:
+        return self.lengths.cumsum(0) - self.lengths
+
+    @property
+    def sequence_indices(self) -> Tensor:
+        return torch.arange(len(self)).repeat_interleave(self.lengths)
+
+    @property
+    def positions(self) -> Tensor:
+        return _ranges(torch.zeros_like(self.lengths), self.lengths)
+
+    @classmethod
+    def from_list(cls, sequences: Iterable[Tensor]) -> "RaggedBatch":
+        sequences = list(sequences)
+        lengths = torch.tensor([len(s) for s in sequences], dtype=torch.long)
+        if not sequences:
+            return cls(torch.empty(0), lengths)
+        return cls(torch.cat(sequences), lengths)
+
+    @classmethod
+    def join(cls, sequences: Iterable[Sequence[Tensor]]) -> "RaggedBatch":
+        sequences = list(sequences)
+        lengths = torch.tensor(
+            [sum(len(part) for part in parts) for parts in sequences],
+            dtype=torch.long,
+        )
+        if not sequences:
+            return cls(torch.empty(0), lengths)
+        return cls(
+            torch.cat([part for parts in sequences for part in parts]),
+            lengths,
+        )
+
+    @classmethod
+    def from_last(cls, lengths: Tensor, values: Tensor) -> "RaggedBatch":
+        data = values.new_zeros((int(lengths.sum()), *values.shape[1:]))
+        data[lengths.cumsum(0) - 1] = values
+        return cls(data, lengths)
+
+    @classmethod
+    def from_packed(cls, x: PackedSequence) -> "RaggedBatch":
+        rows = _get_packed_rows(x)
+        return cls(x.data[rows.to(x.data.device)], get_packed_lengths(x))
+
+    @classmethod
+    def cat(cls, batches: Iterable["RaggedBatch"]) -> "RaggedBatch":
+        batches = [batch for batch in batches if len(batch) > 0]
+        if not batches:
+            return cls.from_list([])
+        return cls(
+            torch.cat([batch.data for batch in batches]),
+            torch.cat([batch.lengths for batch in batches]),
+        )
+
+    def to_packed(self) -> PackedSequence:
+        lengths, sorted_indices = torch.sort(self.lengths, descending=True)
+        steps = torch.arange(lengths[0]).unsqueeze(-1)
+        mask = steps < lengths
+        rows = (self.offsets[sorted_indices] + steps)[mask]
+        sorted_indices = sorted_indices.to(self.data.device)
+        return PackedSequence(
+            self.data[rows.to(self.data.device)],
+            mask.sum(-1),
+            sorted_indices,
+            sorted_indices.argsort(),
+        )
+
+    def to_packed_like(self, x: PackedSequence) -> PackedSequence:
+        rows = _get_packed_rows(x).to(self.data.device)
+        data = self.data.new_empty((len(rows), *self.data.shape[1:]))
+        data[rows] = self.data
+        return PackedSequence(
+            data, x.batch_sizes, x.sorted_indices, x.unsorted_indices
+        )
+
+    def to_list(self) -> List[Tensor]:
+        return list(self.data.split(self.lengths.tolist()))
+
+    def map(self, fn: Callable[[Tensor], Tensor]) -> "RaggedBatch":
+        return RaggedBatch(fn(self.data), self.lengths)
+
+    def split(
+        self, lengths: Union[int, Tensor]
+    ) -> Tuple["RaggedBatch", "RaggedBatch"]:
+        lengths = torch.as_tensor(lengths).expand_as(self.lengths)
+        mask = self.positions < lengths.repeat_interleave(self.lengths)
+        mask = mask.to(self.data.device)
+        return (
+            RaggedBatch(self.data[mask], lengths.clone()),
+            RaggedBatch(self.data[~mask], self.lengths - lengths),
+        )
+
+    def first(self) -> Tensor:
+        return self.data[self.offsets.to(self.data.device)]
+
+    def last(self) -> Tensor:
+        return self.data[
+            (self.offsets + self.lengths - 1).to(self.data.device)
+        ]
+
+    def sum(self) -> Tensor:
+        return self.data.new_zeros(
+            (len(self), *self.data.shape[1:])
+        ).index_add(0, self.sequence_indices.to(self.data.device), self.data)
@@ -4,6 +4,7 @@ from typing import Optional
 from torch import Tensor
 
 from kilroy_module_pytorch_py_sdk.metrics import LossMetric
+from kilroy_module_pytorch_py_sdk.utils import TopKLogprobs
 from kilroy_module_server_py_sdk import Metrizable
 from kilroy_server_py_utils import Categorizable, classproperty, normalize
 
@@ -34,3 +35,12 @@ class PolicyRegularization(Metrizable, Categorizable, ABC):
         baseline_logprobs: Tensor,
     ) -> Tensor:
         pass
+
+    async def calculate_top_k(
+        self,
+        policy_logprobs: Tensor,
+        baseline_logprobs: TopKLogprobs,
+    ) -> Tensor:
+        return await self.calculate(
+            *baseline_logprobs.coarsen(policy_logprobs)
+        )
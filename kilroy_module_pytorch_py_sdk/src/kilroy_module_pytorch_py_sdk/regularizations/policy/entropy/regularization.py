@@ -21,6 +21,7 @@ from kilroy_module_pytorch_py_sdk.regularizations.policy.entropy.state import (
     State,
     MetricsState,
 )
+from kilroy_module_pytorch_py_sdk.utils import TopKLogprobs
 from kilroy_module_server_py_sdk import Metric
 from kilroy_server_py_utils import Configurable, classproperty, Parameter
 
@@ -109,18 +110,32 @@ class EntropyPolicyRegularization(EntropyPolicyRegularizationBase):
         async with self.state.read_lock() as state:
             return state.weight
 
+    @staticmethod
+    def _normalized_entropy(logprobs: Tensor, n_classes: int) -> Tensor:
+        entropy = Categorical(logits=logprobs).entropy()
+        if n_classes > 1:
+            entropy = entropy / torch.tensor(n_classes).log()
+        return entropy
+
     async def calculate(
         self, policy_logprobs: Tensor, baseline_logprobs: Tensor
     ) -> Tensor:
         n_classes = policy_logprobs.shape[-1]
         logprobs = policy_logprobs.view(-1, n_classes)
 
-        policy_entropy = Categorical(logits=logprobs).entropy()
-        if n_classes > 1:
-            policy_entropy = policy_entropy / torch.tensor(n_classes).log()
+        policy_entropy = self._normalized_entropy(logprobs, n_classes)
+        baseline_entropy = self._normalized_entropy(
+            baseline_logprobs, n_classes
+        )
+        return (baseline_entropy - policy_entropy).abs()
 
-        baseline_entropy = Categorical(logits=baseline_logprobs).entropy()
-        if n_classes > 1:
-            baseline_entropy = baseline_entropy / torch.tensor(n_classes).log()
+    async def calculate_top_k(
+        self, policy_logprobs: Tensor, baseline_logprobs: TopKLogprobs
+    ) -> Tensor:
+        n_classes = policy_logprobs.shape[-1]
+        logprobs = policy_logprobs.view(-1, n_classes)
+        policy, baseline = baseline_logprobs.coarsen(logprobs)
 
+        policy_entropy = self._normalized_entropy(policy, n_classes)
+        baseline_entropy = self._normalized_entropy(baseline, n_classes)
         return (baseline_entropy - policy_entropy).abs()
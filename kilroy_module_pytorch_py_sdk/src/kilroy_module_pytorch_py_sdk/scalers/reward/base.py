@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import List, Sequence
 
 from kilroy_module_server_py_sdk import Categorizable, classproperty, normalize
 
@@ -13,3 +14,6 @@ class RewardScaler(Categorizable, ABC):
     @abstractmethod
     async def scale(self, reward: float) -> float:
         pass
+
+    async def scale_batch(self, rewards: Sequence[float]) -> List[float]:
+        return [await self.scale(reward) for reward in rewards]
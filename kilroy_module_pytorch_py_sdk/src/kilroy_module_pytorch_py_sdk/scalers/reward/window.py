@@ -1,9 +1,8 @@
 from dataclasses import dataclass
-from math import isnan
+from math import fsum, sqrt
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Callable, Awaitable, Sequence
 
-import torch
 from kilroy_module_py_shared import SerializableModel
 
 from kilroy_module_pytorch_py_sdk.scalers.reward.base import RewardScaler
@@ -18,6 +17,49 @@ class Params(SerializableModel):
 class State:
     buffer: List[float]
     length: int
+    position: int = 0
+    mean: float = 0
+    deviations: float = 0
+
+
+def _get_ordered(state: State) -> List[float]:
+    return state.buffer[state.position :] + state.buffer[: state.position]
+
+
+def _reset(state: State, buffer: List[float]) -> None:
+    state.buffer = list(buffer[-state.length :])
+    state.position = 0
+    n = len(state.buffer)
+    state.mean = fsum(state.buffer) / n if n > 0 else 0
+    state.deviations = fsum((x - state.mean) ** 2 for x in state.buffer)
+
+
+def _push(state: State, reward: float) -> float:
+    if len(state.buffer) < state.length:
+        state.buffer.append(reward)
+        delta = reward - state.mean
+        state.mean += delta / len(state.buffer)
+        state.deviations += delta * (reward - state.mean)
+    else:
+        removed = state.buffer[state.position]
+        state.buffer[state.position] = reward
+        state.position = (state.position + 1) % state.length
+        mean = state.mean + (reward - removed) / state.length
+        state.deviations += (reward - removed) * (
+            reward - mean + removed - state.mean
+        )
+        state.mean = mean
+
+    if state.position == 0 and len(state.buffer) == state.length:
+        _reset(state, state.buffer)
+
+    n = len(state.buffer)
+    if n < 2:
+        return 0.0
+    variance = state.deviations / (n - 1)
+    if not variance > 0:
+        return 0.0
+    return (reward - state.mean) / sqrt(variance)
 
 
 class WindowRewardScaler(RewardScaler, Configurable[State]):
@@ -32,6 +74,21 @@ class WindowRewardScaler(RewardScaler, Configurable[State]):
                 "default": 1000,
             }
 
+        @classmethod
+        async def _set(
+            cls, state: State, value: int
+        ) -> Callable[[], Awaitable]:
+            original_buffer = _get_ordered(state)
+            original_length = state.length
+
+            async def undo():
+                state.length = original_length
+                _reset(state, original_buffer)
+
+            state.length = value
+            _reset(state, original_buffer)
+            return undo
+
     async def _build_default_state(self) -> State:
         param = Params(**self._kwargs)
         return State(buffer=[], length=param.length)
@@ -39,24 +96,24 @@ class WindowRewardScaler(RewardScaler, Configurable[State]):
     @classmethod
     async def _save_state(cls, state: State, directory: Path) -> None:
         directory.mkdir(parents=True, exist_ok=True)
-        state_dict = {"buffer": state.buffer, "length": state.length}
+        state_dict = {
+            "buffer": _get_ordered(state),
+            "length": state.length,
+        }
         await cls._save_state_dict(state_dict, directory)
 
     async def _load_saved_state(self, directory: Path) -> State:
         params = Params(**self._kwargs)
         state_dict = await self._load_state_dict(directory)
-        return State(
-            buffer=state_dict.get("buffer", []),
-            length=state_dict.get("length", params.length),
+        state = State(
+            buffer=[], length=state_dict.get("length", params.length)
         )
+        _reset(state, state_dict.get("buffer", []))
+        return state
 
     async def scale(self, reward: float) -> float:
+        return (await self.scale_batch([reward]))[0]
+
+    async def scale_batch(self, rewards: Sequence[float]) -> List[float]:
         async with self.state.write_lock() as state:
-            state.buffer.append(reward)
-            if len(state.buffer) > state.length:
-                state.buffer.pop(0)
-            buffer = torch.tensor(state.buffer).float()
-        mean, std = buffer.mean().item(), buffer.std().item()
-        if isnan(std) or std == 0:
-            return 0.0
-        return (reward - mean) / std
+            return [_push(state, float(reward)) for reward in rewards]
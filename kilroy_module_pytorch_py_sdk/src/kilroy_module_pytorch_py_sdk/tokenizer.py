@@ -20,3 +20,6 @@ class Tokenizer(ABC):
     @abstractmethod
     def end_token(self) -> int:
         pass
+
+    def decode_pieces(self, indices: List[int]) -> List[str]:
+        return [self.decode([index]) for index in indices]
@@ -1,3 +1,8 @@
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    CacheBatch,
+    Segment,
+    SequenceBuffer,
+)
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.cache import (
     Cache,
 )
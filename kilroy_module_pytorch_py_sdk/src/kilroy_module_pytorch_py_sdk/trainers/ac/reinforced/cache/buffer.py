@@ -0,0 +1,280 @@
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Collection,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from uuid import uuid4
+
+import torch
+from torch import Tensor
+from torch.nn.functional import pad
+
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
+
+FIFO_EVICTION = "fifo"
+RESERVOIR_EVICTION = "reservoir"
+
+
+@dataclass
+class CacheBatch:
+    full_sequences: RaggedBatch
+    timestep_rewards: RaggedBatch
+
+    @classmethod
+    def from_segment(cls, segment: Optional["Segment"]) -> "CacheBatch":
+        if segment is None or len(segment) == 0:
+            empty = RaggedBatch.from_list([])
+            return cls(full_sequences=empty, timestep_rewards=empty)
+
+        full_sequences = segment.tokens.map(lambda x: x.unsqueeze(-1))
+        return cls(
+            full_sequences=full_sequences,
+            timestep_rewards=RaggedBatch.from_last(
+                full_sequences.lengths, segment.rewards.unsqueeze(-1)
+            ),
+        )
+
+    @classmethod
+    def from_data(
+        cls, data: Collection[Tuple[Tensor, Tensor, Tensor, Tensor]]
+    ) -> "CacheBatch":
+        data = list(data)
+        return cls.from_segment(Segment.from_data(data, 0) if data else None)
+
+
+@dataclass
+class Segment:
+    ids: Tensor
+    tokens: RaggedBatch
+    context_lengths: Tensor
+    scores: Tensor
+    rewards: Tensor
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, indices: Union[slice, Tensor]) -> "Segment":
+        return Segment(
+            ids=self.ids[indices],
+            tokens=self.tokens[indices],
+            context_lengths=self.context_lengths[indices],
+            scores=self.scores[indices],
+            rewards=self.rewards[indices],
+        )
+
+    @classmethod
+    def from_data(
+        cls, data: Sequence[Tuple[Tensor, Tensor, Tensor, Tensor]], start: int
+    ) -> "Segment":
+        return cls(
+            ids=torch.arange(start, start + len(data)),
+            tokens=RaggedBatch.join(
+                (context.flatten(), response.flatten())
+                for context, response, _, _ in data
+            ),
+            context_lengths=torch.tensor(
+                [len(context) for context, _, _, _ in data], dtype=torch.long
+            ),
+            scores=torch.tensor([float(score) for _, _, score, _ in data]),
+            rewards=torch.tensor([float(reward) for _, _, _, reward in data]),
+        )
+
+
+class SequenceBuffer:
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.ids = torch.zeros(capacity, dtype=torch.long)
+        self.tokens = torch.zeros((capacity, 0), dtype=torch.long)
+        self.context_lengths = torch.zeros(capacity, dtype=torch.long)
+        self.lengths = torch.zeros(capacity, dtype=torch.long)
+        self.scores = torch.zeros(capacity)
+        self.rewards = torch.zeros(capacity)
+        self.size = 0
+        self.head = 0
+        self.count = 0
+        self.uid = uuid4().hex
+        self._ordered = True
+        self._batch: Optional[CacheBatch] = None
+        self._pending: List[Tuple[Callable[[], Segment], int]] = []
+
+    def __len__(self) -> int:
+        pending = sum(size for _, size in self._pending)
+        return min(self.size + pending, self.capacity)
+
+    @property
+    def indices(self) -> Tensor:
+        self._materialize()
+        if not self._ordered:
+            return self.ids[: self.size].argsort()
+        return torch.cat(
+            (torch.arange(self.head, self.size), torch.arange(self.head))
+        )
+
+    def defer(self, load: Callable[[], Segment], size: int) -> None:
+        self._pending.append((load, size))
+        self._batch = None
+
+    def _materialize(self) -> None:
+        pending, self._pending = self._pending, []
+        for load, _ in pending:
+            self._append(load())
+
+    def _write(self, segment: Segment, slots: Tensor) -> None:
+        if len(segment) == 0:
+            return
+
+        lengths = segment.tokens.lengths
+        width = int(lengths.max())
+        if width > self.tokens.shape[1]:
+            self.tokens = pad(self.tokens, (0, width - self.tokens.shape[1]))
+
+        mask = torch.arange(width) < lengths.unsqueeze(-1)
+        tokens = torch.zeros((len(segment), width), dtype=torch.long)
+        tokens[mask] = segment.tokens.data.long()
+
+        self._batch = None
+        self.ids[slots] = segment.ids
+        self.tokens[slots] = 0
+        self.tokens[slots, :width] = tokens
+        self.context_lengths[slots] = segment.context_lengths
+        self.lengths[slots] = lengths
+        self.scores[slots] = segment.scores
+        self.rewards[slots] = segment.rewards
+        self.size = max(self.size, int(slots.max()) + 1)
+
+    def _reorder(self) -> None:
+        order = self.ids[: self.size].argsort()
+        for name in (
+            "ids",
+            "tokens",
+            "context_lengths",
+            "lengths",
+            "scores",
+            "rewards",
+        ):
+            getattr(self, name)[: self.size] = getattr(self, name)[order]
+        self.head = 0
+        self._ordered = True
+        self._batch = None
+
+    def _append(self, segment: Segment) -> None:
+        if self.capacity == 0:
+            return
+        if not self._ordered:
+            self._reorder()
+
+        segment = segment[-self.capacity :]
+        free = min(self.capacity - self.size, len(segment))
+        replaced = len(segment) - free
+        oldest = (self.head + torch.arange(replaced)) % self.capacity
+        slots = torch.cat((torch.arange(self.size, self.size + free), oldest))
+        self.head = (self.head + replaced) % self.capacity
+        self._write(segment, slots)
+
+    def _sample(self, segment: Segment) -> None:
+        if self.capacity == 0:
+            return
+
+        free = min(self.capacity - self.size, len(segment))
+        replacements = torch.rand(len(segment) - free) * (
+            segment.ids[free:] + 1
+        )
+        slots = torch.cat(
+            (torch.arange(self.size, self.size + free), replacements.long())
+        )
+
+        winners = {
+            slot: index
+            for index, slot in enumerate(slots.tolist())
+            if slot < self.capacity
+        }
+        selected = torch.tensor(sorted(winners.values()), dtype=torch.long)
+        if bool((slots[selected] < self.size).any()):
+            self._ordered = False
+        self._write(segment[selected], slots[selected])
+
+    def extend(
+        self,
+        data: Sequence[Tuple[Tensor, Tensor, Tensor, Tensor]],
+        eviction: str = FIFO_EVICTION,
+    ) -> None:
+        self._materialize()
+        data, start = list(data), self.count
+        self.count += len(data)
+        if self.capacity == 0 or len(data) == 0:
+            return
+
+        if eviction == RESERVOIR_EVICTION:
+            self._sample(Segment.from_data(data, start))
+        else:
+            skip = max(len(data) - self.capacity, 0)
+            self._append(Segment.from_data(data[skip:], start + skip))
+
+    def resized(
+        self, capacity: int, eviction: str = FIFO_EVICTION
+    ) -> "SequenceBuffer":
+        buffer = SequenceBuffer(capacity)
+        buffer.count = self.count
+        buffer.uid = self.uid
+        buffer.tokens = torch.zeros(
+            (capacity, self.tokens.shape[1]), dtype=torch.long
+        )
+
+        segment = self.get_segment()
+        if eviction == RESERVOIR_EVICTION and len(segment) > capacity:
+            keep = torch.randperm(len(segment))[:capacity]
+            segment = segment[keep.sort().values]
+
+        buffer._append(segment)
+        return buffer
+
+    def get_ids(self) -> Tensor:
+        return self.ids[self.indices]
+
+    def get_segment(self, start: int = 0) -> Segment:
+        indices = self.indices
+        indices = indices[self.ids[indices] >= start]
+        lengths = self.lengths[indices]
+        width = int(lengths.max()) if len(lengths) > 0 else 0
+        mask = torch.arange(width) < lengths.unsqueeze(-1)
+
+        return Segment(
+            ids=self.ids[indices],
+            tokens=RaggedBatch(self.tokens[indices, :width][mask], lengths),
+            context_lengths=self.context_lengths[indices],
+            scores=self.scores[indices],
+            rewards=self.rewards[indices],
+        )
+
+    def _build_batch(self) -> CacheBatch:
+        if len(self) == 0:
+            return CacheBatch.from_segment(None)
+        return CacheBatch.from_segment(self.get_segment())
+
+    def get_batch(self) -> CacheBatch:
+        self._materialize()
+        if self._batch is None:
+            self._batch = self._build_batch()
+        return self._batch
+
+    def to_list(self) -> List[Tuple[Tensor, Tensor, Tensor, Tensor]]:
+        segment = self.get_segment()
+        return [
+            (
+                tokens[:context_length].unsqueeze(-1),
+                tokens[context_length:].unsqueeze(-1),
+                score,
+                reward,
+            )
+            for tokens, context_length, score, reward in zip(
+                segment.tokens.to_list(),
+                segment.context_lengths.tolist(),
+                segment.scores,
+                segment.rewards,
+            )
+        ]
@@ -14,7 +14,12 @@ import torch
 from aiostream import stream
 from torch import Tensor
 
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    CacheBatch,
+    SequenceBuffer,
+)
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.parameters import (
+    EvictionParameter,
     MaxSizeParameter,
 )
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.params import (
@@ -23,26 +28,48 @@ from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.params import (
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.state import (
     State,
 )
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.storage import (
+    load_buffer,
+    prune_segments,
+    save_buffer,
+)
 from kilroy_server_py_utils import Configurable, Parameter, classproperty
 
 
 class CacheBase(Configurable[State], ABC):
     async def _build_default_state(self) -> State:
         params = Params(**self._kwargs)
-        return State(data=[], max_size=params.max_size)
+        return State(
+            buffer=SequenceBuffer(params.max_size),
+            max_size=params.max_size,
+            eviction=params.eviction,
+        )
 
     @classmethod
     async def _save_state(cls, state: State, directory: Path) -> None:
-        torch.save(state.data, directory / "data.pt")
-        state_dict = {"max_size": state.max_size}
+        saved = await cls._load_state_dict(directory)
+        segments = save_buffer(state.buffer, directory, saved)
+        state_dict = {
+            "max_size": state.max_size,
+            "eviction": state.eviction,
+            **segments,
+        }
         await cls._save_state_dict(state_dict, directory)
+        prune_segments(directory, segments["segments"])
 
     async def _load_saved_state(self, directory: Path) -> State:
         params = Params(**self._kwargs)
-        data = torch.load(directory / "data.pt")
         state_dict = await self._load_state_dict(directory)
+        max_size = state_dict.get("max_size", params.max_size)
+        if "segments" in state_dict:
+            buffer = load_buffer(directory, state_dict, max_size)
+        else:
+            buffer = SequenceBuffer(max_size)
+            buffer.extend(torch.load(directory / "data.pt"))
         return State(
-            data=data, max_size=state_dict.get("max_size", params.max_size)
+            buffer=buffer,
+            max_size=max_size,
+            eviction=state_dict.get("eviction", params.eviction),
         )
 
 
@@ -52,15 +79,14 @@ class Cache(CacheBase):
     def parameters(cls) -> Set[Type[Parameter]]:
         return {
             MaxSizeParameter,
+            EvictionParameter,
         }
 
     async def append(
         self, data: Tuple[Tensor, Tensor, Tensor, Tensor]
     ) -> None:
         async with self.state.write_lock() as state:
-            state.data.append(data)
-            if len(state.data) > state.max_size:
-                state.data.pop(0)
+            state.buffer.extend([data], state.eviction)
 
     async def extend(
         self,
@@ -70,17 +96,23 @@ class Cache(CacheBase):
         ],
     ) -> None:
         async with stream.iterate(data).stream() as data:
-            async for datum in data:
-                await self.append(datum)
+            data = [datum async for datum in data]
+
+        async with self.state.write_lock() as state:
+            state.buffer.extend(data, state.eviction)
 
     async def get(self) -> Collection[Tuple[Tensor, Tensor, Tensor, Tensor]]:
         async with self.state.read_lock() as state:
-            return state.data
+            return state.buffer.to_list()
+
+    async def get_batch(self) -> CacheBatch:
+        async with self.state.read_lock() as state:
+            return state.buffer.get_batch()
 
     async def clear(self) -> None:
         async with self.state.write_lock() as state:
-            state.data = []
+            state.buffer = SequenceBuffer(state.max_size)
 
     async def get_size(self) -> int:
         async with self.state.read_lock() as state:
-            return len(state.data)
+            return len(state.buffer)
@@ -1,5 +1,9 @@
 from typing import Dict, Any, Callable, Awaitable
 
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    FIFO_EVICTION,
+    RESERVOIR_EVICTION,
+)
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.state import (
     State,
 )
@@ -10,14 +14,14 @@ class MaxSizeParameter(Parameter[State, int]):
     @classmethod
     async def _set(cls, state: State, value: int) -> Callable[[], Awaitable]:
         original_value = state.max_size
-        original_data = state.data
+        original_buffer = state.buffer
 
         async def undo():
             state.max_size = original_value
-            state.data = original_data
+            state.buffer = original_buffer
 
         state.max_size = value
-        state.data = state.data[-value:]
+        state.buffer = state.buffer.resized(value, state.eviction)
         return undo
 
     # noinspection PyMethodParameters
@@ -34,3 +38,15 @@ class MaxSizeParameter(Parameter[State, int]):
     @classproperty
     def pretty_name(cls) -> str:
         return "Maximum Size"
+
+
+class EvictionParameter(Parameter[State, str]):
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": "string",
+            "enum": [FIFO_EVICTION, RESERVOIR_EVICTION],
+            "title": cls.pretty_name,
+            "default": FIFO_EVICTION,
+        }
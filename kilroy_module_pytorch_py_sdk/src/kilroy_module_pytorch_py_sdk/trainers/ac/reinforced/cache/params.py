@@ -1,5 +1,9 @@
 from kilroy_module_py_shared import SerializableModel
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    FIFO_EVICTION,
+)
 
 
 class Params(SerializableModel):
     max_size: int = 100
+    eviction: str = FIFO_EVICTION
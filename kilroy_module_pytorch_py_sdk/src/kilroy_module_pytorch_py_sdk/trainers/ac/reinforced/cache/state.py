@@ -1,10 +1,12 @@
 from dataclasses import dataclass
-from typing import List, Tuple
 
-from torch import Tensor
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    SequenceBuffer,
+)
 
 
 @dataclass
 class State:
-    data: List[Tuple[Tensor, Tensor, Tensor, Tensor]]
+    buffer: SequenceBuffer
     max_size: int
+    eviction: str
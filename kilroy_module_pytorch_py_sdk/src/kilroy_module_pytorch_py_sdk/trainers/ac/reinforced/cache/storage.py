@@ -0,0 +1,122 @@
+import shutil
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, List
+from uuid import uuid4
+
+import numpy as np
+import torch
+
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    Segment,
+    SequenceBuffer,
+)
+
+SEGMENTS_DIRECTORY = "segments"
+MAX_SEGMENTS = 64
+
+
+def _write_segment(segment: Segment, directory: Path) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    lengths = segment.tokens.lengths
+    offsets = torch.cat((torch.zeros(1, dtype=torch.long), lengths.cumsum(0)))
+    np.save(directory / "ids.npy", segment.ids.numpy())
+    np.save(
+        directory / "tokens.npy", segment.tokens.data.numpy().astype(np.int32)
+    )
+    np.save(directory / "offsets.npy", offsets.numpy())
+    np.save(directory / "context_lengths.npy", segment.context_lengths.numpy())
+    np.save(directory / "scores.npy", segment.scores.numpy())
+    np.save(directory / "rewards.npy", segment.rewards.numpy())
+
+
+def _map_segment(directory: Path) -> Dict[str, np.ndarray]:
+    return {
+        name: np.load(directory / f"{name}.npy", mmap_mode="r")
+        for name in (
+            "ids",
+            "tokens",
+            "offsets",
+            "context_lengths",
+            "scores",
+            "rewards",
+        )
+    }
+
+
+def _read_segment(columns: Dict[str, np.ndarray], rows: np.ndarray) -> Segment:
+    offsets = torch.from_numpy(np.array(columns["offsets"]))
+    tokens = np.array(columns["tokens"]).astype(np.int64)
+    rows = torch.from_numpy(rows)
+    return Segment(
+        ids=torch.from_numpy(np.array(columns["ids"]))[rows],
+        tokens=RaggedBatch(torch.from_numpy(tokens), offsets.diff())[rows],
+        context_lengths=torch.from_numpy(np.array(columns["context_lengths"]))[
+            rows
+        ],
+        scores=torch.from_numpy(np.array(columns["scores"]))[rows],
+        rewards=torch.from_numpy(np.array(columns["rewards"]))[rows],
+    )
+
+
+def save_buffer(
+    buffer: SequenceBuffer, directory: Path, state_dict: Dict[str, Any]
+) -> Dict[str, Any]:
+    live = buffer.get_ids().numpy()
+    saved = state_dict.get("count", 0)
+    segments, stale = [], 0
+
+    if state_dict.get("uid") == buffer.uid and saved <= buffer.count:
+        for segment in state_dict.get("segments", []):
+            ids = np.load(
+                directory / SEGMENTS_DIRECTORY / segment["name"] / "ids.npy",
+                mmap_mode="r",
+            )
+            alive = int(np.isin(ids, live).sum())
+            if alive > 0:
+                segments.append(segment)
+                stale += segment["size"] - alive
+    else:
+        saved = 0
+
+    if len(segments) >= MAX_SEGMENTS or stale > len(live):
+        saved, segments = 0, []
+
+    segment = buffer.get_segment(saved)
+    if len(segment) > 0:
+        name = uuid4().hex
+        _write_segment(segment, directory / SEGMENTS_DIRECTORY / name)
+        segments.append({"name": name, "size": len(segment)})
+
+    np.save(directory / "ids.npy", live)
+    return {"uid": buffer.uid, "count": buffer.count, "segments": segments}
+
+
+def prune_segments(directory: Path, segments: List[Dict[str, Any]]) -> None:
+    names = {segment["name"] for segment in segments}
+    directory = directory / SEGMENTS_DIRECTORY
+    if not directory.exists():
+        return
+    for path in directory.iterdir():
+        if path.name not in names:
+            shutil.rmtree(path)
+
+
+def load_buffer(
+    directory: Path, state_dict: Dict[str, Any], capacity: int
+) -> SequenceBuffer:
+    buffer = SequenceBuffer(capacity)
+    buffer.uid = state_dict["uid"]
+    buffer.count = state_dict["count"]
+
+    live = np.load(directory / "ids.npy")
+    for segment in state_dict["segments"]:
+        columns = _map_segment(
+            directory / SEGMENTS_DIRECTORY / segment["name"]
+        )
+        rows = np.flatnonzero(np.isin(columns["ids"], live))
+        if len(rows) > 0:
+            buffer.defer(partial(_read_segment, columns, rows), len(rows))
+
+    return buffer
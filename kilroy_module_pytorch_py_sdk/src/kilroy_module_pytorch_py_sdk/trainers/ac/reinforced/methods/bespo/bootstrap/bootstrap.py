@@ -12,6 +12,7 @@ from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.bespo.bootstrap.parameters import (
     GeneratorParameter,
     SampleSizeParameter,
+    PipelinedParameter,
     StopConditionParameter,
 )
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.bespo.bootstrap.params import (
@@ -56,6 +57,7 @@ class BootstrapBase(Configurable[State], ABC):
         return State(
             generator=await self._build_generator(params.generator),
             sample_size=params.sample_size,
+            pipelined=params.pipelined,
             stop_condition=await self._build_stop_condition_state(
                 params.stop_condition
             ),
@@ -80,7 +82,10 @@ class BootstrapBase(Configurable[State], ABC):
             state.stop_condition, directory / "stop_condition"
         )
 
-        state_dict = {"sample_size": state.sample_size}
+        state_dict = {
+            "sample_size": state.sample_size,
+            "pipelined": state.pipelined,
+        }
         await cls._save_state_dict(state_dict, directory)
 
     @classmethod
@@ -130,6 +135,7 @@ class BootstrapBase(Configurable[State], ABC):
                 state_dict, directory / "generator"
             ),
             sample_size=state_dict.get("sample_size", params.sample_size),
+            pipelined=state_dict.get("pipelined", params.pipelined),
             stop_condition=await self._load_stop_condition_state(
                 params.stop_condition, directory / "stop_condition"
             ),
@@ -151,6 +157,7 @@ class Bootstrap(BootstrapBase):
         return {
             GeneratorParameter,
             SampleSizeParameter,
+            PipelinedParameter,
             StopConditionParameter,
         }
 
@@ -161,18 +168,23 @@ class Bootstrap(BootstrapBase):
             condition = state.stop_condition.condition
             return await condition.should_stop(rewards, iteration)
 
+    async def is_pipelined(self) -> bool:
+        async with self.state.read_lock() as state:
+            return state.pipelined
+
     async def generate(
         self, policy: ModelInfo[SequentialModel]
-    ) -> List[Tuple[Tensor, Tensor]]:
+    ) -> List[Tuple[Tensor, Tensor, Tensor]]:
         async with self.state.read_lock() as state:
             generator = state.generator
             sample_size = state.sample_size
 
-        sequences = await generator.generate(policy, sample_size)
+        sequences = await generator.generate_with_logprobs(policy, sample_size)
         return [
             (
                 torch.tensor(context).long().view(-1, 1),
                 torch.tensor(response).long().view(-1, 1),
+                logprobs.view(-1, 1),
             )
-            for context, response in sequences
+            for context, response, logprobs in sequences
         ]
@@ -32,6 +32,17 @@ class SampleSizeParameter(Parameter[State, int]):
         }
 
 
+class PipelinedParameter(Parameter[State, bool]):
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": "boolean",
+            "title": cls.pretty_name,
+            "default": False,
+        }
+
+
 class StopConditionParameter(
     CategorizableBasedParameter[State, StopCondition]
 ):
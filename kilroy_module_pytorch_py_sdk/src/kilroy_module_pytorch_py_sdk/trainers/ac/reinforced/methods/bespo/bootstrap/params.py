@@ -14,4 +14,5 @@ class StopConditionParams(SerializableModel):
 class Params(SerializableModel):
     generator: Dict[str, Any] = {}
     sample_size: int = 32
+    pipelined: bool = False
     stop_condition: StopConditionParams = StopConditionParams()
@@ -17,4 +17,5 @@ class StopConditionState:
 class State:
     generator: Generator
     sample_size: int
+    pipelined: bool
     stop_condition: StopConditionState
@@ -1,4 +1,8 @@
+import asyncio
 from abc import ABC
+from asyncio import Lock
+from copy import deepcopy
+from dataclasses import replace
 from functools import partial
 from pathlib import Path
 from typing import (
@@ -12,24 +16,30 @@ from typing import (
     Hashable,
     Any,
     Iterable,
+    Optional,
+    Union,
 )
 
 import torch
 from torch import Tensor
-from torch.nn import MSELoss
 from torch.nn.utils.rnn import PackedSequence
 
 from kilroy_module_pytorch_py_sdk.gae import GeneralizedAdvantageEstimator
 from kilroy_module_pytorch_py_sdk.metrics import (
     ScoreMetric,
     LossMetric,
+    StalenessMetric,
 )
 from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
 from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
 from kilroy_module_pytorch_py_sdk.regularizations.policy import (
     PolicyRegularization,
 )
 from kilroy_module_pytorch_py_sdk.report import MetricReport, Metrics
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    CacheBatch,
+)
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.controls import (
     TrainingControls,
 )
@@ -68,13 +78,24 @@ from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.bespo.stop.valu
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.method import (
     Method,
 )
-from kilroy_module_pytorch_py_sdk.utils import freeze
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.parameters import (
+    PolicyLogprobsTopKParameter,
+    ValueBatchSizeParameter,
+    ValueSampleSizeParameter,
+)
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.policy import (
+    calculate_regularization,
+    compact_logprobs,
+)
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.value import (
+    fit_value_batches,
+    get_value_batches,
+)
 from kilroy_module_pytorch_py_sdk.utils import (
-    pack_list,
+    TopKLogprobs,
+    frozen_forwards,
     gather_logprobs,
-    batched_forward,
-    squash_packed,
-    unpack_to_list,
+    model_forward,
 )
 from kilroy_module_server_py_sdk import Metric
 from kilroy_server_py_utils import Configurable, Parameter
@@ -107,6 +128,12 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
                 x_axis_key=params.bootstrap_episode_reward.x_axis_key,
                 x_axis_label=params.bootstrap_episode_reward.x_axis_label,
             ),
+            bootstrap_episode_staleness=await StalenessMetric.create(
+                name=params.bootstrap_episode_staleness.name,
+                label=params.bootstrap_episode_staleness.label,
+                x_axis_key=params.bootstrap_episode_staleness.x_axis_key,
+                x_axis_label=params.bootstrap_episode_staleness.x_axis_label,
+            ),
             base_bootstrap_iteration_loss=await LossMetric.create(
                 name=params.base_bootstrap_iteration_loss.name,
                 label=params.base_bootstrap_iteration_loss.label,
@@ -159,6 +186,7 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
             stop_condition=await cls._build_policy_stop_condition_state(
                 params.stop_condition
             ),
+            logprobs_top_k=params.logprobs_top_k,
         )
 
     @staticmethod
@@ -206,6 +234,8 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
             stop_condition=await cls._build_value_stop_condition_state(
                 params.stop_condition
             ),
+            batch_size=params.batch_size,
+            sample_size=params.sample_size,
         )
 
     @classmethod
@@ -241,6 +271,9 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
             state.stop_condition, directory / "stop_condition"
         )
 
+        state_dict = {"logprobs_top_k": state.logprobs_top_k}
+        await cls._save_state_dict(state_dict, directory)
+
     @classmethod
     async def _save_value_stop_condition_state(
         cls, state: ValueStopConditionState, directory: Path
@@ -262,6 +295,12 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
             state.stop_condition, directory / "stop_condition"
         )
 
+        state_dict = {
+            "batch_size": state.batch_size,
+            "sample_size": state.sample_size,
+        }
+        await cls._save_state_dict(state_dict, directory)
+
     @classmethod
     async def _save_state(cls, state: State, directory: Path) -> None:
         await cls._save_policy_state(state.policy, directory / "policy")
@@ -301,11 +340,16 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
     async def _load_policy_state(
         cls, params: PolicyParams, directory: Path
     ) -> PolicyState:
+        state_dict = await cls._load_state_dict(directory)
+
         return PolicyState(
             metrics=await cls._build_policy_metrics_state(params.metrics),
             stop_condition=await cls._load_policy_stop_condition_state(
                 params.stop_condition, directory / "stop_condition"
             ),
+            logprobs_top_k=state_dict.get(
+                "logprobs_top_k", params.logprobs_top_k
+            ),
         )
 
     @classmethod
@@ -340,11 +384,15 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
     async def _load_value_state(
         cls, params: ValueParams, directory: Path
     ) -> ValueState:
+        state_dict = await cls._load_state_dict(directory)
+
         return ValueState(
             metrics=await cls._build_value_metrics_state(params.metrics),
             stop_condition=await cls._load_value_stop_condition_state(
                 params.stop_condition, directory / "stop_condition"
             ),
+            batch_size=state_dict.get("batch_size", params.batch_size),
+            sample_size=state_dict.get("sample_size", params.sample_size),
         )
 
     @classmethod
@@ -378,6 +426,7 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethodBase(
             await state.policy.metrics.episode_score.cleanup()
             await state.policy.metrics.episode_reward.cleanup()
             await state.policy.metrics.bootstrap_episode_reward.cleanup()
+            await state.policy.metrics.bootstrap_episode_staleness.cleanup()
             await state.policy.metrics.base_bootstrap_iteration_loss.cleanup()
             await state.policy.metrics.base_bootstrap_episode_loss.cleanup()
             await state.policy.metrics.combined_bootstrap_iteration_loss.cleanup()
@@ -401,7 +450,10 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
     def parameters(cls) -> Set[Type[Parameter]]:
         return {
             PolicyStopConditionParameter,
+            PolicyLogprobsTopKParameter,
             ValueStopConditionParameter,
+            ValueBatchSizeParameter,
+            ValueSampleSizeParameter,
             BootstrapParameter,
         }
 
@@ -411,6 +463,7 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
                 state.policy.metrics.episode_score,
                 state.policy.metrics.episode_reward,
                 state.policy.metrics.bootstrap_episode_reward,
+                state.policy.metrics.bootstrap_episode_staleness,
                 state.policy.metrics.base_bootstrap_iteration_loss,
                 state.policy.metrics.base_bootstrap_episode_loss,
                 state.policy.metrics.combined_bootstrap_iteration_loss,
@@ -423,21 +476,16 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
     async def _get_full_sequences(
         sequences: List[Tuple[Tensor, Tensor]],
     ) -> PackedSequence:
-        return pack_list(
-            [
-                torch.vstack((context, response))
-                for context, response in sequences
-            ]
-        )
+        return RaggedBatch.join(sequences).to_packed()
 
     @staticmethod
     async def _calculate_policy_regularization(
         logprobs: PackedSequence,
-        baseline_logprobs: PackedSequence,
+        baseline_logprobs: Union[PackedSequence, TopKLogprobs],
         regularization: PolicyRegularization,
     ) -> Tuple[Tensor, MetricReport]:
-        loss = await regularization.calculate(
-            logprobs.data, baseline_logprobs.data
+        loss = await calculate_regularization(
+            regularization, logprobs, baseline_logprobs
         )
         report = MetricReport(
             values=loss.detach(),
@@ -452,7 +500,7 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
         self,
         base_losses: Tensor,
         logprobs: PackedSequence,
-        baseline_logprobs: PackedSequence,
+        baseline_logprobs: Union[PackedSequence, TopKLogprobs],
         regularizations: List[PolicyRegularization],
     ) -> Tuple[Tensor, Dict[Hashable, MetricReport]]:
         combined_loss = base_losses.mean()
@@ -534,33 +582,26 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
                     .item(),
                 )
 
-    async def _fit_value_batch(
-        self, values: PackedSequence, returns: PackedSequence
-    ) -> Dict[Hashable, MetricReport]:
-        base_losses = MSELoss(reduction="none")(values.data, returns.data)
-        base_loss = base_losses.mean()
-
-        await background(base_loss.backward)
-
-        return {"base": await self._get_base_value_report(base_loss)}
-
     async def _fit_value(
         self,
         value: TrainingControls[SequentialModel],
-        sequences: PackedSequence,
-        rewards: PackedSequence,
+        sequences: RaggedBatch,
+        rewards: RaggedBatch,
+        cached: int,
         gae: GeneralizedAdvantageEstimator,
         all_reports: Dict[Hashable, List[MetricReport]],
     ) -> Dict[Hashable, List[MetricReport]]:
-        async with value.model.lock:
-            values = await batched_forward(
-                value.model.model, sequences, value.model.batch_size
+        async with self.state.read_lock() as state:
+            batches = get_value_batches(
+                sequences.lengths,
+                cached,
+                state.value.batch_size,
+                state.value.sample_size,
             )
 
-        advantages = await gae.calculate(rewards, values)
-        returns = squash_packed(values, partial(torch.add, advantages.data))
+        loss = await fit_value_batches(value, sequences, rewards, batches, gae)
 
-        reports = await self._fit_value_batch(values, returns)
+        reports = {"base": await self._get_base_value_report(loss)}
         step = await value.step()
         all_reports = await self._process_iteration_reports(
             reports, all_reports, step - 1
@@ -571,8 +612,9 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
     async def _fit_value_loop(
         self,
         value: TrainingControls[SequentialModel],
-        sequences: PackedSequence,
-        rewards: PackedSequence,
+        sequences: RaggedBatch,
+        rewards: RaggedBatch,
+        cached: int,
         gae: GeneralizedAdvantageEstimator,
     ) -> Dict[Hashable, List[MetricReport]]:
         reports = {"base": []}
@@ -587,7 +629,7 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
                 break
 
             reports = await self._fit_value(
-                value, sequences, rewards, gae, reports
+                value, sequences, rewards, cached, gae, reports
             )
             iteration += 1
 
@@ -612,7 +654,7 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
         old_gathered_logprobs: PackedSequence,
         new_gathered_logprobs: PackedSequence,
         new_logprobs: PackedSequence,
-        baseline_logprobs: PackedSequence,
+        baseline_logprobs: Optional[Union[PackedSequence, TopKLogprobs]],
         advantages: PackedSequence,
         regularizations: List[PolicyRegularization],
     ) -> Dict[Hashable, MetricReport]:
@@ -645,36 +687,45 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
         sequences: List[Tuple[Tensor, Tensor]],
         advantages: PackedSequence,
         regularizations: List[PolicyRegularization],
+        old_gathered_logprobs: Optional[PackedSequence] = None,
+        baseline_logprobs: Optional[
+            Union[PackedSequence, TopKLogprobs]
+        ] = None,
     ) -> Dict[Hashable, List[MetricReport]]:
         full_sequences = await self._get_full_sequences(sequences)
 
-        async with baseline.lock:
-            with freeze(baseline.model) as frozen_baseline:
-                baseline_logprobs = await batched_forward(
-                    frozen_baseline, full_sequences, baseline.batch_size
-                )
-                baseline_logprobs = squash_packed(
-                    baseline_logprobs, lambda x: x.detach()
-                )
+        forwards = {}
+        if baseline_logprobs is None and regularizations:
+            forwards["baseline"] = baseline
+        if old_gathered_logprobs is None:
+            forwards["old"] = policy.model
 
-        async with policy.model.lock:
-            with freeze(policy.model.model) as frozen_policy:
-                old_logprobs = await batched_forward(
-                    frozen_policy, full_sequences, policy.model.batch_size
-                )
-                old_logprobs = squash_packed(
-                    old_logprobs, lambda x: x.detach()
-                )
+        outputs = await frozen_forwards(
+            [(model, full_sequences) for model in forwards.values()]
+        )
+        outputs = dict(zip(forwards, outputs))
+        baseline_logprobs = outputs.get("baseline", baseline_logprobs)
+        old_logprobs = outputs.get("old")
 
-        old_gathered_logprobs = await gather_logprobs(old_logprobs, sequences)
+        if old_logprobs is not None:
+            old_gathered_logprobs = await gather_logprobs(
+                old_logprobs, sequences
+            )
+
+        async with self.state.read_lock() as state:
+            top_k = state.policy.logprobs_top_k
+
+        old_logprobs, baseline_logprobs = compact_logprobs(
+            old_logprobs, baseline_logprobs, top_k
+        )
 
         all_reports = {}
         iteration = 0
 
         while True:
             async with policy.model.lock:
-                new_logprobs = await batched_forward(
-                    policy.model.model, full_sequences, policy.model.batch_size
+                new_logprobs = await model_forward(
+                    policy.model, full_sequences
                 )
             new_gathered_logprobs = await gather_logprobs(
                 new_logprobs, sequences
@@ -711,6 +762,70 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
 
         return all_reports
 
+    @staticmethod
+    async def _snapshot_policy(
+        policy: ModelInfo[SequentialModel],
+        snapshot: Optional[ModelInfo[SequentialModel]] = None,
+    ) -> ModelInfo[SequentialModel]:
+        async with policy.lock:
+            if snapshot is None:
+                return replace(
+                    policy,
+                    model=deepcopy(policy.model),
+                    lock=Lock(),
+                    batcher=None,
+                )
+            snapshot.model.load_state_dict(policy.model.state_dict())
+            return snapshot
+
+    async def _generate_bootstrap_sample(
+        self,
+        bootstrap: Bootstrap,
+        policy: ModelInfo[SequentialModel],
+        value: ModelInfo[SequentialModel],
+        baseline: Optional[ModelInfo[SequentialModel]],
+    ) -> Tuple[
+        List[Tuple[Tensor, Tensor]],
+        PackedSequence,
+        Optional[Union[PackedSequence, TopKLogprobs]],
+        PackedSequence,
+        Tensor,
+    ]:
+        generated = await bootstrap.generate(policy)
+        sequences = [(context, response) for context, response, _ in generated]
+        old_gathered_logprobs = RaggedBatch.from_list(
+            logprobs for _, _, logprobs in generated
+        ).to_packed()
+        full_sequences = RaggedBatch.join(sequences).to_packed()
+
+        forwards = [(value, full_sequences)]
+        if baseline is not None:
+            forwards.append((baseline, full_sequences))
+
+        values, *baseline_logprobs = await frozen_forwards(forwards)
+        async with self.state.read_lock() as state:
+            top_k = state.policy.logprobs_top_k
+
+        _, baseline_logprobs = compact_logprobs(
+            None, next(iter(baseline_logprobs), None), top_k
+        )
+
+        values = RaggedBatch.from_packed(values)
+        advantages = values.map(
+            lambda x: x - values.first()[values.sequence_indices]
+        )
+        _, advantages = advantages.split(
+            torch.tensor([len(context) for context, _ in sequences])
+        )
+
+        return (
+            sequences,
+            old_gathered_logprobs,
+            baseline_logprobs,
+            advantages.to_packed(),
+            values.last(),
+        )
+
     async def _fit_bootstrap_loop(
         self,
         policy: TrainingControls[SequentialModel],
@@ -720,73 +835,87 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
     ) -> None:
         iteration = 0
         all_rewards = []
+        snapshot, task, staleness = None, None, 0
+        scored_baseline = baseline if regularizations else None
 
-        while True:
-            async with self.state.read_lock() as state:
-                bootstrap = state.bootstrap
+        try:
+            while True:
+                async with self.state.read_lock() as state:
+                    bootstrap = state.bootstrap
 
-            if await bootstrap.should_stop(all_rewards, iteration):
-                break
+                if await bootstrap.should_stop(all_rewards, iteration):
+                    break
 
-            sequences = await bootstrap.generate(policy.model)
-            full_sequences = pack_list(
-                [
-                    torch.vstack((context, response))
-                    for context, response in sequences
-                ]
-            )
+                if task is None:
+                    sample = await self._generate_bootstrap_sample(
+                        bootstrap, policy.model, value, scored_baseline
+                    )
+                else:
+                    sample, task = await task, None
 
-            async with value.lock:
-                with freeze(value.model) as frozen_value:
-                    values = await batched_forward(
-                        frozen_value, full_sequences, value.batch_size
+                if await bootstrap.is_pipelined():
+                    snapshot = await self._snapshot_policy(
+                        policy.model, snapshot
+                    )
+                    task = asyncio.create_task(
+                        self._generate_bootstrap_sample(
+                            bootstrap, snapshot, value, scored_baseline
+                        )
                     )
-                    values = squash_packed(values, lambda x: x.detach())
 
-            advantages = [
-                (value - value[0])[len(context) :]
-                for (context, _), value in zip(
-                    sequences, unpack_to_list(values)
+                (
+                    sequences,
+                    old_gathered_logprobs,
+                    baseline_logprobs,
+                    advantages,
+                    rewards,
+                ) = sample
+
+                reports = await self._fit_policy_loop(
+                    policy,
+                    baseline,
+                    sequences,
+                    advantages,
+                    regularizations,
+                    old_gathered_logprobs,
+                    baseline_logprobs,
                 )
-            ]
-            advantages = pack_list(advantages)
-            rewards = torch.vstack(
-                [value[-1] for value in unpack_to_list(values)]
-            )
 
-            reports = await self._fit_policy_loop(
-                policy,
-                baseline,
-                sequences,
-                advantages,
-                regularizations,
-            )
+                episode = await policy.increment_episode()
 
-            episode = await policy.increment_episode()
+                await self._process_episode_reports(reports, episode - 1)
 
-            await self._process_episode_reports(reports, episode - 1)
+                async with self.state.write_lock() as state:
+                    await state.policy.metrics.bootstrap_episode_reward.report(
+                        episode - 1, rewards.mean().item()
+                    )
+                    await state.policy.metrics.bootstrap_episode_staleness.report(
+                        episode - 1, staleness
+                    )
 
-            async with self.state.write_lock() as state:
-                await state.policy.metrics.bootstrap_episode_reward.report(
-                    episode - 1, rewards.mean().item()
+                iteration += 1
+                all_rewards.append(rewards.mean().item())
+                staleness = (
+                    len(reports.get("base", [])) if task is not None else 0
                 )
-
-            iteration += 1
-            all_rewards.append(rewards.mean().item())
+        finally:
+            if task is not None:
+                task.cancel()
 
     @staticmethod
     async def _unpack_data(
         data: Iterable[Tuple[Tensor, Tensor, Tensor, Tensor]]
     ) -> Tuple[
         List[Tuple[Tensor, Tensor]],
+        RaggedBatch,
         List[Tensor],
         List[Tensor],
-        List[Tensor],
-        List[Tensor],
+        RaggedBatch,
     ]:
         data = [x for x in data]
         if not data:
-            return [], [], [], [], []
+            empty = RaggedBatch.from_list([])
+            return [], empty, [], [], empty
 
         contexts, responses, scores, rewards = zip(*data)
 
@@ -797,17 +926,10 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
         scores = list(scores)
         rewards = list(rewards)
 
-        full_sequences = [
-            torch.vstack((context, response))
-            for context, response in sequences
-        ]
-
-        timestep_rewards = [
-            torch.vstack(
-                (torch.zeros(len(context) + len(response) - 1, 1), reward)
-            )
-            for (context, response), reward in zip(sequences, rewards)
-        ]
+        full_sequences = RaggedBatch.join(sequences)
+        timestep_rewards = RaggedBatch.from_last(
+            full_sequences.lengths, torch.vstack(rewards).float()
+        )
 
         return sequences, full_sequences, scores, rewards, timestep_rewards
 
@@ -817,10 +939,15 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
         value: TrainingControls[SequentialModel],
         baseline: ModelInfo[SequentialModel],
         data: AsyncIterable[Tuple[Tensor, Tensor, Tensor, Tensor]],
-        cache: Collection[Tuple[Tensor, Tensor, Tensor, Tensor]],
+        cache: Union[
+            CacheBatch, Collection[Tuple[Tensor, Tensor, Tensor, Tensor]]
+        ],
         gae: GeneralizedAdvantageEstimator,
         regularizations: List[PolicyRegularization],
     ) -> None:
+        if not isinstance(cache, CacheBatch):
+            cache = CacheBatch.from_data(cache)
+
         data = [x async for x in data]
         if not data:
             return
@@ -833,18 +960,11 @@ class BootstrappingEarlyStoppingPolicyOptimizationMethod(
             timestep_rewards,
         ) = await self._unpack_data(data)
 
-        (
-            _,
-            cached_full_sequences,
-            _,
-            _,
-            cached_timestep_rewards,
-        ) = await self._unpack_data(cache)
-
         reports = await self._fit_value_loop(
             value,
-            pack_list(cached_full_sequences + full_sequences),
-            pack_list(cached_timestep_rewards + timestep_rewards),
+            RaggedBatch.cat([cache.full_sequences, full_sequences]),
+            RaggedBatch.cat([cache.timestep_rewards, timestep_rewards]),
+            len(cache.full_sequences),
             gae,
         )
 
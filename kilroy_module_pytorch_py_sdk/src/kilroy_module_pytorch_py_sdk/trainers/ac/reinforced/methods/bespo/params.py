@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from kilroy_module_py_shared import SerializableModel
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.bespo.stop.policy import (
@@ -35,6 +35,12 @@ class PolicyMetricsParams(SerializableModel):
         x_axis_key="episode",
         x_axis_label="Episode",
     )
+    bootstrap_episode_staleness: MetricParams = MetricParams(
+        name="policyReinforcedBootstrapStaleness",
+        label="Policy Reinforced Bootstrap Staleness",
+        x_axis_key="episode",
+        x_axis_label="Episode",
+    )
     base_bootstrap_iteration_loss: MetricParams = MetricParams(
         name="policyReinforcedBaseIterationLoss",
         label="Policy Reinforced Base Iteration Loss",
@@ -69,6 +75,7 @@ class PolicyStopConditionParams(SerializableModel):
 class PolicyParams(SerializableModel):
     metrics: PolicyMetricsParams = PolicyMetricsParams()
     stop_condition: PolicyStopConditionParams = PolicyStopConditionParams()
+    logprobs_top_k: Optional[int] = None
 
 
 class ValueMetricsParams(SerializableModel):
@@ -94,6 +101,8 @@ class ValueStopConditionParams(SerializableModel):
 class ValueParams(SerializableModel):
     metrics: ValueMetricsParams = ValueMetricsParams()
     stop_condition: ValueStopConditionParams = ValueStopConditionParams()
+    batch_size: Optional[int] = None
+    sample_size: Optional[int] = None
 
 
 class Params(SerializableModel):
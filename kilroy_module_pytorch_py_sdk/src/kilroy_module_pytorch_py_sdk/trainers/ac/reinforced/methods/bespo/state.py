@@ -1,7 +1,11 @@
 from dataclasses import dataclass
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
-from kilroy_module_pytorch_py_sdk.metrics import ScoreMetric, LossMetric
+from kilroy_module_pytorch_py_sdk.metrics import (
+    ScoreMetric,
+    LossMetric,
+    StalenessMetric,
+)
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.bespo.bootstrap.bootstrap import (
     Bootstrap,
 )
@@ -18,6 +22,7 @@ class PolicyMetricsState:
     episode_score: ScoreMetric
     episode_reward: ScoreMetric
     bootstrap_episode_reward: ScoreMetric
+    bootstrap_episode_staleness: StalenessMetric
     base_bootstrap_iteration_loss: LossMetric
     base_bootstrap_episode_loss: LossMetric
     combined_bootstrap_iteration_loss: LossMetric
@@ -34,6 +39,7 @@ class PolicyStopConditionState:
 class PolicyState:
     metrics: PolicyMetricsState
     stop_condition: PolicyStopConditionState
+    logprobs_top_k: Optional[int]
 
 
 @dataclass
@@ -52,6 +58,8 @@ class ValueStopConditionState:
 class ValueState:
     metrics: ValueMetricsState
     stop_condition: ValueStopConditionState
+    batch_size: Optional[int]
+    sample_size: Optional[int]
 
 
 @dataclass
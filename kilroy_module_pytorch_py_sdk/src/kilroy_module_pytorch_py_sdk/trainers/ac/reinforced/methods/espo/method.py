@@ -12,11 +12,12 @@ from typing import (
     Hashable,
     Any,
     Iterable,
+    Optional,
+    Union,
 )
 
 import torch
 from torch import Tensor
-from torch.nn import MSELoss
 from torch.nn.utils.rnn import PackedSequence
 
 from kilroy_module_pytorch_py_sdk.gae import GeneralizedAdvantageEstimator
@@ -26,10 +27,14 @@ from kilroy_module_pytorch_py_sdk.metrics import (
 )
 from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
 from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
 from kilroy_module_pytorch_py_sdk.regularizations.policy import (
     PolicyRegularization,
 )
 from kilroy_module_pytorch_py_sdk.report import MetricReport, Metrics
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    CacheBatch,
+)
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.controls import (
     TrainingControls,
 )
@@ -64,13 +69,25 @@ from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.espo.stop.value
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.method import (
     Method,
 )
-from kilroy_module_pytorch_py_sdk.utils import freeze
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.parameters import (
+    PolicyLogprobsTopKParameter,
+    ValueBatchSizeParameter,
+    ValueSampleSizeParameter,
+)
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.policy import (
+    calculate_regularization,
+    compact_logprobs,
+)
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.value import (
+    fit_value_batches,
+    get_value_batches,
+)
 from kilroy_module_pytorch_py_sdk.utils import (
-    pack_list,
+    TopKLogprobs,
+    frozen_forward,
+    frozen_forwards,
     gather_logprobs,
-    batched_forward,
-    squash_packed,
-    unpack_to_list,
+    model_forward,
 )
 from kilroy_module_server_py_sdk import Metric
 from kilroy_server_py_utils import Configurable, Parameter
@@ -149,6 +166,7 @@ class EarlyStoppingPolicyOptimizationMethodBase(
             stop_condition=await cls._build_policy_stop_condition_state(
                 params.stop_condition
             ),
+            logprobs_top_k=params.logprobs_top_k,
         )
 
     @staticmethod
@@ -196,6 +214,8 @@ class EarlyStoppingPolicyOptimizationMethodBase(
             stop_condition=await cls._build_value_stop_condition_state(
                 params.stop_condition
             ),
+            batch_size=params.batch_size,
+            sample_size=params.sample_size,
         )
 
     async def _build_default_state(self) -> State:
@@ -226,6 +246,9 @@ class EarlyStoppingPolicyOptimizationMethodBase(
             state.stop_condition, directory / "stop_condition"
         )
 
+        state_dict = {"logprobs_top_k": state.logprobs_top_k}
+        await cls._save_state_dict(state_dict, directory)
+
     @classmethod
     async def _save_value_stop_condition_state(
         cls, state: ValueStopConditionState, directory: Path
@@ -247,6 +270,12 @@ class EarlyStoppingPolicyOptimizationMethodBase(
             state.stop_condition, directory / "stop_condition"
         )
 
+        state_dict = {
+            "batch_size": state.batch_size,
+            "sample_size": state.sample_size,
+        }
+        await cls._save_state_dict(state_dict, directory)
+
     @classmethod
     async def _save_state(cls, state: State, directory: Path) -> None:
         await cls._save_policy_state(state.policy, directory / "policy")
@@ -284,11 +313,16 @@ class EarlyStoppingPolicyOptimizationMethodBase(
     async def _load_policy_state(
         cls, params: PolicyParams, directory: Path
     ) -> PolicyState:
+        state_dict = await cls._load_state_dict(directory)
+
         return PolicyState(
             metrics=await cls._build_policy_metrics_state(params.metrics),
             stop_condition=await cls._load_policy_stop_condition_state(
                 params.stop_condition, directory / "stop_condition"
             ),
+            logprobs_top_k=state_dict.get(
+                "logprobs_top_k", params.logprobs_top_k
+            ),
         )
 
     @classmethod
@@ -323,11 +357,15 @@ class EarlyStoppingPolicyOptimizationMethodBase(
     async def _load_value_state(
         cls, params: ValueParams, directory: Path
     ) -> ValueState:
+        state_dict = await cls._load_state_dict(directory)
+
         return ValueState(
             metrics=await cls._build_value_metrics_state(params.metrics),
             stop_condition=await cls._load_value_stop_condition_state(
                 params.stop_condition, directory / "stop_condition"
             ),
+            batch_size=state_dict.get("batch_size", params.batch_size),
+            sample_size=state_dict.get("sample_size", params.sample_size),
         )
 
     async def _load_saved_state(self, directory: Path) -> State:
@@ -367,7 +405,10 @@ class EarlyStoppingPolicyOptimizationMethod(
     def parameters(cls) -> Set[Type[Parameter]]:
         return {
             PolicyStopConditionParameter,
+            PolicyLogprobsTopKParameter,
             ValueStopConditionParameter,
+            ValueBatchSizeParameter,
+            ValueSampleSizeParameter,
         }
 
     async def get_metrics(self) -> Collection[Metric]:
@@ -387,21 +428,16 @@ class EarlyStoppingPolicyOptimizationMethod(
     async def _get_full_sequences(
         sequences: List[Tuple[Tensor, Tensor]],
     ) -> PackedSequence:
-        return pack_list(
-            [
-                torch.vstack((context, response))
-                for context, response in sequences
-            ]
-        )
+        return RaggedBatch.join(sequences).to_packed()
 
     @staticmethod
     async def _calculate_policy_regularization(
         logprobs: PackedSequence,
-        baseline_logprobs: PackedSequence,
+        baseline_logprobs: Union[PackedSequence, TopKLogprobs],
         regularization: PolicyRegularization,
     ) -> Tuple[Tensor, MetricReport]:
-        loss = await regularization.calculate(
-            logprobs.data, baseline_logprobs.data
+        loss = await calculate_regularization(
+            regularization, logprobs, baseline_logprobs
         )
         report = MetricReport(
             values=loss.detach(),
@@ -416,7 +452,7 @@ class EarlyStoppingPolicyOptimizationMethod(
         self,
         base_losses: Tensor,
         logprobs: PackedSequence,
-        baseline_logprobs: PackedSequence,
+        baseline_logprobs: Union[PackedSequence, TopKLogprobs],
         regularizations: List[PolicyRegularization],
     ) -> Tuple[Tensor, Dict[Hashable, MetricReport]]:
         combined_loss = base_losses.mean()
@@ -498,33 +534,26 @@ class EarlyStoppingPolicyOptimizationMethod(
                     .item(),
                 )
 
-    async def _fit_value_batch(
-        self, values: PackedSequence, returns: PackedSequence
-    ) -> Dict[Hashable, MetricReport]:
-        base_losses = MSELoss(reduction="none")(values.data, returns.data)
-        base_loss = base_losses.mean()
-
-        await background(base_loss.backward)
-
-        return {"base": await self._get_base_value_report(base_loss)}
-
     async def _fit_value(
         self,
         value: TrainingControls[SequentialModel],
-        sequences: PackedSequence,
-        rewards: PackedSequence,
+        sequences: RaggedBatch,
+        rewards: RaggedBatch,
+        cached: int,
         gae: GeneralizedAdvantageEstimator,
         all_reports: Dict[Hashable, List[MetricReport]],
     ) -> Dict[Hashable, List[MetricReport]]:
-        async with value.model.lock:
-            values = await batched_forward(
-                value.model.model, sequences, value.model.batch_size
+        async with self.state.read_lock() as state:
+            batches = get_value_batches(
+                sequences.lengths,
+                cached,
+                state.value.batch_size,
+                state.value.sample_size,
             )
 
-        advantages = await gae.calculate(rewards, values)
-        returns = squash_packed(values, partial(torch.add, advantages.data))
+        loss = await fit_value_batches(value, sequences, rewards, batches, gae)
 
-        reports = await self._fit_value_batch(values, returns)
+        reports = {"base": await self._get_base_value_report(loss)}
         step = await value.step()
         all_reports = await self._process_iteration_reports(
             reports, all_reports, step - 1
@@ -535,8 +564,9 @@ class EarlyStoppingPolicyOptimizationMethod(
     async def _fit_value_loop(
         self,
         value: TrainingControls[SequentialModel],
-        sequences: PackedSequence,
-        rewards: PackedSequence,
+        sequences: RaggedBatch,
+        rewards: RaggedBatch,
+        cached: int,
         gae: GeneralizedAdvantageEstimator,
     ) -> Dict[Hashable, List[MetricReport]]:
         reports = {"base": []}
@@ -551,7 +581,7 @@ class EarlyStoppingPolicyOptimizationMethod(
                 break
 
             reports = await self._fit_value(
-                value, sequences, rewards, gae, reports
+                value, sequences, rewards, cached, gae, reports
             )
             iteration += 1
 
@@ -576,7 +606,7 @@ class EarlyStoppingPolicyOptimizationMethod(
         old_gathered_logprobs: PackedSequence,
         new_gathered_logprobs: PackedSequence,
         new_logprobs: PackedSequence,
-        baseline_logprobs: PackedSequence,
+        baseline_logprobs: Optional[Union[PackedSequence, TopKLogprobs]],
         advantages: PackedSequence,
         regularizations: List[PolicyRegularization],
     ) -> Dict[Hashable, MetricReport]:
@@ -612,33 +642,26 @@ class EarlyStoppingPolicyOptimizationMethod(
     ) -> Dict[Hashable, List[MetricReport]]:
         full_sequences = await self._get_full_sequences(sequences)
 
-        async with baseline.lock:
-            with freeze(baseline.model) as frozen_baseline:
-                baseline_logprobs = await batched_forward(
-                    frozen_baseline, full_sequences, baseline.batch_size
-                )
-                baseline_logprobs = squash_packed(
-                    baseline_logprobs, lambda x: x.detach()
-                )
-
-        async with policy.model.lock:
-            with freeze(policy.model.model) as frozen_policy:
-                old_logprobs = await batched_forward(
-                    frozen_policy, full_sequences, policy.model.batch_size
-                )
-                old_logprobs = squash_packed(
-                    old_logprobs, lambda x: x.detach()
-                )
+        forwards = [(policy.model, full_sequences)]
+        if regularizations:
+            forwards.append((baseline, full_sequences))
 
+        old_logprobs, *baseline_logprobs = await frozen_forwards(forwards)
         old_gathered_logprobs = await gather_logprobs(old_logprobs, sequences)
+        async with self.state.read_lock() as state:
+            top_k = state.policy.logprobs_top_k
+
+        old_logprobs, baseline_logprobs = compact_logprobs(
+            old_logprobs, next(iter(baseline_logprobs), None), top_k
+        )
 
         all_reports = {}
         iteration = 0
 
         while True:
             async with policy.model.lock:
-                new_logprobs = await batched_forward(
-                    policy.model.model, full_sequences, policy.model.batch_size
+                new_logprobs = await model_forward(
+                    policy.model, full_sequences
                 )
             new_gathered_logprobs = await gather_logprobs(
                 new_logprobs, sequences
@@ -680,14 +703,15 @@ class EarlyStoppingPolicyOptimizationMethod(
         data: Iterable[Tuple[Tensor, Tensor, Tensor, Tensor]]
     ) -> Tuple[
         List[Tuple[Tensor, Tensor]],
+        RaggedBatch,
         List[Tensor],
         List[Tensor],
-        List[Tensor],
-        List[Tensor],
+        RaggedBatch,
     ]:
         data = [x for x in data]
         if not data:
-            return [], [], [], [], []
+            empty = RaggedBatch.from_list([])
+            return [], empty, [], [], empty
 
         contexts, responses, scores, rewards = zip(*data)
 
@@ -698,17 +722,10 @@ class EarlyStoppingPolicyOptimizationMethod(
         scores = list(scores)
         rewards = list(rewards)
 
-        full_sequences = [
-            torch.vstack((context, response))
-            for context, response in sequences
-        ]
-
-        timestep_rewards = [
-            torch.vstack(
-                (torch.zeros(len(context) + len(response) - 1, 1), reward)
-            )
-            for (context, response), reward in zip(sequences, rewards)
-        ]
+        full_sequences = RaggedBatch.join(sequences)
+        timestep_rewards = RaggedBatch.from_last(
+            full_sequences.lengths, torch.vstack(rewards).float()
+        )
 
         return sequences, full_sequences, scores, rewards, timestep_rewards
 
@@ -718,10 +735,15 @@ class EarlyStoppingPolicyOptimizationMethod(
         value: TrainingControls[SequentialModel],
         baseline: ModelInfo[SequentialModel],
         data: AsyncIterable[Tuple[Tensor, Tensor, Tensor, Tensor]],
-        cache: Collection[Tuple[Tensor, Tensor, Tensor, Tensor]],
+        cache: Union[
+            CacheBatch, Collection[Tuple[Tensor, Tensor, Tensor, Tensor]]
+        ],
         gae: GeneralizedAdvantageEstimator,
         regularizations: List[PolicyRegularization],
     ) -> None:
+        if not isinstance(cache, CacheBatch):
+            cache = CacheBatch.from_data(cache)
+
         data = [x async for x in data]
         if not data:
             return
@@ -734,42 +756,27 @@ class EarlyStoppingPolicyOptimizationMethod(
             timestep_rewards,
         ) = await self._unpack_data(data)
 
-        (
-            _,
-            cached_full_sequences,
-            _,
-            _,
-            cached_timestep_rewards,
-        ) = await self._unpack_data(cache)
-
         reports = await self._fit_value_loop(
             value,
-            pack_list(cached_full_sequences + full_sequences),
-            pack_list(cached_timestep_rewards + timestep_rewards),
+            RaggedBatch.cat([cache.full_sequences, full_sequences]),
+            RaggedBatch.cat([cache.timestep_rewards, timestep_rewards]),
+            len(cache.full_sequences),
             gae,
         )
 
         episode = await value.increment_episode()
         await self._process_episode_reports(reports, episode - 1)
 
-        async with value.model.lock:
-            with freeze(value.model.model) as frozen_value:
-                values = await batched_forward(
-                    frozen_value,
-                    pack_list(full_sequences),
-                    value.model.batch_size,
-                )
-                values = squash_packed(values, lambda x: x.detach())
-
-        advantages = await gae.calculate(pack_list(timestep_rewards), values)
-        advantages = squash_packed(advantages, lambda x: x.detach())
-        advantages = [
-            advantage[len(context) :]
-            for (context, _), advantage in zip(
-                sequences, unpack_to_list(advantages)
-            )
-        ]
-        advantages = pack_list(advantages)
+        values = await frozen_forward(value.model, full_sequences.to_packed())
+
+        advantages = await gae.calculate(timestep_rewards.to_packed(), values)
+        advantages = RaggedBatch.from_packed(advantages).map(
+            lambda x: x.detach()
+        )
+        _, advantages = advantages.split(
+            torch.tensor([len(context) for context, _ in sequences])
+        )
+        advantages = advantages.to_packed()
 
         reports = await self._fit_policy_loop(
             policy,
@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from kilroy_module_py_shared import SerializableModel
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.espo.stop.policy import (
@@ -63,6 +63,7 @@ class PolicyStopConditionParams(SerializableModel):
 class PolicyParams(SerializableModel):
     metrics: PolicyMetricsParams = PolicyMetricsParams()
     stop_condition: PolicyStopConditionParams = PolicyStopConditionParams()
+    logprobs_top_k: Optional[int] = None
 
 
 class ValueMetricsParams(SerializableModel):
@@ -88,6 +89,8 @@ class ValueStopConditionParams(SerializableModel):
 class ValueParams(SerializableModel):
     metrics: ValueMetricsParams = ValueMetricsParams()
     stop_condition: ValueStopConditionParams = ValueStopConditionParams()
+    batch_size: Optional[int] = None
+    sample_size: Optional[int] = None
 
 
 class Params(SerializableModel):
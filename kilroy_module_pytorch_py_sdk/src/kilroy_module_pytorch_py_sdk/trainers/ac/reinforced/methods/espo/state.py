@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from kilroy_module_pytorch_py_sdk.metrics import ScoreMetric, LossMetric
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.methods.espo.stop.policy import (
@@ -30,6 +30,7 @@ class PolicyStopConditionState:
 class PolicyState:
     metrics: PolicyMetricsState
     stop_condition: PolicyStopConditionState
+    logprobs_top_k: Optional[int]
 
 
 @dataclass
@@ -48,6 +49,8 @@ class ValueStopConditionState:
 class ValueState:
     metrics: ValueMetricsState
     stop_condition: ValueStopConditionState
+    batch_size: Optional[int]
+    sample_size: Optional[int]
 
 
 @dataclass
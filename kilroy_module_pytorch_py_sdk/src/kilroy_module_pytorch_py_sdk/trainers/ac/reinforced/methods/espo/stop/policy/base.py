@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import Optional
 
 from torch.nn.utils.rnn import PackedSequence
 
@@ -15,7 +16,7 @@ class PolicyStopCondition(Categorizable, ABC):
     @abstractmethod
     async def should_stop(
         self,
-        old_logprobs: PackedSequence,
+        old_logprobs: Optional[PackedSequence],
         old_gathered_logprobs: PackedSequence,
         new_logprobs: PackedSequence,
         new_gathered_logprobs: PackedSequence,
@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from torch.nn.utils.rnn import PackedSequence
 
@@ -44,7 +44,7 @@ class DeltaPolicyStopCondition(PolicyStopCondition, Configurable[State]):
 
     async def should_stop(
         self,
-        old_logprobs: PackedSequence,
+        old_logprobs: Optional[PackedSequence],
         old_gathered_logprobs: PackedSequence,
         new_logprobs: PackedSequence,
         new_gathered_logprobs: PackedSequence,
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import AsyncIterable, Tuple, List, Collection
+from typing import AsyncIterable, Collection, Tuple, List, Union
 
 from torch import Tensor
 
@@ -9,6 +9,9 @@ from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
 from kilroy_module_pytorch_py_sdk.regularizations.policy import (
     PolicyRegularization,
 )
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    CacheBatch,
+)
 from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.controls import (
     TrainingControls,
 )
@@ -30,7 +33,9 @@ class Method(Metrizable, Categorizable, ABC):
         value: TrainingControls[SequentialModel],
         baseline: ModelInfo[SequentialModel],
         data: AsyncIterable[Tuple[Tensor, Tensor, Tensor, Tensor]],
-        cache: Collection[Tuple[Tensor, Tensor, Tensor, Tensor]],
+        cache: Union[
+            CacheBatch, Collection[Tuple[Tensor, Tensor, Tensor, Tensor]]
+        ],
         gae: GeneralizedAdvantageEstimator,
         regularizations: List[PolicyRegularization],
     ) -> None:
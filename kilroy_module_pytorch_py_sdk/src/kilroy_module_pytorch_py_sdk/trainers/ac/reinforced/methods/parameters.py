@@ -0,0 +1,100 @@
+from typing import Any, Awaitable, Callable, Dict, Generic, Optional, TypeVar
+
+from kilroy_server_py_utils import Parameter, classproperty
+
+StateType = TypeVar("StateType")
+
+
+class PolicyLogprobsTopKParameter(
+    Parameter[StateType, Optional[int]], Generic[StateType]
+):
+    @classmethod
+    async def _get(cls, state: StateType) -> Optional[int]:
+        return state.policy.logprobs_top_k
+
+    @classmethod
+    async def _set(
+        cls, state: StateType, value: Optional[int]
+    ) -> Callable[[], Awaitable]:
+        original_value = state.policy.logprobs_top_k
+
+        async def undo():
+            state.policy.logprobs_top_k = original_value
+
+        state.policy.logprobs_top_k = value
+        return undo
+
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": ["integer", "null"],
+            "minimum": 1,
+            "title": cls.pretty_name,
+            "default": None,
+        }
+
+    # noinspection PyMethodParameters
+    @classproperty
+    def pretty_name(cls) -> str:
+        return "Policy Logprobs Top-K"
+
+
+class ValueBatchSizeParameter(
+    Parameter[StateType, Optional[int]], Generic[StateType]
+):
+    @classmethod
+    async def _get(cls, state: StateType) -> Optional[int]:
+        return state.value.batch_size
+
+    @classmethod
+    async def _set(
+        cls, state: StateType, value: Optional[int]
+    ) -> Callable[[], Awaitable]:
+        original_value = state.value.batch_size
+
+        async def undo():
+            state.value.batch_size = original_value
+
+        state.value.batch_size = value
+        return undo
+
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": ["integer", "null"],
+            "minimum": 1,
+            "title": cls.pretty_name,
+            "default": None,
+        }
+
+
+class ValueSampleSizeParameter(
+    Parameter[StateType, Optional[int]], Generic[StateType]
+):
+    @classmethod
+    async def _get(cls, state: StateType) -> Optional[int]:
+        return state.value.sample_size
+
+    @classmethod
+    async def _set(
+        cls, state: StateType, value: Optional[int]
+    ) -> Callable[[], Awaitable]:
+        original_value = state.value.sample_size
+
+        async def undo():
+            state.value.sample_size = original_value
+
+        state.value.sample_size = value
+        return undo
+
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": ["integer", "null"],
+            "minimum": 0,
+            "title": cls.pretty_name,
+            "default": None,
+        }
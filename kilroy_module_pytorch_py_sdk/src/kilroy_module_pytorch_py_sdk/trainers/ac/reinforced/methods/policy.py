@@ -0,0 +1,41 @@
+from typing import Optional, Tuple, Union
+
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence
+
+from kilroy_module_pytorch_py_sdk.regularizations.policy import (
+    PolicyRegularization,
+)
+from kilroy_module_pytorch_py_sdk.utils import TopKLogprobs
+
+
+def compact_logprobs(
+    old_logprobs: Optional[PackedSequence],
+    baseline_logprobs: Optional[Union[PackedSequence, TopKLogprobs]],
+    top_k: Optional[int] = None,
+) -> Tuple[
+    Optional[PackedSequence],
+    Optional[Union[PackedSequence, TopKLogprobs]],
+]:
+    if top_k is None:
+        return old_logprobs, baseline_logprobs
+
+    if isinstance(baseline_logprobs, PackedSequence):
+        baseline_logprobs = TopKLogprobs.from_logprobs(
+            baseline_logprobs, top_k
+        )
+    return None, baseline_logprobs
+
+
+async def calculate_regularization(
+    regularization: PolicyRegularization,
+    logprobs: PackedSequence,
+    baseline_logprobs: Union[PackedSequence, TopKLogprobs],
+) -> Tensor:
+    if isinstance(baseline_logprobs, TopKLogprobs):
+        return await regularization.calculate_top_k(
+            logprobs.data, baseline_logprobs
+        )
+    return await regularization.calculate(
+        logprobs.data, baseline_logprobs.data
+    )
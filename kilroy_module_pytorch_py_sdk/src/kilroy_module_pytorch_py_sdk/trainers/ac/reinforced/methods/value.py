@@ -0,0 +1,70 @@
+from functools import partial
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+from torch.nn import MSELoss
+from torch.nn.utils.rnn import PackedSequence
+
+from kilroy_module_pytorch_py_sdk.gae import GeneralizedAdvantageEstimator
+from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.controls import (
+    TrainingControls,
+)
+from kilroy_module_pytorch_py_sdk.utils import model_forward, squash_packed
+from kilroy_server_py_utils.utils import background
+
+
+def get_value_batches(
+    lengths: Tensor,
+    cached: int,
+    batch_size: Optional[int] = None,
+    sample_size: Optional[int] = None,
+) -> List[Tensor]:
+    indices = torch.arange(len(lengths))
+    if sample_size is not None and sample_size < cached:
+        sampled = torch.randperm(cached)[:sample_size].sort().values
+        indices = torch.cat((sampled, indices[cached:]))
+
+    if batch_size is None:
+        return [indices]
+    return list(indices.split(batch_size))
+
+
+async def fit_value_batch(
+    values: PackedSequence, returns: PackedSequence, weight: float
+) -> Tensor:
+    base_losses = MSELoss(reduction="none")(values.data, returns.data)
+    base_loss = base_losses.mean() * weight
+
+    await background(base_loss.backward)
+
+    return base_loss.detach()
+
+
+async def fit_value_batches(
+    value: TrainingControls[SequentialModel],
+    sequences: RaggedBatch,
+    rewards: RaggedBatch,
+    batches: List[Tensor],
+    gae: GeneralizedAdvantageEstimator,
+) -> Tensor:
+    tokens = sum(int(sequences.lengths[batch].sum()) for batch in batches)
+    loss = torch.tensor(0.0)
+
+    for batch in batches:
+        batch_rewards = rewards[batch].to_packed()
+        async with value.model.lock:
+            values = await model_forward(
+                value.model, sequences[batch].to_packed()
+            )
+
+        advantages = await gae.calculate(batch_rewards, values)
+        returns = squash_packed(values, partial(torch.add, advantages.data))
+
+        loss = loss + await fit_value_batch(
+            values, returns, len(values.data) / tokens
+        )
+
+    return loss
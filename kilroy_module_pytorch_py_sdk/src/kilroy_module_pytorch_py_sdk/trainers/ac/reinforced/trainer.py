@@ -563,7 +563,7 @@ class ReinforcedTrainer(ReinforcedTrainerBase):
             increment_episode=__increment_value_episode,
         )
 
-        cached = await cache.get()
+        cached = await cache.get_batch()
 
         async with CachingAsyncIterable(data) as data:
             await method.fit(
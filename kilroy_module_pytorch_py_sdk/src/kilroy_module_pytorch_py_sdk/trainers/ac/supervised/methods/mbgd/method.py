@@ -11,6 +11,7 @@ from typing import (
     Type,
     Dict,
     Hashable,
+    Optional,
 )
 
 import torch
@@ -22,7 +23,9 @@ from kilroy_module_pytorch_py_sdk.losses.policy import PolicyLoss
 from kilroy_module_pytorch_py_sdk.losses.value import ValueLoss
 from kilroy_module_pytorch_py_sdk.metrics import LossMetric
 from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
+from kilroy_module_pytorch_py_sdk.models.cache import ForwardCache
 from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
 from kilroy_module_pytorch_py_sdk.regularizations.policy import (
     PolicyRegularization,
 )
@@ -33,6 +36,7 @@ from kilroy_module_pytorch_py_sdk.trainers.ac.supervised.controls import (
 from kilroy_module_pytorch_py_sdk.trainers.ac.supervised.methods.mbgd.parameters import (
     PolicyLossParameter,
     BatchSizeParameter,
+    BaselineCacheSizeParameter,
     ValueLossParameter,
 )
 from kilroy_module_pytorch_py_sdk.trainers.ac.supervised.methods.mbgd.params import (
@@ -58,12 +62,8 @@ from kilroy_module_pytorch_py_sdk.trainers.ac.supervised.methods.method import (
 )
 from kilroy_module_pytorch_py_sdk.utils import (
     CachingAsyncIterable,
-    pack_list,
-    truncate_last_element,
-    truncate_first_element,
-    batched_forward,
+    model_forward,
     squash_packed,
-    unpack_to_list,
 )
 from kilroy_module_pytorch_py_sdk.utils import freeze
 from kilroy_module_server_py_sdk import Metric
@@ -166,6 +166,7 @@ class MiniBatchGradientDescentMethodBase(Method, Configurable[State], ABC):
             policy=await self._build_policy_state(params.policy),
             value=await self._build_value_state(params.value),
             batch_size=params.batch_size,
+            baseline_cache_size=params.baseline_cache_size,
         )
 
     @classmethod
@@ -205,7 +206,10 @@ class MiniBatchGradientDescentMethodBase(Method, Configurable[State], ABC):
         await cls._save_policy_state(state.policy, directory / "policy")
         await cls._save_value_state(state.value, directory / "value")
 
-        state_dict = {"batch_size": state.batch_size}
+        state_dict = {
+            "batch_size": state.batch_size,
+            "baseline_cache_size": state.baseline_cache_size,
+        }
         await cls._save_state_dict(state_dict, directory)
 
     @classmethod
@@ -280,6 +284,9 @@ class MiniBatchGradientDescentMethodBase(Method, Configurable[State], ABC):
                 params.value, directory / "value"
             ),
             batch_size=state_dict.get("batch_size", params.batch_size),
+            baseline_cache_size=state_dict.get(
+                "baseline_cache_size", params.baseline_cache_size
+            ),
         )
 
     async def cleanup(self) -> None:
@@ -305,6 +312,7 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
             PolicyLossParameter,
             ValueLossParameter,
             BatchSizeParameter,
+            BaselineCacheSizeParameter,
         }
 
     async def get_metrics(self) -> Collection[Metric]:
@@ -322,13 +330,10 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
     def _prepare_input_target(
         sequences: List[Tuple[Tensor, Tensor]]
     ) -> Tuple[PackedSequence, PackedSequence]:
-        full_sequences = [
-            torch.vstack((context, response))
-            for context, response in sequences
-        ]
-        input = pack_list(truncate_last_element(full_sequences))
-        target = pack_list(truncate_first_element(full_sequences))
-        return input, target
+        full_sequences = RaggedBatch.join(sequences)
+        input, _ = full_sequences.split(full_sequences.lengths - 1)
+        _, target = full_sequences.split(1)
+        return input.to_packed(), target.to_packed()
 
     @staticmethod
     async def _calculate_policy_regularization(
@@ -355,15 +360,20 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         logprobs: PackedSequence,
         baseline: ModelInfo[SequentialModel],
         regularizations: List[PolicyRegularization],
+        cache: Optional[ForwardCache] = None,
     ) -> Tuple[Tensor, Dict[Hashable, MetricReport]]:
         combined_loss = base_losses.mean()
         reports = {}
 
-        async with baseline.lock:
-            with freeze(baseline.model) as frozen_baseline:
-                baseline_logprobs = await batched_forward(
-                    frozen_baseline, input, baseline.batch_size
-                )
+        if cache is not None:
+            baseline_logprobs = await cache.forward(baseline, input)
+        else:
+            async with baseline.lock:
+                with freeze(baseline.model) as frozen_baseline:
+                    baseline_logprobs = await model_forward(
+                        baseline, input, frozen_baseline
+                    )
+
         for regularization in regularizations:
             loss, report = await self._calculate_policy_regularization(
                 logprobs, baseline_logprobs, regularization
@@ -403,13 +413,12 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         sequences: List[Tuple[Tensor, Tensor]],
         loss: PolicyLoss,
         regularizations: List[PolicyRegularization],
+        cache: Optional[ForwardCache] = None,
     ) -> Dict[Hashable, MetricReport]:
         input, target = self._prepare_input_target(sequences)
 
         async with policy.lock:
-            logprobs = await batched_forward(
-                policy.model, input, policy.batch_size
-            )
+            logprobs = await model_forward(policy, input)
 
         base_losses = await loss.calculate(logprobs.data, target.data)
         base_loss = base_losses.mean()
@@ -418,7 +427,12 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
 
         if regularizations:
             final_loss, regularization_reports = await self._regularize_policy(
-                base_losses, input, logprobs, baseline, regularizations
+                base_losses,
+                input,
+                logprobs,
+                baseline,
+                regularizations,
+                cache,
             )
             reports = {**reports, **regularization_reports}
 
@@ -428,27 +442,13 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         await background(final_loss.backward)
         return reports
 
-    @staticmethod
-    async def _get_full_sequences(
-        sequences: List[Tuple[Tensor, Tensor]]
-    ) -> PackedSequence:
-        return pack_list(
-            [
-                torch.vstack((context, response))
-                for context, response in sequences
-            ]
-        )
-
     @staticmethod
     async def _get_timestep_rewards(
-        sequences: PackedSequence,
+        sequences: RaggedBatch,
         rewards: List[Tensor],
     ) -> PackedSequence:
-        rewards = [
-            torch.vstack((torch.zeros(len(sequence) - 1, 1), reward))
-            for sequence, reward in zip(unpack_to_list(sequences), rewards)
-        ]
-        return pack_list(rewards)
+        rewards = torch.vstack(rewards).float()
+        return RaggedBatch.from_last(sequences.lengths, rewards).to_packed()
 
     async def _get_base_value_report(self, losses: Tensor) -> MetricReport:
         async with self.state.read_lock() as state:
@@ -468,13 +468,11 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         loss: ValueLoss,
         gae: GeneralizedAdvantageEstimator,
     ) -> Dict[Hashable, MetricReport]:
-        full_sequences = await self._get_full_sequences(sequences)
+        full_sequences = RaggedBatch.join(sequences)
         rewards = await self._get_timestep_rewards(full_sequences, rewards)
 
         async with value.lock:
-            values = await batched_forward(
-                value.model, full_sequences, value.batch_size
-            )
+            values = await model_forward(value, full_sequences.to_packed())
 
         advantages = await gae.calculate(rewards, values)
         returns = squash_packed(values, partial(torch.add, advantages.data))
@@ -527,6 +525,11 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         data: AsyncIterable[Tuple[Tensor, Tensor, Tensor, Tensor]],
         regularizations: List[PolicyRegularization],
     ) -> None:
+        async with self.state.read_lock() as state:
+            cache_size = state.baseline_cache_size
+
+        cache = ForwardCache(cache_size) if cache_size > 0 else None
+
         while True:
             all_reports = {}
 
@@ -542,7 +545,12 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
                     loss = state.policy.loss.loss
 
                 reports = await self._fit_policy_batch(
-                    policy.model, baseline, batch, loss, regularizations
+                    policy.model,
+                    baseline,
+                    batch,
+                    loss,
+                    regularizations,
+                    cache,
                 )
                 step = await policy.step()
                 all_reports = await self._process_step_reports(
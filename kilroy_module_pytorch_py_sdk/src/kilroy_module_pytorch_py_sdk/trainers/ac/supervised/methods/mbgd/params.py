@@ -80,3 +80,4 @@ class Params(SerializableModel):
     policy: PolicyParams = PolicyParams()
     value: ValueParams = ValueParams()
     batch_size: int = 32
+    baseline_cache_size: int = 2**26
@@ -49,3 +49,4 @@ class State:
     policy: PolicyState
     value: ValueState
     batch_size: int
+    baseline_cache_size: int
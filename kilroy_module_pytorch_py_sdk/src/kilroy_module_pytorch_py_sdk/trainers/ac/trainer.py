@@ -43,6 +43,9 @@ from kilroy_server_py_utils import (
     Parameter,
     classproperty,
 )
+from kilroy_server_py_utils.utils import batchify
+
+SCALING_CHUNK_SIZE = 256
 
 
 class ActorCriticTrainerBase(Trainer, Configurable[State], ABC):
@@ -277,16 +280,22 @@ class ActorCriticTrainer(ActorCriticTrainerBase):
         self,
         data: AsyncIterable[Tuple[Tensor, Tensor, Tensor]],
     ) -> AsyncIterable[Tuple[Tensor, Tensor, Tensor, Tensor]]:
-        async for context, response, score in data:
+        async for chunk in batchify(data, SCALING_CHUNK_SIZE):
+            chunk = [x async for x in chunk]
+            scores = [score for _, _, score in chunk]
+
             async with self.state.read_lock() as state:
                 scaler = state.scaler.scaler
             if scaler is not None:
-                reward = await scaler.scale(score.item())
-                reward = torch.tensor(reward).float()
+                rewards = await scaler.scale_batch(
+                    [score.item() for score in scores]
+                )
+                rewards = [torch.tensor(reward).float() for reward in rewards]
             else:
-                reward = score
+                rewards = scores
 
-            yield context, response, score, reward
+            for (context, response, score), reward in zip(chunk, rewards):
+                yield context, response, score, reward
 
     async def fit_supervised(
         self, data: AsyncIterable[Tuple[Tensor, Tensor, Tensor]]
@@ -16,6 +16,7 @@ from torch.nn.utils.rnn import PackedSequence
 from kilroy_module_pytorch_py_sdk import SequentialModel
 from kilroy_module_pytorch_py_sdk.metrics import ScoreMetric, LossMetric
 from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
 from kilroy_module_pytorch_py_sdk.regularizations.policy import (
     PolicyRegularization,
 )
@@ -38,10 +39,8 @@ from kilroy_module_pytorch_py_sdk.trainers.vanilla.reinforced.methods.reinforce.
 )
 from kilroy_module_pytorch_py_sdk.utils import freeze
 from kilroy_module_pytorch_py_sdk.utils import (
-    pack_list,
     gather_logprobs,
-    unpack_to_list,
-    batched_forward,
+    model_forward,
 )
 from kilroy_module_server_py_sdk import Metric
 from kilroy_server_py_utils import Configurable
@@ -124,12 +123,7 @@ class ReinforceMethod(ReinforceMethodBase):
     async def _get_full_sequences(
         sequences: List[Tuple[Tensor, Tensor]],
     ) -> PackedSequence:
-        return pack_list(
-            [
-                torch.vstack((context, response))
-                for context, response in sequences
-            ]
-        )
+        return RaggedBatch.join(sequences).to_packed()
 
     @staticmethod
     async def _calculate_regularization(
@@ -162,8 +156,8 @@ class ReinforceMethod(ReinforceMethodBase):
 
         async with baseline.lock:
             with freeze(baseline.model) as frozen_baseline:
-                baseline_logprobs = await batched_forward(
-                    frozen_baseline, input, baseline.batch_size
+                baseline_logprobs = await model_forward(
+                    baseline, input, frozen_baseline
                 )
         for regularization in regularizations:
             loss, report = await self._calculate_regularization(
@@ -200,9 +194,7 @@ class ReinforceMethod(ReinforceMethodBase):
         rewards: Tensor,
     ) -> Tensor:
         gathered_logprobs = await gather_logprobs(logprobs, sequences)
-        summed_logprobs = torch.vstack(
-            [lp.sum() for lp in unpack_to_list(gathered_logprobs)]
-        )
+        summed_logprobs = RaggedBatch.from_packed(gathered_logprobs).sum()
 
         return -(summed_logprobs * rewards)
 
@@ -217,9 +209,7 @@ class ReinforceMethod(ReinforceMethodBase):
         full_sequences = await self._get_full_sequences(sequences)
 
         async with policy.lock:
-            logprobs = await batched_forward(
-                policy.model, full_sequences, policy.batch_size
-            )
+            logprobs = await model_forward(policy, full_sequences)
 
         base_losses = await self._calculate_base_losses(
             logprobs, sequences, rewards
@@ -10,6 +10,7 @@ from typing import (
     Type,
     Hashable,
     Dict,
+    Optional,
 )
 
 import torch
@@ -19,7 +20,9 @@ from torch.nn.utils.rnn import PackedSequence
 from kilroy_module_pytorch_py_sdk.losses.policy import PolicyLoss
 from kilroy_module_pytorch_py_sdk.metrics import LossMetric
 from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
+from kilroy_module_pytorch_py_sdk.models.cache import ForwardCache
 from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
 from kilroy_module_pytorch_py_sdk.regularizations.policy import (
     PolicyRegularization,
 )
@@ -30,6 +33,7 @@ from kilroy_module_pytorch_py_sdk.trainers.vanilla.supervised.controls import (
 from kilroy_module_pytorch_py_sdk.trainers.vanilla.supervised.methods.mbgd.parameters import (
     PolicyLossParameter,
     BatchSizeParameter,
+    BaselineCacheSizeParameter,
 )
 from kilroy_module_pytorch_py_sdk.trainers.vanilla.supervised.methods.mbgd.params import (
     PolicyParams,
@@ -48,10 +52,7 @@ from kilroy_module_pytorch_py_sdk.trainers.vanilla.supervised.methods.method imp
 )
 from kilroy_module_pytorch_py_sdk.utils import (
     CachingAsyncIterable,
-    pack_list,
-    truncate_last_element,
-    truncate_first_element,
-    batched_forward,
+    model_forward,
 )
 from kilroy_module_pytorch_py_sdk.utils import freeze
 from kilroy_module_server_py_sdk import Metric
@@ -115,6 +116,7 @@ class MiniBatchGradientDescentMethodBase(Method, Configurable[State], ABC):
         return State(
             policy=await self._build_policy_state(params.policy),
             batch_size=params.batch_size,
+            baseline_cache_size=params.baseline_cache_size,
         )
 
     @classmethod
@@ -137,7 +139,10 @@ class MiniBatchGradientDescentMethodBase(Method, Configurable[State], ABC):
     async def _save_state(cls, state: State, directory: Path) -> None:
         await cls._save_policy_state(state.policy, directory / "policy")
 
-        state_dict = {"batch_size": state.batch_size}
+        state_dict = {
+            "batch_size": state.batch_size,
+            "baseline_cache_size": state.baseline_cache_size,
+        }
         await cls._save_state_dict(state_dict, directory)
 
     @classmethod
@@ -179,6 +184,9 @@ class MiniBatchGradientDescentMethodBase(Method, Configurable[State], ABC):
                 params.policy, directory / "policy"
             ),
             batch_size=state_dict.get("batch_size", params.batch_size),
+            baseline_cache_size=state_dict.get(
+                "baseline_cache_size", params.baseline_cache_size
+            ),
         )
 
     async def cleanup(self) -> None:
@@ -199,6 +207,7 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         return {
             PolicyLossParameter,
             BatchSizeParameter,
+            BaselineCacheSizeParameter,
         }
 
     async def get_metrics(self) -> Collection[Metric]:
@@ -214,13 +223,10 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
     def _prepare_input_target(
         sequences: List[Tuple[Tensor, Tensor]]
     ) -> Tuple[PackedSequence, PackedSequence]:
-        full_sequences = [
-            torch.vstack((context, response))
-            for context, response in sequences
-        ]
-        input = pack_list(truncate_last_element(full_sequences))
-        target = pack_list(truncate_first_element(full_sequences))
-        return input, target
+        full_sequences = RaggedBatch.join(sequences)
+        input, _ = full_sequences.split(full_sequences.lengths - 1)
+        _, target = full_sequences.split(1)
+        return input.to_packed(), target.to_packed()
 
     @staticmethod
     async def _calculate_regularization(
@@ -247,15 +253,20 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         logprobs: PackedSequence,
         baseline: ModelInfo[SequentialModel],
         regularizations: List[PolicyRegularization],
+        cache: Optional[ForwardCache] = None,
     ) -> Tuple[Tensor, Dict[Hashable, MetricReport]]:
         combined_loss = base_losses.mean()
         reports = {}
 
-        async with baseline.lock:
-            with freeze(baseline.model) as frozen_baseline:
-                baseline_logprobs = await batched_forward(
-                    frozen_baseline, input, baseline.batch_size
-                )
+        if cache is not None:
+            baseline_logprobs = await cache.forward(baseline, input)
+        else:
+            async with baseline.lock:
+                with freeze(baseline.model) as frozen_baseline:
+                    baseline_logprobs = await model_forward(
+                        baseline, input, frozen_baseline
+                    )
+
         for regularization in regularizations:
             loss, report = await self._calculate_regularization(
                 logprobs, baseline_logprobs, regularization
@@ -293,13 +304,12 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         sequences: List[Tuple[Tensor, Tensor]],
         loss: PolicyLoss,
         regularizations: List[PolicyRegularization],
+        cache: Optional[ForwardCache] = None,
     ) -> Dict[Hashable, MetricReport]:
         input, target = self._prepare_input_target(sequences)
 
         async with policy.lock:
-            logprobs = await batched_forward(
-                policy.model, input, policy.batch_size
-            )
+            logprobs = await model_forward(policy, input)
 
         base_losses = await loss.calculate(logprobs.data, target.data)
         base_loss = base_losses.mean()
@@ -308,7 +318,12 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
 
         if regularizations:
             final_loss, regularization_reports = await self._regularize(
-                base_losses, input, logprobs, baseline, regularizations
+                base_losses,
+                input,
+                logprobs,
+                baseline,
+                regularizations,
+                cache,
             )
             reports = {**reports, **regularization_reports}
 
@@ -323,6 +338,11 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
         data: AsyncIterable[Tuple[Tensor, Tensor, Tensor, Tensor]],
         regularizations: List[PolicyRegularization],
     ) -> None:
+        async with self.state.read_lock() as state:
+            cache_size = state.baseline_cache_size
+
+        cache = ForwardCache(cache_size) if cache_size > 0 else None
+
         async with CachingAsyncIterable(data) as data:
             while True:
                 all_reports = {}
@@ -339,7 +359,12 @@ class MiniBatchGradientDescentMethod(MiniBatchGradientDescentMethodBase):
                         loss = state.policy.loss.loss
 
                     reports = await self._fit_policy_batch(
-                        policy.model, baseline, batch, loss, regularizations
+                        policy.model,
+                        baseline,
+                        batch,
+                        loss,
+                        regularizations,
+                        cache,
                     )
                     step = await policy.step()
 
@@ -43,3 +43,15 @@ class BatchSizeParameter(Parameter[State, int]):
             "title": cls.pretty_name,
             "default": 32,
         }
+
+
+class BaselineCacheSizeParameter(Parameter[State, int]):
+    # noinspection PyMethodParameters
+    @classproperty
+    def schema(cls) -> Dict[str, Any]:
+        return {
+            "type": "integer",
+            "minimum": 0,
+            "title": cls.pretty_name,
+            "default": 2**26,
+        }
@@ -53,3 +53,4 @@ class PolicyParams(SerializableModel):
 class Params(SerializableModel):
     policy: PolicyParams = PolicyParams()
     batch_size: int = 32
+    baseline_cache_size: int = 2**26
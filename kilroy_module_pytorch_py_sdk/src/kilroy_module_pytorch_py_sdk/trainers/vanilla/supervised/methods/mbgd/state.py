@@ -29,3 +29,4 @@ class PolicyState:
 class State:
     policy: PolicyState
     batch_size: int
+    baseline_cache_size: int
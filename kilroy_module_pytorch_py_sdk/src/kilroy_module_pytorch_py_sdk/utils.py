@@ -1,10 +1,16 @@
+import asyncio
 from asyncio import Lock
-from contextlib import contextmanager
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, replace
 from types import TracebackType
 from typing import (
+    TYPE_CHECKING,
+    Callable,
     AsyncIterator,
     Iterable,
     List,
+    Sequence,
     Optional,
     Tuple,
     TypeVar,
@@ -18,7 +24,7 @@ from uuid import uuid4
 import torch
 from aiostream.aiter_utils import AsyncIteratorContext
 from aiostream.stream import iterate
-from kilroy_server_py_utils.utils import batchify, background
+from kilroy_server_py_utils.utils import background
 from torch import Tensor, nn
 from torch.nn.utils.rnn import (
     PackedSequence,
@@ -29,6 +35,9 @@ from torch.nn.utils.rnn import (
 
 from kilroy_module_pytorch_py_sdk.models.abc import SequentialModel
 
+if TYPE_CHECKING:
+    from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+
 T = TypeVar("T")
 
 
@@ -106,31 +115,301 @@ def freeze(model: nn.Module) -> AsyncIterator[nn.Module]:
             param.requires_grad = original_state[name]
 
 
+def get_batch_ranges(
+    lengths: Iterable[int],
+    batch_size: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+) -> List[Tuple[int, int]]:
+    ranges, start, end, longest = [], 0, 0, 0
+
+    for i, length in enumerate(lengths):
+        longest = max(longest, length)
+        size = i - start + 1
+        if size > 1 and (
+            (batch_size is not None and size > batch_size)
+            or (max_tokens is not None and size * longest > max_tokens)
+        ):
+            ranges.append((start, i))
+            start, longest = i, length
+        end = i + 1
+
+    if end > start:
+        ranges.append((start, end))
+    return ranges
+
+
+def get_packed_lengths(x: PackedSequence) -> Tensor:
+    counts = torch.bincount(x.batch_sizes, minlength=x.batch_sizes[0] + 1)
+    lengths = counts.flip(0).cumsum(0).flip(0)[1:]
+    if x.unsorted_indices is None:
+        return lengths
+    return lengths[x.unsorted_indices.cpu()]
+
+
+def get_packed_positions(
+    x: PackedSequence, indices: Tensor
+) -> Tuple[Tensor, Tensor, Tensor]:
+    ranks = indices
+    if x.unsorted_indices is not None:
+        ranks = x.unsorted_indices.cpu()[indices]
+    ranks, order = ranks.sort()
+    lengths = (x.batch_sizes.unsqueeze(-1) > ranks).sum(0)
+    offsets = x.batch_sizes.cumsum(0) - x.batch_sizes
+    mask = torch.arange(lengths[0]).unsqueeze(-1) < lengths
+    positions = (offsets[: lengths[0]].unsqueeze(-1) + ranks)[mask]
+    return positions, mask.sum(-1), order
+
+
+def select_packed(
+    x: PackedSequence, indices: Tensor
+) -> Tuple[Tensor, PackedSequence]:
+    positions, batch_sizes, order = get_packed_positions(x, indices)
+    positions = positions.to(x.data.device)
+    order = order.to(x.data.device)
+    return positions, PackedSequence(
+        x.data[positions], batch_sizes, order, order.argsort()
+    )
+
+
+@dataclass
+class PaddingStats:
+    forwards: int = 0
+    tokens: int = 0
+    padded: int = 0
+
+    @property
+    def efficiency(self) -> float:
+        return self.tokens / self.padded if self.padded > 0 else 1.0
+
+    def update(
+        self, lengths: List[int], ranges: Iterable[Tuple[int, int]]
+    ) -> None:
+        self.forwards += 1
+        self.tokens += sum(lengths)
+        self.padded += sum(
+            (end - start) * max(lengths[start:end]) for start, end in ranges
+        )
+
+    def __sub__(self, other: "PaddingStats") -> "PaddingStats":
+        return PaddingStats(
+            forwards=self.forwards - other.forwards,
+            tokens=self.tokens - other.tokens,
+            padded=self.padded - other.padded,
+        )
+
+
+def with_num_threads(
+    fn: Callable[..., T], threads: Optional[int] = None
+) -> Callable[..., T]:
+    if threads is None:
+        return fn
+
+    def wrapped(*args, **kwargs) -> T:
+        previous = torch.get_num_threads()
+        torch.set_num_threads(threads)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            torch.set_num_threads(previous)
+
+    return wrapped
+
+
+async def forward_concurrently(
+    executor: Executor,
+    model: SequentialModel,
+    inputs: List[PackedSequence],
+    workers: int,
+    threads: Optional[int] = None,
+) -> List[PackedSequence]:
+    threads = threads if threads is not None else torch.get_num_threads()
+    forward = with_num_threads(model, max(1, threads // workers))
+    loop = asyncio.get_running_loop()
+    return list(
+        await asyncio.gather(
+            *(loop.run_in_executor(executor, forward, x) for x in inputs)
+        )
+    )
+
+
 async def batched_forward(
     model: SequentialModel,
     input: PackedSequence,
     batch_size: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    bucket: bool = False,
+    stats: Optional[PaddingStats] = None,
+    workers: int = 1,
+    threads: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> PackedSequence:
+    lengths = get_packed_lengths(input)
+    indices = torch.arange(len(lengths))
+    if bucket and input.sorted_indices is not None:
+        indices = input.sorted_indices.cpu()
+    lengths = lengths[indices].tolist()
+
+    ranges = get_batch_ranges(lengths, batch_size, max_tokens)
+    if stats is not None:
+        stats.update(lengths, ranges)
+    if len(ranges) == 1:
+        return await background(with_num_threads(model, threads), input)
+
+    positions, batches = [], []
+    for start, end in ranges:
+        batch_positions, batch = select_packed(input, indices[start:end])
+        positions.append(batch_positions)
+        batches.append(batch)
+
+    if (
+        executor is not None
+        and workers > 1
+        and not any(p.requires_grad for p in model.parameters())
+    ):
+        batches = await forward_concurrently(
+            executor, model, batches, workers, threads
+        )
+    else:
+        forward = with_num_threads(model, threads)
+        batches = [await background(forward, batch) for batch in batches]
+
+    output = batches[0].data.new_empty(
+        (len(input.data), *batches[0].data.shape[1:])
+    )
+    for batch_positions, batch in zip(positions, batches):
+        output[batch_positions] = batch.data
+
+    return PackedSequence(
+        output, input.batch_sizes, input.sorted_indices, input.unsorted_indices
+    )
+
+
+async def model_forward(
+    info: "ModelInfo[SequentialModel]",
+    input: PackedSequence,
+    model: Optional[SequentialModel] = None,
+    threads: Optional[int] = None,
+) -> PackedSequence:
+    return await batched_forward(
+        model if model is not None else info.model,
+        input,
+        info.batch_size,
+        max_tokens=info.max_tokens,
+        bucket=info.bucket,
+        stats=info.padding,
+        workers=info.workers,
+        threads=threads,
+        executor=info.executor,
+    )
+
+
+@asynccontextmanager
+async def report_padding(
+    info: "ModelInfo[SequentialModel]",
+) -> AsyncIterator[None]:
+    start = replace(info.padding)
+    try:
+        yield
+    finally:
+        stats = info.padding - start
+        if info.padding_metric is not None and stats.forwards > 0:
+            await info.padding_metric.report(
+                info.padding.forwards - 1, stats.efficiency
+            )
+
+
+async def frozen_forward(
+    info: "ModelInfo[SequentialModel]",
+    input: PackedSequence,
+    threads: Optional[int] = None,
+) -> PackedSequence:
+    async with info.lock:
+        with freeze(info.model) as frozen_model:
+            output = await model_forward(info, input, frozen_model, threads)
+    return squash_packed(output, lambda x: x.detach())
+
+
+async def frozen_forwards(
+    forwards: Sequence[Tuple["ModelInfo[SequentialModel]", PackedSequence]]
+) -> List[PackedSequence]:
+    if len({id(info.model) for info, _ in forwards}) < len(forwards):
+        return [await frozen_forward(info, input) for info, input in forwards]
+
+    threads = max(1, torch.get_num_threads() // max(len(forwards), 1))
+    return list(
+        await asyncio.gather(
+            *(frozen_forward(info, input, threads) for info, input in forwards)
+        )
+    )
+
+
+def gather_packed(
+    x: PackedSequence, starts: Tensor, indices: List[Tensor]
 ) -> PackedSequence:
-    sequences = unpack_to_list(input)
-    batches = [
-        [x async for x in batch]
-        async for batch in batchify(sequences, batch_size)
+    lengths = torch.tensor([len(index) for index in indices])
+    offsets = lengths.cumsum(0) - lengths
+    lengths, sorted_indices = torch.sort(lengths, descending=True)
+    steps = torch.arange(lengths[0]).unsqueeze(-1)
+    mask = steps < lengths
+
+    ranks = torch.arange(len(starts))
+    if x.unsorted_indices is not None:
+        ranks = x.unsorted_indices.cpu()
+    starts = starts[sorted_indices]
+    input_offsets = x.batch_sizes.cumsum(0) - x.batch_sizes
+
+    rows = input_offsets[(starts + steps)[mask]]
+    rows = rows + ranks[sorted_indices].expand_as(mask)[mask]
+    columns = torch.cat([index.flatten() for index in indices]).cpu()[
+        (offsets[sorted_indices] + steps)[mask]
     ]
-    inputs = [pack_list(batch) for batch in batches]
-    outputs = [await background(model, input) for input in inputs]
-    return pack_list([x for batch in outputs for x in unpack_to_list(batch)])
+
+    device = x.data.device
+    sorted_indices = sorted_indices.to(device)
+    return PackedSequence(
+        x.data[rows.to(device), columns.to(device)].unsqueeze(-1),
+        mask.sum(-1),
+        sorted_indices,
+        sorted_indices.argsort(),
+    )
 
 
 async def gather_logprobs(
     logprobs: PackedSequence,
     sequences: List[Tuple[Tensor, Tensor]],
 ) -> PackedSequence:
-    logprobs = unpack_to_list(logprobs)
-    logprobs = [
-        logprobs[(len(context) - 1) : -1].gather(1, response)
-        for logprobs, (context, response) in zip(logprobs, sequences)
-    ]
-    return pack_list(logprobs)
+    starts = torch.tensor([len(context) - 1 for context, _ in sequences])
+    return gather_packed(
+        logprobs, starts, [response for _, response in sequences]
+    )
+
+
+@dataclass
+class TopKLogprobs:
+    values: PackedSequence
+    indices: Tensor
+    n_classes: int
+
+    @classmethod
+    def from_logprobs(
+        cls, x: PackedSequence, k: int, dtype: torch.dtype = torch.float16
+    ) -> "TopKLogprobs":
+        values, indices = x.data.topk(min(k, x.data.shape[-1]), dim=-1)
+        return cls(
+            values=squash_packed(x, lambda _: values.to(dtype)),
+            indices=indices.int(),
+            n_classes=x.data.shape[-1],
+        )
+
+    @staticmethod
+    def _with_rest(x: Tensor) -> Tensor:
+        covered = x.logsumexp(-1, keepdim=True).clamp(max=-1e-6)
+        return torch.cat([x, torch.log(-torch.expm1(covered))], dim=-1)
+
+    def coarsen(self, logprobs: Tensor) -> Tuple[Tensor, Tensor]:
+        support = logprobs.gather(-1, self.indices.long())
+        values = self.values.data.to(logprobs.dtype)
+        return self._with_rest(support), self._with_rest(values)
 
 
 class CachingAsyncIterable(AsyncIterable[T], Generic[T]):
@@ -0,0 +1,108 @@
+import re
+from itertools import product
+from typing import List
+
+import pytest
+import torch
+
+from kilroy_module_pytorch_py_sdk.generator.automaton import TokenAutomaton
+from kilroy_module_pytorch_py_sdk.generator.params import Params
+from kilroy_module_pytorch_py_sdk.tokenizer import Tokenizer
+
+PIECES = ["", "", "a", "b", "c", " ", "1", "ab", "ba", "c1", ".", "!", "\n"]
+
+
+class PieceTokenizer(Tokenizer):
+    def encode(self, text: str) -> List[int]:
+        raise NotImplementedError
+
+    def decode(self, indices: List[int]) -> str:
+        return "".join(PIECES[index] for index in indices)
+
+    @property
+    def start_token(self) -> int:
+        return 0
+
+    @property
+    def end_token(self) -> int:
+        return 1
+
+
+REGEXES = [
+    r"a+b*",
+    r"(ab|ba)+",
+    r"[a-c]{2,3}",
+    r"a.*b",
+    r"\d? ?[ab]+",
+    r"(a|b)c?1?",
+    r"[^ ]+ [^ ]+",
+    r"^ab$|c",
+    r"(?:a|b)*c",
+    Params().regex,
+    r"(?=a)[ab]+",
+    r"(?!ab).+",
+    r"(?=.*b)(?!.*c).*",
+    r"a+$",
+    r"a+$\n?",
+    r"(a|b$)c?",
+    r"(?!.*\s).+[.!]$",
+]
+
+
+def _sequences(max_length: int) -> List[List[int]]:
+    tokens = range(2, len(PIECES))
+    return [
+        [0, *sequence]
+        for length in range(max_length + 1)
+        for sequence in product(tokens, repeat=length)
+    ]
+
+
+def _build(regex: str) -> TokenAutomaton:
+    return TokenAutomaton.build(
+        re.compile(regex), PieceTokenizer(), len(PIECES)
+    )
+
+
+@pytest.mark.parametrize("regex", REGEXES)
+def test_accepts_same_texts_as_fullmatch(regex: str) -> None:
+    automaton = _build(regex)
+    sequences = _sequences(4)
+    tensor = torch.tensor([s + [0] * (5 - len(s)) for s in sequences])
+    lengths = torch.tensor([len(s) for s in sequences])
+
+    states = automaton.run(tensor, lengths)
+    ends = automaton.advance(states, torch.ones_like(states))
+
+    for sequence, end in zip(sequences, ends.tolist()):
+        text = PieceTokenizer().decode(sequence)
+        assert (end >= 0) == bool(re.fullmatch(regex, text)), text
+
+
+@pytest.mark.parametrize("regex", REGEXES)
+def test_masked_sampling_produces_matches(regex: str) -> None:
+    torch.manual_seed(0)
+    automaton = _build(regex)
+    budget = 6
+    states = torch.zeros(200, dtype=torch.long)
+    texts = [""] * len(states)
+    done = torch.zeros(len(states), dtype=torch.bool)
+
+    for step in range(budget, 0, -1):
+        mask = automaton.mask(states, torch.full_like(states, step))
+        tokens = torch.multinomial(mask.float(), 1).flatten()
+        tokens[done] = 1
+        for i, token in enumerate(tokens.tolist()):
+            if not done[i]:
+                texts[i] += PIECES[token]
+        done |= tokens == 1
+        states = torch.where(done, states, automaton.advance(states, tokens))
+
+    assert done.any()
+    for text in texts:
+        assert re.fullmatch(regex, text), text
+
+
+def test_rejects_assertions_inside_repetition() -> None:
+    with pytest.raises(ValueError):
+        _build(r"(a|b$)+")
@@ -0,0 +1,174 @@
+import asyncio
+from asyncio import Lock
+from typing import Iterable, List, Optional, Tuple
+
+import pytest
+import torch
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence
+
+from kilroy_module_pytorch_py_sdk.generator.generator import Generator
+from kilroy_module_pytorch_py_sdk.models.abc import (
+    SequentialModel,
+    StepwiseSequentialModel,
+)
+from kilroy_module_pytorch_py_sdk.models.loader import ModelInfo
+from kilroy_module_pytorch_py_sdk.tokenizer import Tokenizer
+from kilroy_module_pytorch_py_sdk.utils import pack_padded, unpack_to_padded
+
+END_TOKEN = 1
+FIRST_RESPONSE_TOKEN = 256
+VOCABULARY_SIZE = 1024
+
+
+class CharTokenizer(Tokenizer):
+    def __init__(self, start: bool = True) -> None:
+        self._start = start
+
+    def encode(self, text: str) -> List[int]:
+        indices = [ord(char) for char in text] + [self.end_token]
+        return [self.start_token] + indices if self._start else indices
+
+    def decode(self, indices: List[int]) -> str:
+        return "".join(chr(index) for index in indices if index > 1)
+
+    @property
+    def start_token(self) -> int:
+        return 0
+
+    @property
+    def end_token(self) -> int:
+        return END_TOKEN
+
+
+def _one_hot_logprobs(shape: Tuple[int, ...], tokens: Tensor) -> Tensor:
+    logprobs = torch.full((*shape, VOCABULARY_SIZE), -1e9)
+    logprobs[torch.arange(len(tokens)), ..., tokens] = 0
+    return logprobs
+
+
+class UniqueTokenModel(SequentialModel):
+    def __init__(self, total_length: int) -> None:
+        super().__init__()
+        self.total_length = total_length
+        self.next_token = FIRST_RESPONSE_TOKEN
+        self.last_tokens: List[Tensor] = []
+
+    def forward(self, x: PackedSequence) -> PackedSequence:
+        padded, lengths = unpack_to_padded(x)
+        padded = padded.squeeze(-1)
+        self.last_tokens.append(
+            padded[torch.arange(len(lengths)), lengths - 1]
+        )
+
+        tokens = []
+        for length in lengths.tolist():
+            if length >= self.total_length:
+                tokens.append(END_TOKEN)
+            else:
+                tokens.append(self.next_token)
+                self.next_token += 1
+
+        logprobs = _one_hot_logprobs(padded.shape, torch.tensor(tokens))
+        return pack_padded(logprobs, lengths)
+
+
+class CountingStepwiseModel(StepwiseSequentialModel[Tensor]):
+    def __init__(self, total_length: int) -> None:
+        super().__init__()
+        self.total_length = total_length
+        self.batch_sizes: List[int] = []
+        self.prefills = 0
+
+    def forward(self, x: PackedSequence) -> PackedSequence:
+        raise NotImplementedError
+
+    def forward_last(
+        self, x: PackedSequence, state: Optional[Tensor] = None
+    ) -> Tuple[Tensor, Tensor]:
+        _, lengths = unpack_to_padded(x)
+        counts = lengths if state is None else state + lengths
+        self.batch_sizes.append(len(lengths))
+        self.prefills += state is None
+
+        tokens = torch.where(
+            counts < self.total_length, ord("a"), END_TOKEN
+        ).long()
+        return _one_hot_logprobs((len(tokens),), tokens), counts
+
+    def select_state(self, state: Tensor, indices: Tensor) -> Tensor:
+        return state[indices]
+
+    def concatenate_states(self, states: Iterable[Tensor]) -> Tensor:
+        return torch.cat(list(states))
+
+
+def _generate(
+    model: SequentialModel, contexts: List[str], n: int, window: int
+) -> List[Tuple[List[int], List[int]]]:
+    async def generate() -> List[Tuple[List[int], List[int]]]:
+        generator = await Generator.create(
+            contexts=contexts, regex=r".*", max_length=20, window=window
+        )
+        info = ModelInfo(
+            model=model, tokenizer=CharTokenizer(), batch_size=64, lock=Lock()
+        )
+        return [s async for s in generator.generate_stream(info, n)]
+
+    return asyncio.run(generate())
+
+
+def test_context_index_keeps_context_tokens() -> None:
+    index = Generator._build_context_index(["ab", ""], CharTokenizer())
+
+    assert index.lengths.tolist() == [3, 1]
+    assert index.sequences[0].tolist() == [0, ord("a"), ord("b")]
+    assert index.sequences[1, :1].tolist() == [0]
+
+
+def test_context_index_rejects_empty_contexts() -> None:
+    with pytest.raises(ValueError):
+        Generator._build_context_index(["ab", ""], CharTokenizer(False))
+
+
+def test_stream_yields_every_sequence_once_within_window() -> None:
+    torch.manual_seed(0)
+    model = UniqueTokenModel(total_length=7)
+
+    results = _generate(model, ["", "ab", "abcd"], 10, 4)
+
+    responses = [
+        tuple(r for r in response if r != END_TOKEN) for _, response in results
+    ]
+    assert len(results) == 10
+    assert len(set(responses)) == 10
+    assert all(r >= FIRST_RESPONSE_TOKEN for rs in responses for r in rs)
+    assert len(model.last_tokens[0]) == 4
+    assert max(len(tokens) for tokens in model.last_tokens) == 4
+
+
+def test_finished_sequences_are_replaced_while_others_run() -> None:
+    torch.manual_seed(0)
+    model = UniqueTokenModel(total_length=7)
+
+    _generate(model, ["", "abcd"], 12, 3)
+
+    assert any(
+        (tokens < FIRST_RESPONSE_TOKEN).any()
+        and (tokens >= FIRST_RESPONSE_TOKEN).any()
+        for tokens in model.last_tokens
+    )
+
+
+def test_stepwise_prefill_continues_from_context_state() -> None:
+    torch.manual_seed(0)
+    model = CountingStepwiseModel(total_length=6)
+
+    results = _generate(model, ["ab", "abc", "abd", "b", ""], 12, 3)
+
+    assert len(results) == 12
+    for context, response in results:
+        text = CharTokenizer().decode(response)
+        assert text == "a" * (6 - len(context))
+    assert max(model.batch_sizes) <= 3
+    assert model.prefills > 1
@@ -0,0 +1,81 @@
+import asyncio
+from typing import Tuple, Type
+
+import pytest
+import torch
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence
+
+from kilroy_module_pytorch_py_sdk.regularizations.policy import (
+    DeparturePolicyRegularization,
+    EntropyPolicyRegularization,
+    PolicyRegularization,
+)
+from kilroy_module_pytorch_py_sdk.utils import TopKLogprobs, pack_list
+
+REGULARIZATIONS = [DeparturePolicyRegularization, EntropyPolicyRegularization]
+
+
+def _make_logprobs(
+    lengths: Tuple[int, ...], n_classes: int, scale: float
+) -> Tuple[PackedSequence, PackedSequence]:
+    logits = [torch.randn(length, n_classes) * scale for length in lengths]
+    noise = [torch.randn_like(x) for x in logits]
+    return (
+        pack_list([(x + e).log_softmax(-1) for x, e in zip(logits, noise)]),
+        pack_list([x.log_softmax(-1) for x in logits]),
+    )
+
+
+def _calculate(
+    cls: Type[PolicyRegularization], k: int, scale: float
+) -> Tuple[Tensor, Tensor]:
+    async def calculate() -> Tuple[Tensor, Tensor]:
+        regularization = await cls.create()
+        policy, baseline = _make_logprobs((4, 1, 3), 50, scale)
+        compact = TopKLogprobs.from_logprobs(baseline, k)
+
+        dense_loss = await regularization.calculate(policy.data, baseline.data)
+        compact_loss = await regularization.calculate_top_k(
+            policy.data, compact
+        )
+        await regularization.cleanup()
+        return dense_loss, compact_loss
+
+    return asyncio.run(calculate())
+
+
+@pytest.mark.parametrize("cls", REGULARIZATIONS)
+def test_full_support_matches_dense_loss(
+    cls: Type[PolicyRegularization],
+) -> None:
+    torch.manual_seed(0)
+    dense_loss, compact_loss = _calculate(cls, 50, 1.0)
+    assert torch.allclose(compact_loss, dense_loss, atol=1e-3)
+
+
+@pytest.mark.parametrize("cls", REGULARIZATIONS)
+def test_compact_loss_matches_dense_loss(
+    cls: Type[PolicyRegularization],
+) -> None:
+    torch.manual_seed(0)
+    dense_loss, compact_loss = _calculate(cls, 10, 8.0)
+    assert torch.allclose(compact_loss, dense_loss, atol=1e-2)
+
+
+@pytest.mark.parametrize("cls", REGULARIZATIONS)
+def test_compact_loss_propagates_gradients(
+    cls: Type[PolicyRegularization],
+) -> None:
+    async def calculate() -> Tensor:
+        regularization = await cls.create()
+        policy, baseline = _make_logprobs((3, 2), 20, 1.0)
+        policy.data.requires_grad_()
+        baseline = TopKLogprobs.from_logprobs(baseline, 5)
+        loss = await regularization.calculate_top_k(policy.data, baseline)
+        loss.sum().backward()
+        await regularization.cleanup()
+        return policy.data.grad
+
+    torch.manual_seed(0)
+    assert asyncio.run(calculate()).abs().sum() > 0
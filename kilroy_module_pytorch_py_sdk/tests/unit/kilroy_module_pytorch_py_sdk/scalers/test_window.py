@@ -0,0 +1,46 @@
+import asyncio
+import random
+from statistics import fmean, stdev
+from typing import List
+
+import pytest
+
+from kilroy_module_pytorch_py_sdk.scalers.reward.window import (
+    WindowRewardScaler,
+)
+
+
+def _expected(rewards: List[float], length: int) -> List[float]:
+    expected = []
+    for i, reward in enumerate(rewards):
+        window = rewards[max(0, i + 1 - length) : i + 1]
+        if len(window) < 2 or stdev(window) == 0:
+            expected.append(0.0)
+        else:
+            expected.append((reward - fmean(window)) / stdev(window))
+    return expected
+
+
+async def _scale(rewards: List[float], length: int, batch: int) -> List[float]:
+    scaler = await WindowRewardScaler.create(length=length)
+    scaled = []
+    for i in range(0, len(rewards), batch):
+        scaled.extend(await scaler.scale_batch(rewards[i : i + batch]))
+    return scaled
+
+
+@pytest.mark.parametrize("offset", [0.0, 1e4, 1e8])
+@pytest.mark.parametrize("batch", [1, 7])
+def test_matches_exact_window_statistics(offset: float, batch: int) -> None:
+    rng = random.Random(0)
+    rewards = [offset + rng.gauss(0, 1) for _ in range(500)]
+
+    scaled = asyncio.run(_scale(rewards, 50, batch))
+
+    assert scaled == pytest.approx(_expected(rewards, 50), abs=1e-6)
+
+
+def test_constant_rewards_scale_to_zero() -> None:
+    scaled = asyncio.run(_scale([3.0] * 20, 5, 1))
+
+    assert scaled == [0.0] * 20
@@ -0,0 +1,68 @@
+import asyncio
+from typing import List
+
+import pytest
+import torch
+from torch import Tensor
+
+from kilroy_module_pytorch_py_sdk.gae import GeneralizedAdvantageEstimator
+from kilroy_module_pytorch_py_sdk.utils import pack_list, unpack_to_list
+
+
+def _loop(
+    rewards: List[Tensor], values: List[Tensor], gamma: float, lambda_: float
+) -> List[Tensor]:
+    all_advantages = []
+
+    for sequence_rewards, sequence_values in zip(rewards, values):
+        advantages = []
+        advantage = 0
+
+        for i in reversed(range(len(sequence_rewards))):
+            next_value = (
+                torch.zeros(1)
+                if i == len(sequence_rewards) - 1
+                else sequence_values[i + 1]
+            )
+            delta = (
+                sequence_rewards[i] + gamma * next_value - sequence_values[i]
+            )
+            advantage = delta + gamma * lambda_ * advantage
+            advantages.append(advantage)
+
+        all_advantages.append(torch.stack(advantages[::-1]))
+
+    return all_advantages
+
+
+def _calculate(
+    rewards: List[Tensor], values: List[Tensor], gamma: float, lambda_: float
+) -> List[Tensor]:
+    async def calculate() -> List[Tensor]:
+        gae = await GeneralizedAdvantageEstimator.create(
+            gamma=gamma, lambda_=lambda_
+        )
+        advantages = await gae.calculate(pack_list(rewards), pack_list(values))
+        return unpack_to_list(advantages)
+
+    return asyncio.run(calculate())
+
+
+@pytest.mark.parametrize("gamma", [0.0, 0.9, 1.0])
+@pytest.mark.parametrize("lambda_", [0.0, 0.5, 0.95, 1.0])
+@pytest.mark.parametrize("terminal", [True, False])
+def test_matches_loop(gamma: float, lambda_: float, terminal: bool) -> None:
+    torch.manual_seed(0)
+    lengths = [5, 1, 12, 7, 7, 3]
+    values = [torch.randn(length, 1) for length in lengths]
+    rewards = [torch.randn(length, 1) for length in lengths]
+    if terminal:
+        for sequence_rewards in rewards:
+            sequence_rewards[:-1] = 0
+
+    advantages = _calculate(rewards, values, gamma, lambda_)
+    expected = _loop(rewards, values, gamma, lambda_)
+
+    assert len(advantages) == len(expected)
+    for actual, reference in zip(advantages, expected):
+        assert torch.allclose(actual, reference, atol=1e-5)
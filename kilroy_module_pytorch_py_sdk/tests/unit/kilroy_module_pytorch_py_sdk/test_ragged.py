@@ -0,0 +1,102 @@
+from typing import List
+
+import pytest
+import torch
+from torch import Tensor
+from torch.nn.utils.rnn import pack_sequence
+
+from kilroy_module_pytorch_py_sdk.ragged import RaggedBatch
+from kilroy_module_pytorch_py_sdk.utils import pack_list, unpack_to_list
+
+
+def _make_sequences(lengths: List[int], features: int = 3) -> List[Tensor]:
+    return [
+        torch.arange(length * features).float().view(length, features) + i
+        for i, length in enumerate(lengths)
+    ]
+
+
+def _assert_same(actual: List[Tensor], expected: List[Tensor]) -> None:
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        assert torch.equal(a, e)
+
+
+LENGTHS = [[1], [4, 1, 3], [2, 5, 5, 1, 3], [3, 3, 3]]
+
+
+@pytest.mark.parametrize("lengths", LENGTHS)
+def test_packed_round_trip(lengths: List[int]) -> None:
+    sequences = _make_sequences(lengths)
+
+    batch = RaggedBatch.from_list(sequences)
+    packed = batch.to_packed()
+
+    _assert_same(unpack_to_list(packed), sequences)
+    _assert_same(RaggedBatch.from_packed(packed).to_list(), sequences)
+
+
+@pytest.mark.parametrize("lengths", LENGTHS)
+@pytest.mark.parametrize("enforce_sorted", [True, False])
+def test_from_packed_matches_unpacking(
+    lengths: List[int], enforce_sorted: bool
+) -> None:
+    sequences = _make_sequences(lengths)
+    if enforce_sorted:
+        sequences = sorted(sequences, key=len, reverse=True)
+    packed = pack_sequence(sequences, enforce_sorted=enforce_sorted)
+
+    batch = RaggedBatch.from_packed(packed)
+
+    assert batch.lengths.tolist() == [len(s) for s in sequences]
+    _assert_same(batch.to_list(), sequences)
+
+
+@pytest.mark.parametrize("lengths", LENGTHS)
+def test_to_packed_like_restores_layout(lengths: List[int]) -> None:
+    sequences = _make_sequences(lengths)
+    packed = pack_list(sequences)
+
+    restored = RaggedBatch.from_packed(packed).to_packed_like(packed)
+
+    assert torch.equal(restored.data, packed.data)
+    assert torch.equal(restored.batch_sizes, packed.batch_sizes)
+    assert torch.equal(restored.sorted_indices, packed.sorted_indices)
+    assert torch.equal(restored.unsorted_indices, packed.unsorted_indices)
+
+
+def test_indexing_and_helpers_match_lists() -> None:
+    sequences = _make_sequences([2, 5, 1, 3])
+    batch = RaggedBatch.from_list(sequences)
+    indices = torch.tensor([3, 0, 3])
+
+    _assert_same(batch[indices].to_list(), [sequences[i] for i in indices])
+    _assert_same(batch[1:3].to_list(), sequences[1:3])
+    assert torch.equal(batch.first(), torch.stack([s[0] for s in sequences]))
+    assert torch.equal(batch.last(), torch.stack([s[-1] for s in sequences]))
+    assert torch.equal(batch.sum(), torch.stack([s.sum(0) for s in sequences]))
+
+
+def test_join_split_and_cat() -> None:
+    contexts = _make_sequences([1, 3, 2])
+    responses = _make_sequences([4, 1, 2])
+
+    joined = RaggedBatch.join(zip(contexts, responses))
+    left, right = joined.split(torch.tensor([len(c) for c in contexts]))
+
+    _assert_same(left.to_list(), contexts)
+    _assert_same(right.to_list(), responses)
+    _assert_same(
+        RaggedBatch.cat([left, RaggedBatch.from_list([]), right]).to_list(),
+        contexts + responses,
+    )
+
+
+def test_from_last_places_values_at_ends() -> None:
+    lengths = torch.tensor([3, 1, 2])
+    values = torch.tensor([[1.0], [2.0], [3.0]])
+
+    batch = RaggedBatch.from_last(lengths, values)
+
+    assert batch.data.flatten().tolist() == [0, 0, 1, 2, 0, 3]
+    assert torch.equal(batch.last(), values)
@@ -0,0 +1,133 @@
+from typing import List, Tuple
+
+import torch
+from torch import Tensor
+
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.buffer import (
+    FIFO_EVICTION,
+    RESERVOIR_EVICTION,
+    CacheBatch,
+    SequenceBuffer,
+)
+
+Item = Tuple[Tensor, Tensor, Tensor, Tensor]
+
+
+def _make_items(start: int, n: int) -> List[Item]:
+    return [
+        (
+            torch.full((i % 3 + 1, 1), i),
+            torch.full((i % 4 + 1, 1), -i),
+            torch.tensor(float(i)),
+            torch.tensor(float(i) / 2),
+        )
+        for i in range(start, start + n)
+    ]
+
+
+def _rewards(buffer: SequenceBuffer) -> List[float]:
+    return [float(reward) for _, _, _, reward in buffer.to_list()]
+
+
+def test_fifo_keeps_latest_items_in_order() -> None:
+    buffer = SequenceBuffer(10)
+    items = []
+
+    for start, n in [(0, 4), (4, 5), (9, 3), (12, 25), (37, 1)]:
+        batch = _make_items(start, n)
+        buffer.extend(batch)
+        items = (items + batch)[-10:]
+
+        assert len(buffer) == len(items)
+        assert buffer.get_ids().tolist() == list(range(start + n))[-10:]
+        for (context, response, score, reward), expected in zip(
+            buffer.to_list(), items
+        ):
+            assert torch.equal(context, expected[0])
+            assert torch.equal(response, expected[1])
+            assert float(score) == float(expected[2])
+            assert float(reward) == float(expected[3])
+
+
+def test_fifo_with_zero_capacity_keeps_nothing() -> None:
+    buffer = SequenceBuffer(0)
+    buffer.extend(_make_items(0, 5))
+
+    assert len(buffer) == 0
+    assert buffer.count == 5
+    assert len(buffer.get_batch().full_sequences) == 0
+
+
+def test_reservoir_keeps_uniform_sample() -> None:
+    torch.manual_seed(0)
+    counts = torch.zeros(100)
+
+    for _ in range(300):
+        buffer = SequenceBuffer(10)
+        for start in range(0, 100, 7):
+            buffer.extend(
+                _make_items(start, min(7, 100 - start)), RESERVOIR_EVICTION
+            )
+        assert len(buffer) == 10
+        counts[buffer.get_ids()] += 1
+
+    buckets = counts.view(10, 10).sum(-1)
+    assert torch.all((buckets - 300).abs() < 75)
+
+
+def test_fifo_after_reservoir_evicts_oldest() -> None:
+    torch.manual_seed(0)
+    buffer = SequenceBuffer(8)
+    buffer.extend(_make_items(0, 30), RESERVOIR_EVICTION)
+    kept = buffer.get_ids().tolist()
+
+    buffer.extend(_make_items(30, 3), FIFO_EVICTION)
+
+    assert buffer.get_ids().tolist() == kept[3:] + [30, 31, 32]
+
+
+def test_batch_view_is_reused_until_mutation() -> None:
+    buffer = SequenceBuffer(5)
+    buffer.extend(_make_items(0, 3))
+
+    batch = buffer.get_batch()
+    assert buffer.get_batch() is batch
+
+    buffer.extend(_make_items(3, 4))
+    updated = buffer.get_batch()
+    assert updated is not batch
+    assert updated.full_sequences.lengths.tolist() == [
+        (i % 3 + 1) + (i % 4 + 1) for i in range(2, 7)
+    ]
+    assert updated.timestep_rewards.last().flatten().tolist() == _rewards(
+        buffer
+    )
+
+
+def test_resized_keeps_latest_items() -> None:
+    buffer = SequenceBuffer(6)
+    buffer.extend(_make_items(0, 9))
+
+    smaller = buffer.resized(4)
+    larger = smaller.resized(8)
+    larger.extend(_make_items(9, 2))
+
+    assert smaller.get_ids().tolist() == [5, 6, 7, 8]
+    assert larger.get_ids().tolist() == [5, 6, 7, 8, 9, 10]
+
+
+def test_batch_from_data_matches_buffer_batch() -> None:
+    buffer = SequenceBuffer(5)
+    buffer.extend(_make_items(0, 8))
+
+    expected = buffer.get_batch()
+    batch = CacheBatch.from_data(buffer.to_list())
+
+    assert torch.equal(batch.full_sequences.data, expected.full_sequences.data)
+    assert torch.equal(
+        batch.full_sequences.lengths, expected.full_sequences.lengths
+    )
+    assert torch.equal(
+        batch.timestep_rewards.data, expected.timestep_rewards.data
+    )
+    assert len(CacheBatch.from_data([]).full_sequences) == 0
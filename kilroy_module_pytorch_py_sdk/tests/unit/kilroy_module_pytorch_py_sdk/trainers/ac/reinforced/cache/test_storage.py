@@ -0,0 +1,112 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import List, Tuple
+
+import torch
+from torch import Tensor
+
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache import Cache
+from kilroy_module_pytorch_py_sdk.trainers.ac.reinforced.cache.storage import (
+    SEGMENTS_DIRECTORY,
+)
+
+Item = Tuple[Tensor, Tensor, Tensor, Tensor]
+
+
+def _make_items(start: int, n: int) -> List[Item]:
+    return [
+        (
+            torch.full((i % 3 + 1, 1), i),
+            torch.full((i % 5 + 1, 1), i + 1),
+            torch.tensor(float(i)),
+            torch.tensor(float(-i)),
+        )
+        for i in range(start, start + n)
+    ]
+
+
+def _assert_same(actual: List[Item], expected: List[Item]) -> None:
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        for x, y in zip(a, e):
+            assert torch.equal(x, y)
+
+
+def _segments(directory: Path) -> List[dict]:
+    with open(directory / "state.json") as f:
+        return json.load(f)["segments"]
+
+
+def test_save_load_round_trips(tmp_path: Path) -> None:
+    async def run() -> None:
+        cache = await Cache.create(max_size=20)
+
+        for step in range(12):
+            await cache.extend(_make_items(step * 7, 7))
+            if step == 6:
+                await cache.config.set({"eviction": "reservoir"})
+            if step == 9:
+                await cache.config.set({"maxSize": 8, "eviction": "fifo"})
+            await cache.save(tmp_path)
+
+            loaded = await Cache.from_saved(tmp_path)
+            _assert_same(list(await loaded.get()), list(await cache.get()))
+
+    asyncio.run(run())
+
+
+def test_loaded_cache_keeps_appending(tmp_path: Path) -> None:
+    async def run() -> None:
+        cache = await Cache.create(max_size=10)
+        await cache.extend(_make_items(0, 6))
+        await cache.save(tmp_path)
+
+        loaded = await Cache.from_saved(tmp_path)
+        await loaded.extend(_make_items(6, 9))
+        await loaded.save(tmp_path)
+        await cache.extend(_make_items(6, 9))
+
+        reloaded = await Cache.from_saved(tmp_path)
+        _assert_same(list(await reloaded.get()), list(await cache.get()))
+        _assert_same(list(await reloaded.get()), _make_items(5, 10))
+
+    asyncio.run(run())
+
+
+def test_saves_are_compacted(tmp_path: Path) -> None:
+    async def run() -> None:
+        cache = await Cache.create(max_size=10)
+
+        for step in range(50):
+            await cache.extend(_make_items(step * 3, 3))
+            await cache.save(tmp_path)
+
+            segments = _segments(tmp_path)
+            directories = {
+                path.name for path in (tmp_path / SEGMENTS_DIRECTORY).iterdir()
+            }
+            assert directories == {segment["name"] for segment in segments}
+            assert sum(segment["size"] for segment in segments) <= 2 * 10 + 3
+
+        loaded = await Cache.from_saved(tmp_path)
+        _assert_same(list(await loaded.get()), _make_items(140, 10))
+
+    asyncio.run(run())
+
+
+def test_loads_legacy_data_file(tmp_path: Path) -> None:
+    async def run() -> None:
+        items = _make_items(0, 4)
+        torch.save(items, tmp_path / "data.pt")
+        with open(tmp_path / "state.json", "w") as f:
+            json.dump({"max_size": 3}, f)
+
+        cache = await Cache.from_saved(tmp_path)
+        _assert_same(list(await cache.get()), items[1:])
+
+        await cache.save(tmp_path)
+        loaded = await Cache.from_saved(tmp_path)
+        _assert_same(list(await loaded.get()), items[1:])
+
+    asyncio.run(run())